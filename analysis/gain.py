@@ -3,231 +3,335 @@
 """
 This little program should help you decide if using Traffic Morphing
 is worth it. It will morph thousands of packets, both using morpher
-and direct sampling, and compare the overhead by plotting it.
+and direct sampling, and compare the overhead.
 
-It's not very user friendly, and might be buggy, but it gets the job
-done...
-"""
+It runs a sweep over a grid of morphing matrices (each one for a
+direction, with its source and target distributions), split penalties
+and packet counts, given as a sweep file:
 
-import matplotlib
-matplotlib.use('Agg') # to be able to plot in machines without X.org
-import matplotlib.pyplot as plt
-import numpy
-import scipy.stats
-import decimal
-import math
-import sys
+# matrix <direction> <source> <target> <morphing matrix>
+matrix CS ../data/tor_cs_distr.txt ../data/https_cs_distr.txt ../mm_cs.mtx
+matrix SC ../data/tor_sc_distr.txt ../data/https_sc_distr.txt ../mm_sc.bin
+# split-penalty <bytes>...
+split-penalty 0 50 100
+# packets <count>...
+packets 100000 1000000
 
-sys.path.append("../dreams/python/")
-import dream
+Filenames are relative to the directory of the sweep file. Every cell
+of the grid is simulated (see simulate.py) on a process pool, with its
+own random stream, and the results are written as one tab-separated
+table, along with the exact expected overheads (see overhead.py):
 
-# CHANGE THESE FILENAMES TO POINT TO YOUR PROB. DISTRS AND MORPHING MATRICES
-SC_HTTPS_PROB_DISTR_FILENAME = "../data/https_sc_distr.txt"
-SC_TOR_PROB_DISTR_FILENAME = "../data/tor_sc_distr.txt"
-SC_MORPHING_MATRIX_FILENAME = "../__personal_lol_sc"
-
-CS_HTTPS_PROB_DISTR_FILENAME = "../data/https_cs_distr.txt"
-CS_TOR_PROB_DISTR_FILENAME = "../data/tor_cs_distr.txt"
-CS_MORPHING_MATRIX_FILENAME = "../__personal_lol_cs"
-
-"""Return True if 'string' represents a floating point number."""
-def string_is_float(string):
-    try:
-        float(string)
-    except ValueError, TypeError:
-        return False
-    return True
+$ gain.py --sweep=sweep.txt --jobs=8 --output=results.tsv
 
-"""Given a file of the format '<packet length: probability>\n':
+A single cell can also be given on the command line:
 
-# comment
-1: 0.024...
-2: 0.005...
-3: 0.156...
-...
-
-return a list representing its probability distribution.
+$ gain.py --direction=CS --source=../data/tor_cs_distr.txt \
+      --target=../data/https_cs_distr.txt --matrix=../mm_cs.mtx --plot
 """
-def get_distr_from_file(filename):
-    i = 1
-    distr = []
-    with open(filename) as file:
-        for line in file:
-            subline = line.split(" ")
-            if (subline[0].startswith("#")): # comment
-                continue
-            if ((len(subline) != 2) or
-                (not subline[0].startswith(str(i))) or
-                (not string_is_float(subline[1]))):
-                print "Wrong file format (%d %s %s)" % (len(subline), subline[0], str(i))
-                sys.exit(1)
-            distr.append(subline[1].rstrip())
-            i+=1
-
-    tmp = map(decimal.Decimal, distr)
-    assert(math.fsum(tmp) == decimal.Decimal(1))
-
-    return distr
-
-"""Given a filename containing a probability distribution, and a name
-for the distribution, return a scipy prob. distribution
-representation."""
-def get_prob_distr_from_file(filename, name):
-    tmp = get_distr_from_file(filename)
-    https_cs_distr = map(numpy.double, tmp)
-    https_cs_vals = [numpy.arange(1460), https_cs_distr]
-    return scipy.stats.rv_discrete(name=name, values=https_cs_vals)
-
-DEBUG = True
-
-# How many bytes of penalty overhead to add when we split a packet.
-SPLIT_PENALTY = 50
 
-# Client->Server (CS) or Server->Client (SC)
-MODE = 'CS'
-
-"""Given a packet of 'packet_size' bytes, return the total morphing overhead in bytes.
-If 'method' is "sampling", use the traditional sampling method. If
-'method' is "morphing" use packet morphing.
+import sys
+import os
+import getopt
+import itertools
+import multiprocessing
+import time
+import numpy
 
-'arg' is a method-specific argument. In the case of sampling, its the
-target protocol probability distribution. In the case of morphing, its
-a list with a morphing matrix as the first element, and the target
-protocol probability distribution as the second element.
-"""
-def get_overhead_for_packet_size(packet_size, method, arg):
-    overhead = 0
-    first_split = True
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "dreams", "python"))
+import dream
 
-    """If we are "morphing", we use the morphing matrix to get the
-    first target packet size, and the probability distribution for any
-    subsequent packets in the case of splitting.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import distr
 
-    If we are "samplign" we only use the probability distribution.
-    """
+import simulate
+import overhead
 
-    while (True):
-        if (method == 'morphing'):
-            if (first_split):
-                target_randv = arg[0].get_target_length(packet_size)
-            else:
-                target_randv = arg[1].rvs()
-        elif (method == 'sampling'):
-            target_randv = arg.rvs()
-        else:
-            print("???")
-            sys.exit(1)
-
-        if (target_randv >= packet_size):
-            if (DEBUG):
-                print "%s: Got packet size %d. We must morph it to %d. " \
-                    "Padding with %d and sending." % \
-                    (method, packet_size, target_randv, target_randv - packet_size)
+# Client->Server (CS) or Server->Client (SC)
+DIRECTIONS = ("CS", "SC")
 
-            overhead += target_randv - packet_size
-            break # exit the loop. we sent the whole packet.
-        else:
-            if (DEBUG):
-                print "%s: Got packet size %d. We must morph it to %d. " \
-                    "Splitting to %d and sending the first part..." % \
-                    (method, packet_size, target_randv, packet_size - target_randv)
+# How many bytes of penalty overhead to add when we split a packet.
+SPLIT_PENALTY = simulate.SPLIT_PENALTY
 
-            overhead += SPLIT_PENALTY
-            packet_size -= target_randv
-            # loop again. we haven't sent the whole packet yet.
+DEFAULT_PACKETS = 500000
 
-        first_split = False
+# How many points of the cumulative overhead to plot at most.
+PLOT_POINTS = 10000
 
-    return overhead
+# The columns of the results table.
+COLUMNS = ("direction", "matrix", "split_penalty", "packets", "seed",
+           "sampling", "morphing", "gain", "expected_sampling",
+           "expected_morphing", "seconds")
 
 """Given the elements on the x axis, a list containing the elements of
-the y, a list containing labels, and a filename, plot the diagram and
-save it to the disk."""
-def plot_it(x_axis, y_axis_list, label_list, name):
+the y, a list containing labels, a title and a filename, plot the
+diagram and save it to the disk."""
+def plot_it(x_axis, y_axis_list, label_list, title, fname):
+    import matplotlib
+    matplotlib.use('Agg') # to be able to plot in machines without X.org
+    import matplotlib.pyplot as plt
+
     if (not (len(y_axis_list) == len(label_list))):
-        print "No! (%d %d %d)" % (len(label_list), len(y_axis_list))
+        print "No! (%d %d)" % (len(label_list), len(y_axis_list))
         sys.exit(1)
 
     for i in xrange(len(y_axis_list)):
         plt.plot(x_axis, y_axis_list[i], label=label_list[i])
 
     leg = plt.legend(loc='upper left')
-    if (MODE == 'CS'):
-        plt.title('Client->Server: %s packets' % (name))
-    else:
-        plt.title('Server->Client: %s packets' % (name))
+    plt.title(title)
     plt.ylabel('bytes overhead')
     plt.xlabel('packets')
 
     leg.get_frame().set_alpha(0.5)
 
-    plt.savefig('%s_%s.png' % (name, MODE.lower()))
+    plt.savefig(fname)
 
     plt.clf()
 
-"""Plot diagram every <element> packets."""
-TEST_N = [500, 2000, 8000, 16000, 50000, 100000, 500000]
-
-
-if (MODE == 'SC'):
-    # HTTPS S->C prob. distr.
-    https_custm = get_prob_distr_from_file(SC_HTTPS_PROB_DISTR_FILENAME, "https_gain")
-    # Tor S->C prob. distr.
-    tor_custm = get_prob_distr_from_file(SC_TOR_PROB_DISTR_FILENAME, "tor_gain")
-    # S->C morphing matrix
-    mm_csc = dream.get_csc_from_mm(SC_MORPHING_MATRIX_FILENAME)
-elif (MODE == 'CS'):
-    # HTTPS C->S prob. distr.
-    https_custm = get_prob_distr_from_file(CS_HTTPS_PROB_DISTR_FILENAME, "https_gain")
-    # Tor C->S prob. distr.
-    tor_custm = get_prob_distr_from_file(CS_TOR_PROB_DISTR_FILENAME, "tor_gain")
-    # C->S morphing matrix
-    mm_csc = dream.get_csc_from_mm(CS_MORPHING_MATRIX_FILENAME)
-else:
-    print "STOP... HAMMER TIME"
-    sys.exit(1)
-
-mm = dream.MorphingMatrix(mm_csc)
-
-y_axis_sampling = []
-y_axis_morphing = []
-total_overhead_sampling = 0
-total_overhead_morphing = 0
-
-"""Main loop: Every iteration represents a packet morphing. We morph
-the packet once using 'sampling', and once using 'morphing'. Everytime,
-we add the overhead in bytes to the respective list. If DEBUG is True, we log every round.
-If, according to TEST_N, it's time to plot the diagram, we plot_it().
+"""Given a sweep file 'filename' (see the module documentation), return
+a (matrices, split_penalties, packets) tuple, where 'matrices' is a
+list of (direction, source, target, matrix) tuples. Raise ValueError if
+the file is not a valid sweep file."""
+def get_sweep_from_file(filename):
+    topdir = os.path.dirname(filename)
+    matrices = []
+    split_penalties = []
+    packets = []
+
+    with open(filename) as file:
+        for line in file:
+            subline = line.split()
+            if ((not subline) or (subline[0].startswith("#"))): # comment
+                continue
+
+            if ((subline[0] == "matrix") and (len(subline) == 5) and
+                (subline[1] in DIRECTIONS)):
+                matrices.append(tuple([subline[1]] +
+                                      [os.path.join(topdir, fname)
+                                       for fname in subline[2:]]))
+            elif ((subline[0] in ("split-penalty", "packets")) and
+                  (len(subline) > 1) and
+                  all(value.isdigit() for value in subline[1:])):
+                values = [int(value) for value in subline[1:]]
+                if (subline[0] == "split-penalty"):
+                    split_penalties.extend(values)
+                else:
+                    packets.extend(values)
+            else:
+                raise ValueError("Wrong sweep format (%s)" % (line.rstrip()))
+
+    if (not matrices):
+        raise ValueError("No matrices in sweep file '%s'" % (filename))
+    if (0 in packets):
+        raise ValueError("Packet counts must be positive")
+
+    return (matrices, split_penalties or [SPLIT_PENALTY],
+            packets or [DEFAULT_PACKETS])
+
+"""
+Public function.
+Given the lists of 'matrices' ((direction, source, target, matrix)
+tuples), 'split_penalties' and 'packets' of a sweep, return the list of
+its cells, as dictionaries. Cell 'i' gets the random stream seeded with
+('seed', i), so every cell is reproducible on its own.
+"""
+def get_cells(matrices, split_penalties, packets, seed=0, plot=False):
+    cells = []
+    for ((direction, source, target, matrix), split_penalty, count) in \
+            itertools.product(matrices, split_penalties, packets):
+        cells.append({"direction" : direction, "source" : source,
+                      "target" : target, "matrix" : matrix,
+                      "split_penalty" : split_penalty, "packets" : count,
+                      "seed" : (seed, len(cells)), "plot" : plot})
+    return cells
+
+"""Simulate the sweep cell 'cell' (see get_cells()) and return its row
+of the results table, as a dictionary with COLUMNS as keys. This is a
+module level function so that multiprocessing can pickle it."""
+def run_cell(cell):
+    start = time.time()
+    source = distr.get_distr_from_file(cell["source"])
+    target = distr.get_distr_from_file(cell["target"])
+    mm = dream.get_morphing_matrix_from_file(cell["matrix"])
+    packets = cell["packets"]
+
+    stats = overhead.get_overhead_stats(source, target, mm.matrix,
+                                        cell["split_penalty"])
+    sampling, morphing = simulate.simulate(
+        source, target, mm, packets, cell["split_penalty"],
+        numpy.random.RandomState(list(cell["seed"])))
+
+    if (cell["plot"]):
+        name = "%s_%s_%d_%d" % (cell["direction"].lower(),
+                                os.path.basename(cell["matrix"]),
+                                cell["split_penalty"], packets)
+        step = max(packets // PLOT_POINTS, 1)
+        plot_it(numpy.arange(1, packets+1)[::step],
+                [sampling[::step], morphing[::step]], ["sampling", "morphing"],
+                "%s: %s packets (split penalty %d)" %
+                ({"CS" : "Client->Server",
+                  "SC" : "Server->Client"}[cell["direction"]],
+                 packets, cell["split_penalty"]),
+                "%s.png" % (name))
+
+    return {"direction" : cell["direction"], "matrix" : cell["matrix"],
+            "split_penalty" : cell["split_penalty"], "packets" : packets,
+            "seed" : "%d:%d" % cell["seed"],
+            "sampling" : sampling[-1] / float(packets),
+            "morphing" : morphing[-1] / float(packets),
+            "gain" : (sampling[-1] - morphing[-1]) / float(packets),
+            "expected_sampling" : stats["sampling"]["mean"],
+            "expected_morphing" : stats["morphing"]["mean"],
+            "seconds" : time.time() - start}
+
+"""
+Public function.
+Run the sweep 'cells' (see get_cells()) on a pool of 'jobs' processes
+and return their rows of the results table, in the order of 'cells'.
 """
-for i in xrange(1,max(TEST_N)+1):
-    source_randv = tor_custm.rvs()+1
-
-    """Morph with 'sampling'."""
-    sampling_overhead = get_overhead_for_packet_size(source_randv,
-                                                     'sampling', https_custm)
-
-    total_overhead_sampling += sampling_overhead
-    y_axis_sampling.append(total_overhead_sampling)
-
-    """Morph with 'morphing'."""
-    morphing_overhead = get_overhead_for_packet_size(source_randv,
-                                                     'morphing', (mm, https_custm))
-
-    total_overhead_morphing += morphing_overhead
-    y_axis_morphing.append(total_overhead_morphing)
-
-    """Print information in stdout."""
-    if (DEBUG):
-        print "%d: OVERHEAD ROUND SUMMARY: Sampling: %d : Morphing: %d" % \
-            (i, sampling_overhead, morphing_overhead)
-        rel_overhead = sampling_overhead - morphing_overhead
-        if (rel_overhead >= 0):
-            print "%d: OVERHEAD ROUND SUMMARY: Morpher won (%d)" % (i, rel_overhead)
-        else:
-            print "%d: OVERHEAD ROUND SUMMARY: Morpher lost (%d)" % (i, abs(rel_overhead))
-        print "%d: SUMMARY: %s %s" % (i, str(total_overhead_sampling), str(total_overhead_morphing))
-
-    """If it's time to plot, plot_it()."""
-    if (i in TEST_N):
-        plot_it(range(1,i+1), [y_axis_sampling, y_axis_morphing], ["sampling", "morphing"], str(i))
+def run_sweep(cells, jobs=1):
+    if ((jobs == 1) or (len(cells) == 1)):
+        return map(run_cell, cells)
+
+    pool = multiprocessing.Pool(min(jobs, len(cells)))
+    try:
+        return pool.map(run_cell, cells, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+"""Write the results table 'rows' (see run_cell()) to the file object
+'file', tab-separated, with a header line."""
+def write_results(rows, file):
+    file.write("\t".join(COLUMNS) + "\n")
+    for row in rows:
+        file.write("\t".join([("%.4f" % row[column])
+                              if (isinstance(row[column], float))
+                              else str(row[column])
+                              for column in COLUMNS]) + "\n")
+
+"""Spit usage instructions and exit"""
+def usage():
+    print """Usage:
+    \tgain options [arguments]
+    where 'options' are:
+       --sweep=<sweep filename (see the module documentation)>
+       --direction=<CS or SC; single cell without --sweep, filter with it>
+       --source=<source distribution filename, single cell>
+       --target=<target distribution filename, single cell>
+       --matrix=<morphing matrix filename, single cell>
+       --split-penalty=<bytes of overhead per split, single cell (default: %d)>
+       --packets=<number of packets to morph, single cell (default: %d)>
+       --jobs=<number of worker processes (default: 1)>
+       --seed=<base random seed (default: 0)>
+       --output=<results table filename (default: stdout)>
+       --plot (save a plot of the cumulative overhead of every cell)
+    """ % (SPLIT_PENALTY, DEFAULT_PACKETS)
+    sys.exit()
+
+"""Entry point"""
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "", ["sweep=", "direction=", "source=",
+                                              "target=", "matrix=",
+                                              "split-penalty=", "packets=",
+                                              "jobs=", "seed=", "output=",
+                                              "plot"])
+    except getopt.GetoptError:
+        usage()
+
+    sweep = None
+    direction = None
+    source = None
+    target = None
+    matrix = None
+    split_penalty = SPLIT_PENALTY
+    packets = DEFAULT_PACKETS
+    jobs = 1
+    seed = 0
+    output = None
+    plot = False
+
+    for opt, arg in opts:
+        if opt == "--sweep":
+            sweep = arg
+        elif opt == "--direction":
+            direction = arg.upper()
+        elif opt == "--source":
+            source = arg
+        elif opt == "--target":
+            target = arg
+        elif opt == "--matrix":
+            matrix = arg
+        elif opt == "--split-penalty":
+            split_penalty = int(arg) if arg.isdigit() else -1
+        elif opt == "--packets":
+            packets = int(arg) if arg.isdigit() else 0
+        elif opt == "--jobs":
+            jobs = int(arg) if arg.isdigit() else 0
+        elif opt == "--seed":
+            seed = int(arg) if arg.isdigit() else -1
+        elif opt == "--output":
+            output = arg
+        elif opt == "--plot":
+            plot = True
+
+    if ((direction is not None) and (direction not in DIRECTIONS)):
+        print "Please provide a valid direction (%s)." % (", ".join(DIRECTIONS))
+        usage()
+    if ((jobs <= 0) or (seed < 0)):
+        print "Please provide a positive number of jobs and " \
+            "a non-negative seed."
+        usage()
+
+    if (sweep):
+        if (not os.path.isfile(sweep)):
+            print "Please provide a valid sweep filename."
+            usage()
+        try:
+            matrices, split_penalties, counts = get_sweep_from_file(sweep)
+        except ValueError, e:
+            print "%s: %s" % (sweep, e)
+            sys.exit(1)
+    else:
+        for fname in (source, target, matrix):
+            if ((not fname) or (not os.path.isfile(fname))):
+                print "Please provide valid source, target and matrix " \
+                    "filenames, or a sweep file."
+                usage()
+        if ((packets <= 0) or (split_penalty < 0)):
+            print "Please provide a positive number of packets and " \
+                "a non-negative split penalty."
+            usage()
+        matrices = [(direction or "CS", source, target, matrix)]
+        split_penalties, counts = [split_penalty], [packets]
+
+    # filter after numbering the cells, so that they keep their seeds
+    cells = [cell for cell in
+             get_cells(matrices, split_penalties, counts, seed, plot)
+             if ((not sweep) or (not direction) or
+                 (cell["direction"] == direction))]
+    if (not cells):
+        print "Nothing to do."
+        sys.exit(1)
+
+    start = time.time()
+    rows = run_sweep(cells, jobs)
+
+    if (output):
+        with open(output, "w") as file:
+            write_results(rows, file)
+    else:
+        write_results(rows, sys.stdout)
+
+    print >> sys.stderr, "Ran %d cells in %.2fs." % \
+        (len(cells), time.time() - start)
+
+if __name__ == "__main__":
+    if (sys.hexversion < 0x02070000):
+        print "You can only run this script with a Python version >= 2.7."
+        sys.exit(1)
 
+    main(sys.argv[1:])
@@ -0,0 +1,244 @@
+#!/usr/bin/python2.7
+
+"""
+Exact expected overhead of traffic morphing versus direct sampling.
+
+This answers the question of gain.py without simulating any packets.
+Packets are morphed like in simulate.py: a target length is drawn (for
+'morphing', the first one from the morphing matrix), and the packet is
+either padded up to it, or split, paying 'split_penalty' bytes, with a
+fresh target length drawn from the target distribution for the rest.
+
+The overhead of sending the rest of a split packet only depends on how
+many bytes are left, so its moments are computed by dynamic programming
+over the remaining bytes. The first draw is then a single sparse pass
+over the CSC morphing matrix (or over the target distribution, for
+'sampling').
+
+$ overhead.py --source=../data/tor_cs_distr.txt \
+      --target=../data/https_cs_distr.txt --matrix=../mm.mtx
+
+Pass --simulate=<packets> to cross-check the results with simulate.py.
+"""
+
+import sys
+import os
+import getopt
+import time
+import math
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "dreams", "python"))
+import dream
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import distr
+
+import simulate
+
+METHODS = ("sampling", "morphing")
+
+"""
+Given the 'target' probability distribution (a NumPy array, element 'i'
+being the probability of length 'i+1') and the 'split_penalty', return
+a (mean, second_moment, splits) tuple of NumPy arrays. Element 'r' of
+each is, for a packet with 'r' bytes left to send whose target lengths
+are all drawn from 'target', the expected overhead in bytes, its
+expected square, and the expected number of splits. Element 0 is 0.
+"""
+def get_remaining_moments(target, split_penalty):
+    size = len(target)
+    prob = numpy.concatenate(([0.0], target)) # prob[l]: target length 'l'
+    lengths = numpy.arange(size+1, dtype=numpy.double)
+
+    # tail[r] = P(T >= r), tail1[r] = E[T; T >= r], tail2[r] = E[T^2; T >= r]
+    tail = numpy.cumsum(prob[::-1])[::-1]
+    tail1 = numpy.cumsum((prob * lengths)[::-1])[::-1]
+    tail2 = numpy.cumsum((prob * lengths**2)[::-1])[::-1]
+
+    mean = numpy.zeros(size+1)
+    second = numpy.zeros(size+1)
+    splits = numpy.zeros(size+1)
+    penalty = float(split_penalty)
+
+    for r in xrange(1, size+1):
+        # pad: T >= r, overhead T-r
+        pad1 = tail1[r] - r * tail[r]
+        pad2 = tail2[r] - 2 * r * tail1[r] + r * r * tail[r]
+
+        # split: T < r, overhead penalty + overhead of the r-T bytes left
+        low = prob[1:r]
+        split = 1.0 - tail[r]
+        rest_mean = numpy.dot(low, mean[r-1:0:-1])
+        rest_second = numpy.dot(low, second[r-1:0:-1])
+
+        mean[r] = pad1 + penalty * split + rest_mean
+        second[r] = pad2 + penalty * penalty * split + \
+            2 * penalty * rest_mean + rest_second
+        splits[r] = split + numpy.dot(low, splits[r-1:0:-1])
+
+    return (mean, second, splits)
+
+"""
+Given NumPy arrays 'rows' of the first target lengths drawn, 'cols' of
+the source lengths they were drawn for, and 'probs' of the probability
+of each (target, source) pair, and the moments of the remaining bytes
+as returned by get_remaining_moments(), return a dictionary with the
+expected overhead per packet ('mean'), its 'variance', the probability
+that a packet gets split ('split_probability') and the expected number
+of splits per packet ('splits').
+"""
+def get_first_draw_stats(rows, cols, probs, moments, split_penalty):
+    mean, second, splits = moments
+    padding = rows - cols
+    split = padding < 0
+    left = numpy.where(split, -padding, 0)
+    penalty = float(split_penalty)
+
+    first1 = numpy.where(split, penalty + mean[left], padding)
+    first2 = numpy.where(split,
+                         penalty * penalty + 2 * penalty * mean[left] +
+                         second[left],
+                         padding.astype(numpy.double)**2)
+
+    expected = numpy.dot(probs, first1)
+    return {"mean" : expected,
+            "variance" : max(numpy.dot(probs, first2) - expected**2, 0.0),
+            "split_probability" : probs[split].sum(),
+            "splits" : numpy.dot(probs[split], 1 + splits[left[split]])}
+
+"""
+Public function.
+Given the 'source' and 'target' probability distributions (NumPy
+arrays as returned by distr.get_distr_from_file()), the morphing
+'matrix' between them (a SciPy CSC matrix) and the 'split_penalty',
+return a dictionary from each method in METHODS to its statistics, as
+returned by get_first_draw_stats().
+
+Raise ValueError if the sizes of the distributions and the matrix do
+not match.
+"""
+def get_overhead_stats(source, target, matrix,
+                       split_penalty=simulate.SPLIT_PENALTY):
+    size = len(source)
+    if ((len(target) != size) or (matrix.shape != (size, size))):
+        raise ValueError("Distributions and matrix have different sizes " \
+                         "(%d, %d, %s)." % (size, len(target), matrix.shape))
+
+    matrix = matrix.tocsc()
+    moments = get_remaining_moments(target, split_penalty)
+    lengths = numpy.arange(1, size+1)
+
+    # sampling: every (target, source) pair, with probability target*source
+    rows = numpy.tile(lengths, size)
+    cols = numpy.repeat(lengths, size)
+    probs = numpy.outer(source, target).ravel()
+    stats = {"sampling" : get_first_draw_stats(rows, cols, probs,
+                                               moments, split_penalty)}
+
+    # morphing: the non-zero entries of the matrix, weighted by source
+    cols = numpy.repeat(lengths, numpy.diff(matrix.indptr))
+    rows = matrix.indices + 1
+    probs = matrix.data * source[cols-1]
+    stats["morphing"] = get_first_draw_stats(rows, cols, probs,
+                                             moments, split_penalty)
+
+    return stats
+
+"""Print the statistics 'stats' of get_overhead_stats()."""
+def print_stats(stats):
+    print "%-10s %12s %12s %12s %12s" % ("method", "overhead", "stddev",
+                                          "P(split)", "splits")
+    for method in METHODS:
+        print "%-10s %12.4f %12.4f %12.6f %12.6f" % \
+            (method, stats[method]["mean"],
+             math.sqrt(stats[method]["variance"]),
+             stats[method]["split_probability"], stats[method]["splits"])
+
+"""Spit usage instructions and exit"""
+def usage():
+    print """Usage:
+    \toverhead options [arguments]
+    where 'options' are:
+       --source=<source distribution filename>
+       --target=<target distribution filename>
+       --matrix=<morphing matrix filename (Matrix Market or binary)>
+       --split-penalty=<bytes of overhead per split (default: %d)>
+       --simulate=<number of packets to cross-check with a simulation>
+       --seed=<random seed of the simulation>
+    """ % (simulate.SPLIT_PENALTY)
+    sys.exit()
+
+"""Entry point"""
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "", ["source=", "target=", "matrix=",
+                                              "split-penalty=", "simulate=",
+                                              "seed="])
+    except getopt.GetoptError:
+        usage()
+
+    source = None
+    target = None
+    matrix = None
+    split_penalty = simulate.SPLIT_PENALTY
+    packets = 0
+    seed = None
+
+    for opt, arg in opts:
+        if opt == "--source":
+            source = arg
+        elif opt == "--target":
+            target = arg
+        elif opt == "--matrix":
+            matrix = arg
+        elif opt == "--split-penalty":
+            split_penalty = int(arg) if arg.isdigit() else -1
+        elif opt == "--simulate":
+            packets = int(arg) if arg.isdigit() else -1
+        elif opt == "--seed":
+            seed = int(arg) if arg.isdigit() else None
+
+    for fname in (source, target, matrix):
+        if ((not fname) or (not os.path.isfile(fname))):
+            print "Please provide valid source, target and matrix filenames."
+            usage()
+    if ((packets < 0) or (split_penalty < 0)):
+        print "Please provide a non-negative number of packets and " \
+            "split penalty."
+        usage()
+
+    try:
+        source = distr.get_distr_from_file(source)
+        target = distr.get_distr_from_file(target)
+        mm = dream.get_morphing_matrix_from_file(matrix)
+
+        start = time.time()
+        stats = get_overhead_stats(source, target, mm.matrix, split_penalty)
+    except ValueError, e:
+        print e
+        sys.exit(1)
+
+    print "Computed in %.3fs:" % (time.time() - start)
+    print_stats(stats)
+
+    if (packets):
+        start = time.time()
+        totals = simulate.simulate(source, target, mm, packets,
+                                   split_penalty,
+                                   numpy.random.RandomState(seed))
+        print "Simulated %d packets in %.2fs:" % (packets, time.time() - start)
+        for method, total in zip(METHODS, totals):
+            # a 99.7%% confidence interval around the expected overhead
+            error = 3 * math.sqrt(stats[method]["variance"] / packets)
+            print "%-10s %12.4f (expected %.4f +- %.4f)" % \
+                (method, total[-1] / float(packets),
+                 stats[method]["mean"], error)
+
+if __name__ == "__main__":
+    if (sys.hexversion < 0x02070000):
+        print "You can only run this script with a Python version >= 2.7."
+        sys.exit(1)
+
+    main(sys.argv[1:])
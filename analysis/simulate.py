@@ -0,0 +1,197 @@
+#!/usr/bin/python2.7
+
+"""
+Vectorized Monte Carlo simulation of the overhead of traffic morphing
+versus direct sampling.
+
+It morphs packets exactly like gain.py used to, one at a time, but
+draws all source lengths, target lengths and split remainders as
+NumPy arrays in bulk:
+
+    * A source packet length is drawn from the source distribution.
+
+    * With 'sampling', a target length is drawn from the target
+      distribution. With 'morphing', the first target length is
+      drawn from the morphing matrix column of the source length.
+
+    * If the target length is at least the remaining packet length,
+      the packet is padded up to the target length and sent. Otherwise,
+      the packet is split: 'split_penalty' bytes of overhead are added,
+      the first part is sent, and a new target length is drawn from
+      the target distribution for the rest.
+
+Use it as a library (see simulate()) or as a script:
+
+$ simulate.py --source=../data/tor_cs_distr.txt \
+      --target=../data/https_cs_distr.txt --matrix=../mm.mtx --packets=10000000
+"""
+
+import sys
+import os
+import getopt
+import time
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "dreams", "python"))
+import dream
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import distr
+
+# How many bytes of penalty overhead to add when we split a packet.
+SPLIT_PENALTY = 50
+
+# How many packets to simulate at a time; bounds memory usage.
+CHUNK_SIZE = 1 << 20
+
+"""Given a probability distribution 'distr' over packet lengths
+[1, len(distr)], return its CDF for sample_lengths()."""
+def get_cdf(distr):
+    cdf = numpy.cumsum(distr)
+    return cdf / cdf[-1]
+
+"""Return a NumPy array of 'n' packet lengths drawn from the
+distribution of CDF 'cdf', using NumPy RandomState 'rng'."""
+def sample_lengths(cdf, n, rng):
+    lengths = numpy.searchsorted(cdf, rng.random_sample(n), side='right')
+    return numpy.minimum(lengths, len(cdf) - 1) + 1
+
+"""
+Given NumPy arrays of source packet 'lengths' and of their 'first'
+target lengths, return a NumPy array with the overhead in bytes of
+sending each packet. Target lengths after a split are drawn from the
+target distribution of CDF 'target_cdf'.
+
+All packets are processed together: each round pads and sends the
+packets whose target length fits, and splits the rest, which carry
+over to the next round with fresh target lengths.
+"""
+def get_overheads(lengths, first, target_cdf, split_penalty, rng):
+    overhead = numpy.zeros(len(lengths), dtype=numpy.int64)
+    active = numpy.arange(len(lengths))
+    left = numpy.asarray(lengths, dtype=numpy.int64)
+    targets = numpy.asarray(first, dtype=numpy.int64)
+
+    while (len(active)):
+        padding = targets - left
+        sent = padding >= 0
+        overhead[active] += numpy.where(sent, padding, split_penalty)
+
+        # the packets we split are left with '-padding' bytes to send
+        split = ~sent
+        active = active[split]
+        left = -padding[split]
+
+        targets = sample_lengths(target_cdf, len(active), rng)
+
+    return overhead
+
+"""
+Public function.
+Simulate morphing 'packets' packets of the 'source' distribution into
+the 'target' distribution, both with direct sampling and with the
+dream.MorphingMatrix 'mm'. 'source' and 'target' are NumPy arrays as
+returned by distr.get_distr_from_file(). 'rng' is a NumPy RandomState
+(a fresh one by default).
+
+Return a (sampling, morphing) pair of NumPy arrays with the cumulative
+overhead in bytes after each packet.
+"""
+def simulate(source, target, mm, packets, split_penalty=SPLIT_PENALTY,
+             rng=None):
+    if (rng is None):
+        rng = numpy.random.RandomState()
+
+    source_cdf = get_cdf(source)
+    target_cdf = get_cdf(target)
+
+    sampling = numpy.empty(packets, dtype=numpy.int64)
+    morphing = numpy.empty(packets, dtype=numpy.int64)
+
+    for start in xrange(0, packets, CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, packets)
+        lengths = sample_lengths(source_cdf, end - start, rng)
+
+        first = sample_lengths(target_cdf, end - start, rng)
+        sampling[start:end] = get_overheads(lengths, first, target_cdf,
+                                            split_penalty, rng)
+
+        first = mm.get_target_lengths(lengths, rng.random_sample(end - start))
+        morphing[start:end] = get_overheads(lengths, first, target_cdf,
+                                            split_penalty, rng)
+
+    return (numpy.cumsum(sampling), numpy.cumsum(morphing))
+
+"""Spit usage instructions and exit"""
+def usage():
+    print """Usage:
+    \tsimulate options [arguments]
+    where 'options' are:
+       --source=<source distribution filename>
+       --target=<target distribution filename>
+       --matrix=<morphing matrix filename (Matrix Market or binary)>
+       --packets=<number of packets to morph (default: 1000000)>
+       --split-penalty=<bytes of overhead per split (default: %d)>
+       --seed=<random seed>
+    """ % (SPLIT_PENALTY)
+    sys.exit()
+
+"""Entry point"""
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "", ["source=", "target=", "matrix=",
+                                              "packets=", "split-penalty=",
+                                              "seed="])
+    except getopt.GetoptError:
+        usage()
+
+    source = None
+    target = None
+    matrix = None
+    packets = 1000000
+    split_penalty = SPLIT_PENALTY
+    seed = None
+
+    for opt, arg in opts:
+        if opt == "--source":
+            source = arg
+        elif opt == "--target":
+            target = arg
+        elif opt == "--matrix":
+            matrix = arg
+        elif opt == "--packets":
+            packets = int(arg) if arg.isdigit() else 0
+        elif opt == "--split-penalty":
+            split_penalty = int(arg) if arg.isdigit() else -1
+        elif opt == "--seed":
+            seed = int(arg) if arg.isdigit() else None
+
+    for fname in (source, target, matrix):
+        if ((not fname) or (not os.path.isfile(fname))):
+            print "Please provide valid source, target and matrix filenames."
+            usage()
+    if ((packets <= 0) or (split_penalty < 0)):
+        print "Please provide a positive number of packets and " \
+            "a non-negative split penalty."
+        usage()
+
+    mm = dream.get_morphing_matrix_from_file(matrix)
+    start = time.time()
+    sampling, morphing = simulate(distr.get_distr_from_file(source),
+                                  distr.get_distr_from_file(target),
+                                  mm, packets, split_penalty,
+                                  numpy.random.RandomState(seed))
+
+    print "Morphed %d packets in %.2fs." % (packets, time.time() - start)
+    print "Sampling: %d bytes of overhead (%.2f per packet)" % \
+        (sampling[-1], sampling[-1] / float(packets))
+    print "Morphing: %d bytes of overhead (%.2f per packet)" % \
+        (morphing[-1], morphing[-1] / float(packets))
+
+if __name__ == "__main__":
+    if (sys.hexversion < 0x02070000):
+        print "You can only run this script with a Python version >= 2.7."
+        sys.exit(1)
+
+    main(sys.argv[1:])
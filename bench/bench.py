@@ -0,0 +1,385 @@
+#!/usr/bin/python2.7
+
+"""
+Benchmark of the hot paths of morpher, with correctness checks.
+
+$ bench/bench.py [options]
+
+For every matrix size and solver it times:
+
+  * generating the morphing matrix (morpheus.py's MorphingMatrixLP),
+    and checks its objective against the exact optimum of the 'ot1d'
+    solver;
+  * loading it with dream.py from a Matrix Market and from a binary
+    file;
+  * sampling target lengths with dream.py, one at a time
+    (get_target_length()) and in one batch (get_target_lengths()), and
+    with dream.c's dream_get_target_length() and
+    dream_get_target_lengths() through a ctypes shim (see cdream.py).
+    dream.c must give the same target lengths as dream.py for the same
+    random numbers, with floating point and with fixed-point (32-bit
+    integer) random numbers;
+  * and runs a chi-square test of the morphed packet lengths against
+    the target distribution.
+
+The results are written as JSON, so that runs of different versions
+can be compared. Sizes up to the size of the distributions use their
+first packet lengths, renormalized; bigger sizes stretch their CDFs.
+LPs bigger than --max-lp-size are skipped, as are unavailable solvers.
+
+where 'options' are:
+   --source=<source distribution (default: data/tor_cs_distr.txt)>
+   --target=<target distribution (default: data/https_cs_distr.txt)>
+   --sizes=<comma separated matrix sizes (default: 100,500,1460,9000)>
+   --solvers=<comma separated solvers (default: ot1d,linprog,glpsol)>
+   --max-lp-size=<biggest size to solve an LP for (default: 1460)>
+   --samples=<number of packets to sample (default: 200000)>
+   --repeat=<times to repeat each timing; the best is kept (default: 3)>
+   --seed=<random seed (default: 0)>
+   --no-c (don't benchmark dream.c)
+   --output=<JSON output file (default: stdout)>
+"""
+
+import sys
+import os
+import getopt
+import json
+import time
+import math
+import platform
+import tempfile
+import shutil
+from distutils.spawn import find_executable
+import numpy
+import scipy
+import scipy.io
+import scipy.stats
+
+TOPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(TOPDIR)
+import morpheus
+import dream
+import distr
+
+import cdream
+
+# Bump when the meaning of a field of the JSON output changes.
+SCHEMA_VERSION = 1
+
+DEFAULT_SOURCE = os.path.join(TOPDIR, "data", "tor_cs_distr.txt")
+DEFAULT_TARGET = os.path.join(TOPDIR, "data", "https_cs_distr.txt")
+DEFAULT_SIZES = (100, 500, 1460, 9000)
+DEFAULT_SOLVERS = (morpheus.SOLVER_OT1D, morpheus.SOLVER_LINPROG,
+                   morpheus.SOLVER_GLPSOL)
+DEFAULT_MAX_LP_SIZE = 1460
+DEFAULT_SAMPLES = 200000
+DEFAULT_REPEAT = 3
+
+# Chi-square test: bins expecting fewer packets than this are merged,
+# and the test fails below this p-value.
+CHI2_MIN_EXPECTED = 5
+CHI2_ALPHA = 1e-3
+
+# Solutions whose objective is within this relative distance from the
+# exact optimum are optimal.
+OBJECTIVE_TOLERANCE = 1e-6
+
+"""Print 'msg' to stderr, so that it doesn't mix with the JSON."""
+def log(msg):
+    sys.stderr.write(msg + "\n")
+
+"""
+Given a probability distribution 'distr', return it resized to 'size'
+packet lengths. A smaller distribution is its first 'size' packet
+lengths, renormalized; a bigger one has the CDF of 'distr' stretched
+over 'size' packet lengths.
+"""
+def get_resized_distr(distr, size):
+    distr = numpy.asarray(distr, dtype=numpy.double)
+    if (size <= len(distr)):
+        resized = distr[:size]
+    else:
+        cdf = numpy.concatenate(([0.0], numpy.cumsum(distr)))
+        points = numpy.arange(size + 1) * (len(distr) / float(size))
+        resized = numpy.diff(numpy.interp(points, numpy.arange(len(distr) + 1),
+                                          cdf))
+    return resized / math.fsum(resized)
+
+"""Call 'func' 'repeat' times and return (best time in seconds, the
+value it returned last)."""
+def best_of(func, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        value = func()
+        spent = time.time() - start
+        if ((best is None) or (spent < best)):
+            best = spent
+    return (best, value)
+
+"""Return 'samples' packet lengths drawn from distribution 'distr'
+with 'rng'."""
+def sample_lengths(distr, samples, rng):
+    cdf = numpy.cumsum(distr)
+    k = numpy.searchsorted(cdf, rng.random_sample(samples) * cdf[-1],
+                           side='right')
+    return numpy.minimum(k, len(distr) - 1) + 1
+
+"""
+Given the (one-based) packet 'lengths' of morphed packets, return a
+dict with the chi-square test of them against the 'target'
+distribution: the 'statistic', its degrees of freedom ('dof'), its
+'p_value' and whether it 'passed'.
+"""
+def get_chi_square(lengths, target):
+    observed = numpy.bincount(lengths - 1, minlength=len(target))
+    expected = target * len(lengths)
+
+    big = expected >= CHI2_MIN_EXPECTED
+    observed = numpy.append(observed[big], observed[~big].sum())
+    expected = numpy.append(expected[big], expected[~big].sum())
+    if (expected[-1] <= 0): # nothing to merge
+        observed, expected = observed[:-1], expected[:-1]
+
+    statistic = math.fsum((observed - expected) ** 2 / expected)
+    dof = len(expected) - 1
+    p_value = float(scipy.stats.chi2.sf(statistic, dof))
+
+    return {"statistic": statistic, "dof": dof, "p_value": p_value,
+            "passed": p_value >= CHI2_ALPHA}
+
+"""
+Solve the morphing matrix between 'source' and 'target' with 'solver'.
+Return (matrix, results), where 'results' is a dict with the time it
+took and its correctness checks against the exact 'optimum' objective.
+"""
+def bench_solver(solver, source, target, optimum):
+    lp = morpheus.MorphingMatrixLP(source, target, solver)
+    start = time.time()
+    matrix = lp.harvest()
+    spent = time.time() - start
+
+    objective = lp.stats["objective"]
+    gap = (objective - optimum) / optimum if (optimum) else 0.0
+    return (matrix, {"time": spent, "nnz": int(matrix.nnz),
+                     "iterations": lp.stats["iterations"] and
+                                   int(lp.stats["iterations"]),
+                     "objective": objective, "optimum": optimum,
+                     "relative_gap": gap,
+                     "optimal": abs(gap) <= OBJECTIVE_TOLERANCE,
+                     "column_residual": float(lp.stats["column_residual"]),
+                     "target_residual": float(lp.stats["target_residual"])})
+
+"""
+Write 'matrix' in Matrix Market and binary format to 'workdir' and time
+loading each with dream.py. Return (binary filename, results).
+"""
+def bench_loading(matrix, workdir, repeat):
+    mm_fname = os.path.join(workdir, "mm.mtx")
+    binary_fname = os.path.join(workdir, "mm.bin")
+    scipy.io.mmwrite(mm_fname, matrix, comment="Morphing Matrix",
+                     field="real")
+    dream.write_binary(matrix, binary_fname)
+
+    mm_time = best_of(lambda: dream.get_morphing_matrix_from_file(mm_fname),
+                      repeat)[0]
+    binary_time = best_of(
+        lambda: dream.get_morphing_matrix_from_file(binary_fname), repeat)[0]
+
+    return (binary_fname,
+            {"mm_time": mm_time, "binary_time": binary_time,
+             "mm_bytes": os.path.getsize(mm_fname),
+             "binary_bytes": os.path.getsize(binary_fname)})
+
+"""
+Time sampling the target lengths of 'lengths' with the random numbers
+'rands' from the binary morphing matrix file 'fname', with dream.py
+and, if 'lib' is given, with dream.c. Return (the target lengths of
+dream.py's batch sampling, results).
+"""
+def bench_sampling(fname, lengths, rands, lib, repeat):
+    mm = dream.get_morphing_matrix_from_file(fname)
+    pairs = zip(lengths.tolist(), rands.tolist())
+    # The same random numbers, as 32-bit integers.
+    rs = numpy.minimum(rands * dream.FIXED_POINT_ONE,
+                       dream.FIXED_POINT_ONE - 1).astype(numpy.uint32)
+
+    single_time, single = best_of(
+        lambda: [mm.get_target_length(l, r) for (l, r) in pairs], repeat)
+    batch_time, batch = best_of(
+        lambda: mm.get_target_lengths(lengths, rands), repeat)
+    fixed_time, fixed = best_of(
+        lambda: mm.get_target_lengths_fixed(lengths, rs), repeat)
+
+    results = {"python_single_rate": len(pairs) / single_time,
+               "python_batch_rate": len(pairs) / batch_time,
+               "python_fixed_batch_rate": len(pairs) / fixed_time,
+               "python_mismatches": int(numpy.sum(numpy.array(single) !=
+                                                  batch))}
+
+    if (lib is not None):
+        csc = cdream.CDream(lib, fname)
+        try:
+            c_time, c_single = best_of(
+                lambda: [csc.get_target_length(l, r) for (l, r) in pairs],
+                repeat)
+            c_batch_time, c_batch = best_of(
+                lambda: csc.get_target_lengths(lengths, rands), repeat)
+            c_fixed_time, c_fixed = best_of(
+                lambda: csc.get_target_lengths_fixed(lengths, rs), repeat)
+        finally:
+            csc.close()
+        results["c_single_rate"] = len(pairs) / c_time
+        results["c_batch_rate"] = len(pairs) / c_batch_time
+        results["c_fixed_batch_rate"] = len(pairs) / c_fixed_time
+        # Both sample from the CDFs and thresholds of the binary file,
+        # with the same floating point operations.
+        results["c_mismatches"] = int(numpy.sum(numpy.array(c_single) !=
+                                                batch) +
+                                      numpy.sum(c_batch != batch) +
+                                      numpy.sum(c_fixed != fixed))
+        results["c_agrees"] = results["c_mismatches"] == 0
+
+    return (batch, results)
+
+"""Return a dict describing the machine and software of the run."""
+def get_environment():
+    return {"python": platform.python_version(),
+            "numpy": numpy.__version__, "scipy": scipy.__version__,
+            "platform": platform.platform(),
+            "machine": platform.machine(), "processor": platform.processor(),
+            "glpsol": find_executable("glpsol") is not None}
+
+"""Run the benchmark of 'config' (see main()) and return its results
+as a list of dicts, one per (size, solver)."""
+def run(config, lib):
+    source = distr.get_distr_from_file(config["source"])
+    target = distr.get_distr_from_file(config["target"])
+    rng = numpy.random.RandomState(config["seed"])
+    workdir = tempfile.mkdtemp(prefix="morpher-bench-")
+
+    results = []
+    try:
+        for size in config["sizes"]:
+            s = get_resized_distr(source, size)
+            t = get_resized_distr(target, size)
+            optimum = morpheus.get_objective(
+                morpheus.get_monotone_coupling(s, t), s)
+            lengths = sample_lengths(s, config["samples"], rng)
+            rands = rng.random_sample(config["samples"])
+
+            for solver in config["solvers"]:
+                result = {"size": size, "solver": solver}
+                results.append(result)
+
+                if ((solver != morpheus.SOLVER_OT1D) and
+                    (size > config["max_lp_size"])):
+                    result["skipped"] = "LP bigger than --max-lp-size"
+                    continue
+                if ((solver == morpheus.SOLVER_GLPSOL) and
+                    (not find_executable("glpsol"))):
+                    result["skipped"] = "glpsol not found"
+                    continue
+
+                log("size %d, solver %s: solving..." % (size, solver))
+                matrix, result["solve"] = bench_solver(solver, s, t, optimum)
+                log("size %d, solver %s: loading..." % (size, solver))
+                fname, result["load"] = bench_loading(matrix, workdir,
+                                                      config["repeat"])
+                log("size %d, solver %s: sampling..." % (size, solver))
+                morphed, result["sample"] = bench_sampling(
+                    fname, lengths, rands, lib, config["repeat"])
+                result["chi_square"] = get_chi_square(morphed, t)
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+"""Spit usage instructions and exit"""
+def usage():
+    print __doc__
+    sys.exit(1)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "", ["source=", "target=", "sizes=",
+                                              "solvers=", "max-lp-size=",
+                                              "samples=", "repeat=", "seed=",
+                                              "no-c", "output="])
+    except getopt.GetoptError:
+        usage()
+
+    config = {"source": DEFAULT_SOURCE, "target": DEFAULT_TARGET,
+              "sizes": list(DEFAULT_SIZES), "solvers": list(DEFAULT_SOLVERS),
+              "max_lp_size": DEFAULT_MAX_LP_SIZE,
+              "samples": DEFAULT_SAMPLES, "repeat": DEFAULT_REPEAT,
+              "seed": 0, "c": True}
+    output = None
+
+    try:
+        for opt, arg in opts:
+            if opt in ("--source", "--target"):
+                config[opt[2:]] = arg
+            elif opt == "--sizes":
+                config["sizes"] = [int(size) for size in arg.split(",")]
+            elif opt == "--solvers":
+                config["solvers"] = arg.split(",")
+            elif opt == "--max-lp-size":
+                config["max_lp_size"] = int(arg)
+            elif opt == "--samples":
+                config["samples"] = int(arg)
+            elif opt == "--repeat":
+                config["repeat"] = int(arg)
+            elif opt == "--seed":
+                config["seed"] = int(arg)
+            elif opt == "--no-c":
+                config["c"] = False
+            elif opt == "--output":
+                output = arg
+    except ValueError:
+        print "Please provide integer sizes, samples, repeats and seeds."
+        usage()
+
+    if ((not os.path.isfile(config["source"])) or
+        (not os.path.isfile(config["target"]))):
+        print "Please provide valid filenames for the distributions."
+        usage()
+    if ((min(config["sizes"]) <= 0) or (config["samples"] <= 0) or
+        (config["repeat"] <= 0)):
+        print "Please provide positive sizes, samples and repeats."
+        usage()
+    for solver in config["solvers"]:
+        if (solver not in morpheus.SOLVERS):
+            print "Please provide valid solvers (%s)." % \
+                (", ".join(morpheus.SOLVERS))
+            usage()
+
+    lib = cdream.build_library() if (config["c"]) else None
+    try:
+        results = run(config, lib)
+    finally:
+        if (lib is not None):
+            cdream.remove_library(lib)
+
+    report = {"schema": SCHEMA_VERSION, "time": time.time(),
+              "environment": get_environment(), "config": config,
+              "results": results}
+    if (output):
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+
+    failed = [r for r in results if (("solve" in r) and
+                                     ((not r["solve"]["optimal"]) or
+                                      (not r["chi_square"]["passed"]) or
+                                      (not r["sample"].get("c_agrees", True))))]
+    for r in failed:
+        log("size %d, solver %s: correctness checks FAILED" %
+            (r["size"], r["solver"]))
+    if (failed):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
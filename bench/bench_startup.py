@@ -0,0 +1,140 @@
+#!/usr/bin/python2.7
+
+"""
+Benchmark of how long a fresh process takes to start sampling from a
+morphing matrix with dream.py.
+
+$ bench/bench_startup.py [options] [morphing matrix files]
+
+For every morphing matrix file (Matrix Market or binary), it starts
+fresh Python processes that import dream.py and load the matrix with
+get_morphing_matrix_from_file(), with dream.PARANOIA on and off, and
+reports how long the import, the load and the whole process took. If
+no files are given, it generates the morphing matrices of the 'ot1d'
+solver between the default distributions of bench.py, resized to
+1460 and 9000 packet lengths, in both formats.
+
+The results are written as JSON, like bench.py's.
+
+where 'options' are:
+   --repeat=<times to start each process; the best is kept (default: 5)>
+   --output=<JSON output file (default: stdout)>
+"""
+
+import sys
+import os
+import getopt
+import json
+import time
+import subprocess
+import tempfile
+import shutil
+
+import bench
+
+DREAM_DIR = os.path.join(bench.TOPDIR, "dreams", "python")
+DEFAULT_SIZES = (1460, 9000)
+DEFAULT_REPEAT = 5
+
+# What the fresh processes run. It prints how long importing dream.py
+# and loading the matrix took, as JSON.
+CHILD = """
+import sys, time, json
+start = time.time()
+sys.path.insert(0, %r)
+import dream
+imported = time.time()
+dream.PARANOIA = %r
+dream.get_morphing_matrix_from_file(%r)
+json.dump({"import_time": imported - start,
+           "load_time": time.time() - imported}, sys.stdout)
+"""
+
+"""Start a fresh process that loads morphing matrix 'fname' with
+'paranoia', and return the timings of CHILD and the time the whole
+process took."""
+def run_child(fname, paranoia):
+    start = time.time()
+    output = subprocess.check_output([sys.executable, "-c",
+                                      CHILD % (DREAM_DIR, paranoia, fname)])
+    timings = json.loads(output)
+    timings["process_time"] = time.time() - start
+    return timings
+
+"""Return the best timings of 'repeat' runs of run_child()."""
+def bench_file(fname, paranoia, repeat):
+    runs = [run_child(fname, paranoia) for i in xrange(repeat)]
+    return dict((key, min(run[key] for run in runs)) for key in runs[0])
+
+"""Write the 'ot1d' morphing matrices of bench.py's default
+distributions resized to 'sizes' to 'workdir', in both formats, and
+return their filenames."""
+def get_default_files(workdir, sizes):
+    import morpheus
+    import dream
+    import distr
+
+    source = distr.get_distr_from_file(bench.DEFAULT_SOURCE)
+    target = distr.get_distr_from_file(bench.DEFAULT_TARGET)
+
+    fnames = []
+    for size in sizes:
+        matrix = morpheus.get_monotone_coupling(
+            bench.get_resized_distr(source, size),
+            bench.get_resized_distr(target, size))
+        fname = os.path.join(workdir, "mm_%d" % (size))
+        morpheus.write_mm(fname, matrix)
+        dream.write_binary(matrix, fname + ".bin")
+        fnames.extend([morpheus.get_mm_filename(fname), fname + ".bin"])
+    return fnames
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "", ["repeat=", "output="])
+    except getopt.GetoptError:
+        print __doc__
+        sys.exit(1)
+
+    repeat = DEFAULT_REPEAT
+    output = None
+    for opt, arg in opts:
+        if opt == "--repeat":
+            repeat = int(arg) if arg.isdigit() else 0
+        elif opt == "--output":
+            output = arg
+
+    if (repeat <= 0):
+        print "Please provide a positive number of repeats."
+        sys.exit(1)
+    for fname in args:
+        if (not os.path.isfile(fname)):
+            print "Please provide valid morphing matrix filenames."
+            sys.exit(1)
+
+    workdir = tempfile.mkdtemp(prefix="morpher-bench-")
+    try:
+        fnames = args or get_default_files(workdir, DEFAULT_SIZES)
+        results = []
+        for fname in fnames:
+            for paranoia in (True, False):
+                bench.log("%s, PARANOIA %s..." % (fname, paranoia))
+                result = {"file": os.path.basename(fname),
+                          "bytes": os.path.getsize(fname),
+                          "paranoia": paranoia}
+                result.update(bench_file(fname, paranoia, repeat))
+                results.append(result)
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {"schema": bench.SCHEMA_VERSION, "time": time.time(),
+              "environment": bench.get_environment(),
+              "config": {"repeat": repeat}, "results": results}
+    if (output):
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,150 @@
+import os
+import subprocess
+import tempfile
+import shutil
+import ctypes
+import numpy
+
+"""
+A ctypes shim to dreams/c/dream.c, for benchmarking and cross-checking
+it against dream.py.
+
+    lib = build_library()
+    csc = CDream(lib, "mm.bin")
+    csc.get_target_length(85, 0.3)
+    csc.close()
+
+build_library() compiles dream.c and mmio.c into a shared library
+with gcc(1). Only binary morphing matrix files (morpheus.py --binary)
+can be loaded, since dream_set_csc_from_mm() is disabled in dream.c.
+"""
+
+C_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     "..", "dreams", "c")
+SOURCES = ("dream.c", "mmio.c")
+CFLAGS = ("-O2", "-shared", "-fPIC", "-pthread")
+LIBS = ("-lm",)
+
+# enum mm_ret of dream.h
+DREAM_MM_OKAY = 0
+
+"""csc_t of dream.h"""
+class csc_t(ctypes.Structure):
+    _fields_ = [("size", ctypes.c_int),
+                ("entries_n", ctypes.c_int),
+                ("values", ctypes.POINTER(ctypes.c_double)),
+                ("row_inds", ctypes.POINTER(ctypes.c_int)),
+                ("col_ptrs", ctypes.POINTER(ctypes.c_int)),
+                ("cdf", ctypes.POINTER(ctypes.c_double)),
+                ("thresholds", ctypes.POINTER(ctypes.c_uint64)),
+                ("map", ctypes.c_void_p),
+                ("map_len", ctypes.c_size_t),
+                ("refs", ctypes.c_int)]
+
+"""
+Compile dream.c into a shared library in 'directory' (a fresh
+temporary directory if None) and return it as a ctypes.CDLL with the
+argument and return types of its functions set. Raise
+subprocess.CalledProcessError if gcc fails.
+"""
+def build_library(directory=None, cc="gcc"):
+    if (directory is None):
+        directory = tempfile.mkdtemp(prefix="cdream-")
+    fname = os.path.join(directory, "libdream.so")
+    subprocess.check_call([cc] + list(CFLAGS) + ["-o", fname] +
+                          [os.path.join(C_DIR, src) for src in SOURCES] +
+                          list(LIBS))
+
+    lib = ctypes.CDLL(fname)
+    lib.dream_set_csc_from_binary.argtypes = \
+        [ctypes.POINTER(ctypes.POINTER(csc_t)), ctypes.c_char_p]
+    lib.dream_set_csc_from_binary.restype = ctypes.c_int
+    lib.dream_get_target_length.argtypes = \
+        [ctypes.POINTER(csc_t), ctypes.c_int, ctypes.c_double]
+    lib.dream_get_target_length.restype = ctypes.c_int
+    lib.dream_get_target_lengths.argtypes = \
+        [ctypes.POINTER(csc_t), ctypes.POINTER(ctypes.c_int),
+         ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_int),
+         ctypes.c_size_t]
+    lib.dream_get_target_lengths.restype = ctypes.c_int
+    lib.dream_get_target_lengths_fixed.argtypes = \
+        [ctypes.POINTER(csc_t), ctypes.POINTER(ctypes.c_int),
+         ctypes.POINTER(ctypes.c_uint32), ctypes.POINTER(ctypes.c_int),
+         ctypes.c_size_t]
+    lib.dream_get_target_lengths_fixed.restype = ctypes.c_int
+    lib.csc_free.argtypes = [ctypes.POINTER(csc_t)]
+    lib.csc_free.restype = None
+
+    return lib
+
+"""Remove the directory of a library returned by build_library()."""
+def remove_library(lib):
+    shutil.rmtree(os.path.dirname(lib._name), ignore_errors=True)
+
+"""
+A morphing matrix loaded by dream.c.
+
+'lib' is a library returned by build_library() and 'fname' a binary
+morphing matrix file.
+'self.size' is the number of rows/columns of the matrix.
+"""
+class CDream:
+    def __init__(self, lib, fname):
+        self.lib = lib
+        self.csc = ctypes.POINTER(csc_t)()
+        ret = lib.dream_set_csc_from_binary(ctypes.byref(self.csc), fname)
+        if (ret != DREAM_MM_OKAY):
+            raise ValueError("dream.c can't load '%s' (mm_ret %d)." %
+                             (fname, ret))
+        self.size = self.csc.contents.size
+
+    """Public function.
+    Like dream.MorphingMatrix.get_target_length(), through
+    dream_get_target_length()."""
+    def get_target_length(self, s_len, rand):
+        t_len = self.lib.dream_get_target_length(self.csc, s_len, rand)
+        if (t_len < 0):
+            raise ValueError("dream_get_target_length(%d, %s) failed." %
+                             (s_len, rand))
+        return t_len
+
+    """Public function.
+    Like dream.MorphingMatrix.get_target_lengths(), through
+    dream_get_target_lengths(). 'rands' must be given."""
+    def get_target_lengths(self, lengths, rands):
+        return self.__get_target_lengths(self.lib.dream_get_target_lengths,
+                                         lengths, rands, ctypes.c_double)
+
+    """Public function.
+    Like dream.MorphingMatrix.get_target_lengths_fixed(), through
+    dream_get_target_lengths_fixed(). 'rs' must be given."""
+    def get_target_lengths_fixed(self, lengths, rs):
+        return self.__get_target_lengths(
+            self.lib.dream_get_target_lengths_fixed, lengths, rs,
+            ctypes.c_uint32)
+
+    """Call the batch sampling function 'func' of dream.c with the
+    source 'lengths' and the random numbers 'rands' of ctypes type
+    'ctype', and return the target lengths."""
+    def __get_target_lengths(self, func, lengths, rands, ctype):
+        lengths = numpy.ascontiguousarray(lengths, dtype=numpy.intc)
+        rands = numpy.ascontiguousarray(rands, dtype=ctype)
+        if (rands.shape != lengths.shape):
+            raise ValueError("Random numbers and 'lengths' have different " \
+                             "shapes (%s:%s)." % (rands.shape, lengths.shape))
+        out = numpy.empty(lengths.shape, dtype=numpy.intc)
+
+        ret = func(self.csc, lengths.ctypes.data_as(ctypes.POINTER(ctypes.c_int)),
+                   rands.ctypes.data_as(ctypes.POINTER(ctype)),
+                   out.ctypes.data_as(ctypes.POINTER(ctypes.c_int)),
+                   lengths.size)
+        if (ret < 0):
+            raise ValueError("%s() failed." % (func.__name__))
+        return out
+
+    """Public function.
+    Free the matrix."""
+    def close(self):
+        if (self.csc):
+            self.lib.csc_free(self.csc)
+            self.csc = ctypes.POINTER(csc_t)()
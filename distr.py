@@ -0,0 +1,221 @@
+#!/usr/bin/python2.7
+
+"""
+Packet length probability distributions.
+
+This module loads the probability distribution files of morpheus.py
+(see the FAQ for their format) into NumPy arrays, and builds
+distributions from raw packet length captures. Run it as a script to
+turn a packet length log into a probability distribution file:
+
+$ tshark -r trace.pcap -T fields -e tcp.len 'tcp.len > 0' > lengths.txt
+$ distr.py --lengths=lengths.txt --output=my_cs_distr.txt
+"""
+
+import sys
+import os
+import math
+import getopt
+import itertools
+from fractions import Fraction
+import numpy
+
+# 1500b ethernet MTU - 20b min. ip headers - 20b min. tcp headers
+MAX_TCP_PAYLOAD_SIZE = 1460
+
+# How far from 1 the probabilities of a distribution file may sum up to.
+DEFAULT_TOLERANCE = 1e-6
+
+# How many packet lengths to histogram at a time.
+CHUNK_SIZE = 1 << 16
+
+"""Given a non-comment 'line' of a distribution file, which should be
+the 'n'th one, return its probability as a string."""
+def parse_line(line, n):
+    subline = line.split()
+    if ((len(subline) != 2) or (subline[0] != "%d:" % (n))):
+        raise ValueError("Wrong file format (line '%s', expected length %d)" %
+                         (line.rstrip(), n))
+    return subline[1]
+
+"""Given a distribution file 'filename', yield the probability of each
+packet length as a string, in order."""
+def iter_distr_file(filename):
+    n = 1
+    with open(filename) as file:
+        for line in file:
+            if ((not line.strip()) or line.startswith("#")): # comment
+                continue
+            yield parse_line(line, n)
+            n += 1
+
+"""Given a file of the format '<packet length: probability>\\n':
+
+# comment
+1: 0.024...
+2: 0.005...
+3: 0.156...
+...
+
+return a NumPy array representing its probability distribution; its
+element 'i' is the probability of packets of length 'i+1'.
+
+The probabilities must be non-negative and must sum up to 1 within
+'tolerance'; the returned distribution is normalized to sum up to 1.
+If 'paranoid' is True, the sum is computed exactly with rationals
+(see get_exact_distr_from_file()) instead of with floats.
+
+Raise ValueError if the file is not a valid distribution.
+"""
+def get_distr_from_file(filename, tolerance=DEFAULT_TOLERANCE,
+                        paranoid=False):
+    try:
+        distr = numpy.fromiter(itertools.imap(float, iter_distr_file(filename)),
+                               dtype=numpy.double)
+    except ValueError, e:
+        raise ValueError("%s: %s" % (filename, e))
+
+    if (paranoid):
+        total = sum(get_exact_distr_from_file(filename))
+    else:
+        total = math.fsum(distr)
+
+    check_distr(distr, total, tolerance, filename)
+
+    return distr / math.fsum(distr)
+
+"""Like get_distr_from_file(), but return the probabilities exactly,
+as a list of Fractions, without normalizing them."""
+def get_exact_distr_from_file(filename):
+    try:
+        return map(Fraction, iter_distr_file(filename))
+    except ValueError, e:
+        raise ValueError("%s: %s" % (filename, e))
+
+"""Raise ValueError if 'distr', whose elements sum up to 'total', is
+not a probability distribution within 'tolerance'. 'name' is used in
+error messages."""
+def check_distr(distr, total, tolerance, name):
+    if (len(distr) == 0):
+        raise ValueError("%s: 0 size distribution" % (name))
+    if (not numpy.all(numpy.isfinite(distr) & (distr >= 0))):
+        raise ValueError("%s: negative or invalid probabilities" % (name))
+    if (abs(total - 1) > tolerance):
+        raise ValueError("%s: probabilities sum up to %s, not 1" %
+                         (name, float(total)))
+
+"""
+Given an iterable 'lengths' of packet lengths (e.g. a packet capture
+of a protocol), return their probability distribution over lengths
+[1, size] as a NumPy array, like get_distr_from_file() does.
+
+The lengths are histogrammed in chunks as they stream by, so the
+capture is never held in memory. Lengths of 0 (packets without
+payload) are ignored; other lengths outside [1, size] raise
+ValueError.
+"""
+def get_distr_from_lengths(lengths, size=MAX_TCP_PAYLOAD_SIZE):
+    counts = numpy.zeros(size+1, dtype=numpy.int64)
+    lengths = iter(lengths)
+
+    while (True):
+        chunk = numpy.fromiter(itertools.islice(lengths, CHUNK_SIZE),
+                               dtype=numpy.int64)
+        if (len(chunk) == 0):
+            break
+        if ((chunk.min() < 0) or (chunk.max() > size)):
+            raise ValueError("Packet lengths must be in [0, %d] (got %d..%d)" %
+                             (size, chunk.min(), chunk.max()))
+        counts += numpy.bincount(chunk, minlength=size+1)
+
+    total = counts[1:].sum()
+    if (total == 0):
+        raise ValueError("No packets with payload")
+
+    return counts[1:] / float(total)
+
+"""
+Given a packet length log 'filename' (one packet length per line, as
+given by e.g. tshark -T fields -e tcp.len; lines starting with '#' are
+comments), return its probability distribution over lengths [1, size]
+as a NumPy array. The log is streamed, never held in memory. A
+'filename' of '-' is the standard input.
+"""
+def get_distr_from_length_log(filename, size=MAX_TCP_PAYLOAD_SIZE):
+    def iter_lengths(file):
+        for line in file:
+            line = line.strip()
+            if (line and (not line.startswith("#"))):
+                yield int(line)
+
+    if (filename == "-"):
+        return get_distr_from_lengths(iter_lengths(sys.stdin), size)
+    with open(filename) as file:
+        return get_distr_from_lengths(iter_lengths(file), size)
+
+"""Write the probability distribution 'distr' to file 'filename' in
+the format of get_distr_from_file(), with an optional 'comment'."""
+def write_distr_to_file(distr, filename, comment=None):
+    with open(filename, "w") as file:
+        if (comment):
+            for line in comment.split("\n"):
+                file.write("# %s\n" % (line))
+        for n, prob in enumerate(distr):
+            file.write("%d: %r\n" % (n+1, float(prob)))
+
+"""Spit usage instructions and exit"""
+def usage():
+    print """Usage:
+    \tdistr options [arguments]
+    where 'options' are:
+       --lengths=<packet length log filename, one length per line ('-' for stdin)>
+       --output=<probability distribution output filename>
+       --size=<largest packet length (default: %d)>
+    """ % (MAX_TCP_PAYLOAD_SIZE)
+    sys.exit()
+
+"""Entry point"""
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "", ["lengths=", "output=", "size="])
+    except getopt.GetoptError:
+        usage()
+
+    lengths = None
+    output = None
+    size = MAX_TCP_PAYLOAD_SIZE
+
+    for opt, arg in opts:
+        if opt == "--lengths":
+            lengths = arg
+        elif opt == "--output":
+            output = arg
+        elif opt == "--size":
+            size = int(arg) if arg.isdigit() else 0
+
+    if ((not lengths) or ((lengths != "-") and (not os.path.isfile(lengths)))):
+        print "Please provide a valid packet length log."
+        usage()
+    if ((not output) or (os.path.exists(output))):
+        print "Please provide a valid output filename."
+        usage()
+    if (size <= 0):
+        print "Please provide a positive size."
+        usage()
+
+    try:
+        distr = get_distr_from_length_log(lengths, size)
+    except ValueError, e:
+        print "%s: %s" % (lengths, e)
+        sys.exit(1)
+
+    write_distr_to_file(distr, output,
+                        "Packet length probability distribution of '%s'" %
+                        (os.path.basename(lengths)))
+
+if __name__ == "__main__":
+    if (sys.hexversion < 0x02070000):
+        print "You can only run this script with a Python version >= 2.7."
+        sys.exit(1)
+
+    main(sys.argv[1:])
@@ -0,0 +1,150 @@
+/* Benchmark of sampling target packet lengths from many threads that
+   share one morphing matrix, each with its own dream_rng_t.
+
+   $ gcc -O2 -pthread -o bench_threads bench_threads.c dream.c mmio.c -lm
+   $ ./bench_threads my_morphing_matrix.bin [max threads] [samples per thread] [sample every]
+
+   For every number of threads up to 'max threads', prints the total
+   and per-thread sampling throughput. With no shared mutable state,
+   the total throughput should scale linearly up to the number of
+   cores. If 'sample every' is given, each thread records statistics
+   of one in every 'sample every' calls in its own dream_stats_t,
+   to measure what that costs. */
+
+#include <stdlib.h>
+#include <stdio.h>
+#include <pthread.h>
+#include <time.h>
+
+#include "dream.h"
+
+typedef struct {
+  const csc_t *csc;
+  dream_rng_t rng;
+  long samples;
+  long sum; /* so that the sampling can't be optimized away */
+  dream_stats_t *stats; /* NULL if not recording statistics */
+} worker_t;
+
+static void *
+work(void *arg)
+{
+  worker_t *w = arg;
+  int size = w->csc->size;
+  long i;
+
+  for (i = 0 ; i < w->samples ; i++) {
+    int n = 1 + (int) (dream_rng_double(&w->rng) * size);
+    if (w->stats)
+      w->sum += dream_sample_target_length_stats(w->csc, &w->rng, n, w->stats);
+    else
+      w->sum += dream_sample_target_length(w->csc, &w->rng, n);
+  }
+
+  return NULL;
+}
+
+static double
+now(void)
+{
+  struct timespec ts;
+
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+int
+main(int argc, char **argv)
+{
+  csc_t *csc = NULL;
+  pthread_t *threads;
+  worker_t *workers;
+  int max_threads = 4;
+  long samples = 1000000;
+  long sample_every = 0;
+  dream_stats_t *stats = NULL;
+  int n, i;
+
+  if (argc < 2) {
+    fprintf(stderr, "Usage: %s <binary morphing matrix> "
+            "[max threads] [samples per thread] [sample every]\n", argv[0]);
+    return 1;
+  }
+  if (argc > 2)
+    max_threads = atoi(argv[2]);
+  if (argc > 3)
+    samples = atol(argv[3]);
+  if (argc > 4)
+    sample_every = atol(argv[4]);
+  if ((max_threads <= 0) || (samples <= 0) || (sample_every < 0)) {
+    fprintf(stderr, "Threads and samples must be positive.\n");
+    return 1;
+  }
+
+  if (dream_set_csc_from_binary(&csc, argv[1]) != DREAM_MM_OKAY) {
+    fprintf(stderr, "Could not load '%s'.\n", argv[1]);
+    return 1;
+  }
+
+  threads = calloc(max_threads, sizeof(pthread_t));
+  workers = calloc(max_threads, sizeof(worker_t));
+  if (!threads || !workers) {
+    fprintf(stderr, "Out of memory.\n");
+    return 1;
+  }
+  if (sample_every) {
+    stats = calloc(max_threads, sizeof(dream_stats_t));
+    for (i = 0 ; i < max_threads ; i++)
+      if (!stats || dream_stats_init(&stats[i], csc->size, sample_every)) {
+        fprintf(stderr, "Out of memory.\n");
+        return 1;
+      }
+  }
+
+  printf("threads\tMsamples/s\tper thread\n");
+  for (n = 1 ; n <= max_threads ; n++) {
+    double start, spent;
+
+    for (i = 0 ; i < n ; i++) {
+      workers[i].csc = csc;
+      workers[i].samples = samples;
+      workers[i].sum = 0;
+      workers[i].stats = stats ? &stats[i] : NULL;
+      dream_rng_seed(&workers[i].rng, i);
+    }
+
+    start = now();
+    for (i = 0 ; i < n ; i++)
+      if (pthread_create(&threads[i], NULL, work, &workers[i])) {
+        fprintf(stderr, "Could not create thread.\n");
+        return 1;
+      }
+    for (i = 0 ; i < n ; i++)
+      pthread_join(threads[i], NULL);
+    spent = now() - start;
+
+    printf("%d\t%.2f\t\t%.2f\n", n, n * samples / spent / 1e6,
+           samples / spent / 1e6);
+  }
+
+  if (stats) {
+    dream_stats_t total;
+
+    dream_stats_init(&total, csc->size, sample_every);
+    for (i = 0 ; i < max_threads ; i++) {
+      dream_stats_merge(&total, &stats[i]);
+      dream_stats_free(&stats[i]);
+    }
+    printf("recorded %lu of %lu calls, %.1f ns each on average\n",
+           (unsigned long) total.recorded, (unsigned long) total.calls,
+           total.recorded ? (double) total.latency_ns / total.recorded : 0);
+    dream_stats_free(&total);
+    free(stats);
+  }
+
+  free(threads);
+  free(workers);
+  csc_free(csc);
+
+  return 0;
+}
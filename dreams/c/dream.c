@@ -4,12 +4,26 @@
 #include <assert.h>
 #include <string.h>
 #include <limits.h>
+#include <math.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <time.h>
 
 #include "mmio.h"
 #include "dream.h"
 
-/** DISABLED TILL THE INTEGER OVERFLOWS ARE FIXED. */
-#if 0
+/** Return whether 'p' points into the mapped binary file of 'csc'. */
+static int
+is_mapped(const csc_t *csc, const void *p)
+{
+  const unsigned char *map = csc->map;
+
+  return map && ((const unsigned char *)p >= map) &&
+    ((const unsigned char *)p < map + csc->map_len);
+}
+
 /** Free space allocated by matrix 'csc'. */
 void
 csc_free(csc_t *csc)
@@ -17,52 +31,157 @@ csc_free(csc_t *csc)
   if (!csc)
     return;
 
+  /* dream_prepare() may have added thresholds to a version 1 file. */
+  if (csc->thresholds && !is_mapped(csc, csc->thresholds))
+    free(csc->thresholds);
+
+  if (csc->map) { /* arrays point into a mapped binary file */
+    munmap(csc->map, csc->map_len);
+    free(csc);
+    return;
+  }
+
   if (csc->values)
     free(csc->values);
   if (csc->row_inds)
     free(csc->row_inds);
   if (csc->col_ptrs)
     free(csc->col_ptrs);
+  if (csc->cdf)
+    free(csc->cdf);
 
   free(csc);
 }
 
-/** Create square CSC matrix of 'cols_n' columns and of 'nz_entries'
-    non-zero entries in 'csc_out'. */
-static int
-csc_create(csc_t **csc_out, int cols_n, int nz_entries)
+/** Given a morphing matrix 'csc' without per-column CDFs or
+    fixed-point thresholds, compute them, laid out like 'values', as
+    in binary morphing matrix files: each column's CDF is normalized
+    to end at exactly 1 and shifted by the zero-based column number,
+    and its thresholds are its normalized running sums times
+    DREAM_FIXED_POINT_ONE, rounded, ending at exactly
+    DREAM_FIXED_POINT_ONE. */
+int
+dream_prepare(csc_t *csc)
 {
-  assert((cols_n > 0) && (nz_entries > 0));
-
-  if (cols_n == INT_MAX) /* don't overflow cols_n. */
+  double *cdf = csc->cdf;
+  uint64_t *thresholds = csc->thresholds;
+  int j, i;
+
+  if (!cdf)
+    cdf = malloc(csc->entries_n * sizeof(double));
+  if (!thresholds)
+    thresholds = malloc(csc->entries_n * sizeof(uint64_t));
+  if (!cdf || !thresholds) {
+    if (cdf != csc->cdf)
+      free(cdf);
+    if (thresholds != csc->thresholds)
+      free(thresholds);
     return -1;
+  }
 
-  *csc_out = calloc(1, sizeof(csc_t));
-  if (!csc_out)
-    return -1;
+  for (j = 0 ; j < csc->size ; j++) {
+    int lo = csc->col_ptrs[j];
+    int hi = csc->col_ptrs[j+1];
+    double sum = 0.0, running = 0.0;
+
+    for (i = lo ; i < hi ; i++)
+      sum += csc->values[i];
+    if (sum <= 0.0)
+      sum = 1.0;
+
+    /* The same floating point operations as dream.py's get_cdf() and
+       get_thresholds(). A mapped CDF is never written to. */
+    for (i = lo ; i < hi ; i++) {
+      running += csc->values[i];
+      if (cdf != csc->cdf)
+        cdf[i] = running / sum + j;
+      if (thresholds != csc->thresholds)
+        thresholds[i] = (uint64_t)floor(running / sum *
+                                        (double)DREAM_FIXED_POINT_ONE + 0.5);
+    }
+    if ((hi > lo) && (thresholds != csc->thresholds))
+      thresholds[hi-1] = DREAM_FIXED_POINT_ONE;
+  }
 
-  (*csc_out)->values = malloc(nz_entries * sizeof(double));
-  (*csc_out)->row_inds = malloc(nz_entries * sizeof(int));
-  (*csc_out)->col_ptrs = malloc((cols_n+1) * sizeof(int));
-  if ((!(*csc_out)->values) ||
-      (!(*csc_out)->row_inds) ||
-      (!(*csc_out)->col_ptrs)) {
-    csc_free(*csc_out);
+  csc->cdf = cdf;
+  csc->thresholds = thresholds;
+
+  return 0;
+}
+
+/** Initialize 'slot' with the morphing matrix 'csc', which it takes
+    over. Return 0 on success, or -1 on error. */
+int
+dream_slot_init(dream_slot_t *slot, csc_t *csc)
+{
+  if (pthread_mutex_init(&slot->lock, NULL))
     return -1;
-  }
 
-  (*csc_out)->size = cols_n;
-  (*csc_out)->entries_n = nz_entries;
+  csc->refs = 1; /* the reference of the slot */
+  slot->csc = csc;
 
   return 0;
 }
 
+/** Return a reference to the current morphing matrix of 'slot'. Drop
+    it with dream_csc_release() when done sampling from it. */
+csc_t *
+dream_slot_acquire(dream_slot_t *slot)
+{
+  csc_t *csc;
+
+  /* Taking the reference under the lock makes sure that a concurrent
+     swap can't free the matrix in between. */
+  pthread_mutex_lock(&slot->lock);
+  csc = slot->csc;
+  __atomic_add_fetch(&csc->refs, 1, __ATOMIC_RELAXED);
+  pthread_mutex_unlock(&slot->lock);
+
+  return csc;
+}
+
+/** Drop a reference to 'csc' taken with dream_slot_acquire(), freeing
+    it if it was the last one. */
+void
+dream_csc_release(csc_t *csc)
+{
+  if (__atomic_sub_fetch(&csc->refs, 1, __ATOMIC_ACQ_REL) == 0)
+    csc_free(csc);
+}
+
+/** Make 'csc' the current morphing matrix of 'slot', which takes it
+    over. The old matrix is freed once no thread uses it anymore. */
+void
+dream_slot_swap(dream_slot_t *slot, csc_t *csc)
+{
+  csc_t *old;
+
+  csc->refs = 1; /* the reference of the slot */
+
+  pthread_mutex_lock(&slot->lock);
+  old = slot->csc;
+  slot->csc = csc;
+  pthread_mutex_unlock(&slot->lock);
+
+  dream_csc_release(old);
+}
+
+/** Drop the matrix of 'slot' (see dream_slot_swap()) and free the
+    resources of 'slot'. */
+void
+dream_slot_destroy(dream_slot_t *slot)
+{
+  dream_csc_release(slot->csc);
+  slot->csc = NULL;
+  pthread_mutex_destroy(&slot->lock);
+}
+
 /** Given a source packet length in 'n' and a random number \in [0,1]
     in 'rand', return the target packet length according to the
     morphing matrix in 'csc'.
     - 'b_n' is given in one-based numbering. */
 int
-dream_get_target_length(csc_t *csc, int b_n, double rand)
+dream_get_target_length(const csc_t *csc, int b_n, double rand)
 {
   double cdf = 0.0;
   int n = b_n - 1; /* zero based column number */
@@ -80,6 +199,28 @@ dream_get_target_length(csc_t *csc, int b_n, double rand)
   assert(col_size > 0);
   assert((csc->col_ptrs[n] + col_size) <= csc->entries_n);
 
+  if (csc->cdf) {
+    /* Binary search for the first entry whose CDF value passes
+       'n + rand'; the same double dream.py's bisect sampler uses. If
+       'rand' is 1, that's past the column, so use its last entry. */
+    const double key = n + rand;
+    int lo = csc->col_ptrs[n];
+    int hi = csc->col_ptrs[n+1];
+
+    while (lo < hi) {
+      int mid = lo + (hi - lo) / 2;
+
+      if (key < csc->cdf[mid])
+        hi = mid;
+      else
+        lo = mid + 1;
+    }
+    if (lo == csc->col_ptrs[n+1])
+      lo--;
+
+    return csc->row_inds[lo]+1;
+  }
+
   /* Iterate the probability column while synthesizing its Cumulative
      Distribution Function. We look for the row of the element that
      makes the CDF value pass 'rand'. */
@@ -93,12 +234,87 @@ dream_get_target_length(csc_t *csc, int b_n, double rand)
   return csc->row_inds[csc->col_ptrs[n]+i-1]+1;
 }
 
+/** Given 'n' source packet lengths in 'lens' and as many random
+    numbers \in [0,1] in 'rands', place their target packet lengths
+    according to the morphing matrix in 'csc' in 'out'.
+    Return 0 on success, or -1 if any of the source lengths or random
+    numbers was invalid; their target lengths are -1. */
+int
+dream_get_target_lengths(const csc_t *csc, const int *lens,
+                         const double *rands, int *out, size_t n)
+{
+  size_t i;
+  int ret = 0;
+
+  for (i = 0 ; i < n ; i++) {
+    out[i] = dream_get_target_length(csc, lens[i], rands[i]);
+    if (out[i] < 0)
+      ret = -1;
+  }
+
+  return ret;
+}
+
+/** Given a source packet length in 'n' and a random integer 'r' \in
+    [0, DREAM_FIXED_POINT_ONE), return the target packet length
+    according to the fixed-point thresholds of the morphing matrix in
+    'csc', or -1 if it has none.
+    - 'b_n' is given in one-based numbering. */
+int
+dream_get_target_length_fixed(const csc_t *csc, int b_n, uint32_t r)
+{
+  int n = b_n - 1; /* zero based column number */
+  int lo, hi;
+
+  if (!csc->thresholds)
+    return -1;
+  if ((n < 0) || (n >= csc->size))
+    return -1;
+
+  lo = csc->col_ptrs[n];
+  hi = csc->col_ptrs[n+1];
+  assert(hi > lo);
+
+  /* Binary search for the first entry whose threshold is greater
+     than 'r'. The last threshold of a column is
+     DREAM_FIXED_POINT_ONE, so there always is one. */
+  while (lo < hi) {
+    int mid = lo + (hi - lo) / 2;
+
+    if (r < csc->thresholds[mid])
+      hi = mid;
+    else
+      lo = mid + 1;
+  }
+  assert(lo < csc->col_ptrs[n+1]);
+
+  return csc->row_inds[lo]+1;
+}
+
+/** Like dream_get_target_lengths(), with random integers 'rs' for
+    dream_get_target_length_fixed(). */
+int
+dream_get_target_lengths_fixed(const csc_t *csc, const int *lens,
+                               const uint32_t *rs, int *out, size_t n)
+{
+  size_t i;
+  int ret = 0;
+
+  for (i = 0 ; i < n ; i++) {
+    out[i] = dream_get_target_length_fixed(csc, lens[i], rs[i]);
+    if (out[i] < 0)
+      ret = -1;
+  }
+
+  return ret;
+}
+
 /** Given a morphing matrix 'csc' and a source packet length 'n',
     print all possible mutations that can happen to 'n' along with
     their probabilities.
     - 'b_n' is given in one-based numbering. */
 void
-dream_print_potential(csc_t *csc, int b_n)
+dream_print_potential(const csc_t *csc, int b_n)
 {
   int n = b_n - 1; /* zero based column number */
   int i = 0;
@@ -121,6 +337,477 @@ dream_print_potential(csc_t *csc, int b_n)
 
 }
 
+/** Return the next output of the SplitMix64 generator of state 'x'. */
+static uint64_t
+splitmix64(uint64_t *x)
+{
+  uint64_t z = (*x += 0x9e3779b97f4a7c15ULL);
+
+  z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+  z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+  return z ^ (z >> 31);
+}
+
+/** Seed the random number generator 'rng' with 'seed'. */
+void
+dream_rng_seed(dream_rng_t *rng, uint64_t seed)
+{
+  int i;
+
+  /* SplitMix64 never gives an all-zero xoshiro state. */
+  for (i = 0 ; i < 4 ; i++)
+    rng->s[i] = splitmix64(&seed);
+}
+
+static inline uint64_t
+rotl(uint64_t x, int k)
+{
+  return (x << k) | (x >> (64 - k));
+}
+
+/** Return the next output of 'rng' (xoshiro256+). */
+static uint64_t
+rng_next(dream_rng_t *rng)
+{
+  uint64_t *s = rng->s;
+  uint64_t result = s[0] + s[3];
+  uint64_t t = s[1] << 17;
+
+  s[2] ^= s[0];
+  s[3] ^= s[1];
+  s[1] ^= s[2];
+  s[0] ^= s[3];
+  s[2] ^= t;
+  s[3] = rotl(s[3], 45);
+
+  return result;
+}
+
+/** Return the next random number \in [0,1) of 'rng'. */
+double
+dream_rng_double(dream_rng_t *rng)
+{
+  /* the top 53 bits make a double with all its mantissa random */
+  return (rng_next(rng) >> 11) * (1.0 / 9007199254740992.0);
+}
+
+/** Return the next random 32-bit integer of 'rng'. */
+uint32_t
+dream_rng_uint32(dream_rng_t *rng)
+{
+  /* the low bits of xoshiro256+ are its weakest */
+  return (uint32_t)(rng_next(rng) >> 32);
+}
+
+/** Given a source packet length in 'b_n', return the target packet
+    length according to the morphing matrix in 'csc', drawing the
+    random number from 'rng'.
+    - 'b_n' is given in one-based numbering. */
+int
+dream_sample_target_length(const csc_t *csc, dream_rng_t *rng, int b_n)
+{
+  if (csc->thresholds)
+    return dream_get_target_length_fixed(csc, b_n, dream_rng_uint32(rng));
+  return dream_get_target_length(csc, b_n, dream_rng_double(rng));
+}
+
+/** Initialize 'stats' for a morphing matrix of size 'size', to record
+    one in every 'sample_every' calls. Return 0 on success, or -1 on
+    error. */
+int
+dream_stats_init(dream_stats_t *stats, int size, uint32_t sample_every)
+{
+  if (size <= 0 || sample_every == 0)
+    return -1;
+
+  memset(stats, 0, sizeof(*stats));
+  stats->size = size;
+  stats->sample_every = sample_every;
+  stats->countdown = sample_every;
+
+  stats->hits = calloc(size, sizeof(uint64_t));
+  stats->targets = calloc(size, sizeof(uint64_t));
+  if (!stats->hits || !stats->targets) {
+    dream_stats_free(stats);
+    return -1;
+  }
+
+  return 0;
+}
+
+/** Free the resources of 'stats'. */
+void
+dream_stats_free(dream_stats_t *stats)
+{
+  free(stats->hits);
+  free(stats->targets);
+  stats->hits = stats->targets = NULL;
+}
+
+/** Add 'n' to 'counter' of a dream_stats_t. Only the thread owning
+    the statistics writes to them, so there's no need for an atomic
+    add, but the store is atomic so that dream_stats_merge() can read
+    them from other threads. */
+static inline void
+stat_add(uint64_t *counter, uint64_t n)
+{
+  __atomic_store_n(counter, *counter + n, __ATOMIC_RELAXED);
+}
+
+/** Read 'counter' of a dream_stats_t of any thread. */
+static inline uint64_t
+stat_get(const uint64_t *counter)
+{
+  return __atomic_load_n(counter, __ATOMIC_RELAXED);
+}
+
+/** Return the nanoseconds of the monotonic clock. */
+static uint64_t
+now_ns(void)
+{
+  struct timespec ts;
+
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (uint64_t) ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+/** Like dream_sample_target_length(), but record statistics of the
+    call in 'stats' if its turn has come.
+    - 'b_n' is given in one-based numbering. */
+int
+dream_sample_target_length_stats(const csc_t *csc, dream_rng_t *rng,
+                                 int b_n, dream_stats_t *stats)
+{
+  uint64_t start, ns;
+  int t_n, bucket;
+
+  /* Unrecorded calls only touch the countdown; 'calls' is counted a
+     batch at a time when a call is recorded. */
+  if (--stats->countdown)
+    return dream_sample_target_length(csc, rng, b_n);
+  stats->countdown = stats->sample_every;
+  stat_add(&stats->calls, stats->sample_every);
+
+  start = now_ns();
+  t_n = dream_sample_target_length(csc, rng, b_n);
+  ns = now_ns() - start;
+  /* the matrix might have been swapped for one of another size */
+  if (t_n < 0 || b_n > stats->size || t_n > stats->size)
+    return t_n;
+
+  bucket = ns ? 64 - __builtin_clzll(ns) : 0;
+  if (bucket >= DREAM_STATS_LATENCY_BUCKETS)
+    bucket = DREAM_STATS_LATENCY_BUCKETS - 1;
+
+  stat_add(&stats->recorded, 1);
+  stat_add(&stats->hits[b_n-1], 1);
+  stat_add(&stats->targets[t_n-1], 1);
+  stat_add(&stats->latency[bucket], 1);
+  stat_add(&stats->latency_ns, ns);
+  if (t_n > b_n)
+    stat_add(&stats->padding_bytes, t_n - b_n);
+  else
+    stat_add(&stats->split_bytes, b_n - t_n);
+
+  return t_n;
+}
+
+/** Add the statistics of 'src' to 'dst'. Return 0 on success, or -1
+    if they're of different sizes. */
+int
+dream_stats_merge(dream_stats_t *dst, const dream_stats_t *src)
+{
+  int i;
+
+  if (dst->size != src->size)
+    return -1;
+
+  dst->calls += stat_get(&src->calls);
+  dst->recorded += stat_get(&src->recorded);
+  for (i = 0 ; i < src->size ; i++) {
+    dst->hits[i] += stat_get(&src->hits[i]);
+    dst->targets[i] += stat_get(&src->targets[i]);
+  }
+  for (i = 0 ; i < DREAM_STATS_LATENCY_BUCKETS ; i++)
+    dst->latency[i] += stat_get(&src->latency[i]);
+  dst->latency_ns += stat_get(&src->latency_ns);
+  dst->padding_bytes += stat_get(&src->padding_bytes);
+  dst->split_bytes += stat_get(&src->split_bytes);
+
+  return 0;
+}
+
+/** Compare the target lengths recorded in 'stats' with the
+    distribution 'target', putting the chi-square statistic in 'chi2'
+    and the Kullback-Leibler divergence in 'kl'. Return how many
+    recorded lengths were outside 'target', or -1 if none were
+    recorded. Like get_divergence() of dreams/python/monitor.py. */
+long
+dream_stats_divergence(const dream_stats_t *stats, const double *target,
+                       double *chi2, double *kl)
+{
+  double total = 0, packets = 0;
+  long outside = 0;
+  int i;
+
+  for (i = 0 ; i < stats->size ; i++) {
+    total += target[i];
+    packets += stat_get(&stats->targets[i]);
+  }
+  if (packets == 0 || total <= 0)
+    return -1;
+
+  *chi2 = *kl = 0;
+  for (i = 0 ; i < stats->size ; i++) {
+    double observed = stat_get(&stats->targets[i]);
+    double p = target[i] / total;
+
+    if (p <= 0) {
+      outside += observed;
+      continue;
+    }
+    *chi2 += (observed - p * packets) * (observed - p * packets) /
+      (p * packets);
+    if (observed > 0)
+      *kl += observed / packets * log2(observed / packets / p);
+  }
+  if (outside)
+    *kl = INFINITY;
+
+  return outside;
+}
+
+/* The binary morphing matrix format (see the FAQ). All fields are
+   little-endian. */
+#define BINARY_MAGIC "MORPHCSC"
+#define BINARY_MAGIC_LEN 8
+#define BINARY_VERSION 2 /* version 1 files, without thresholds, too */
+#define BINARY_HEADER_LEN 32
+
+/** Return the CRC-32 (as in zlib) of the 'len' bytes at 'buf'. */
+static uint32_t
+crc32(const unsigned char *buf, size_t len)
+{
+  uint32_t table[256];
+  uint32_t crc;
+  uint32_t i, k;
+  size_t n;
+
+  for (i = 0 ; i < 256 ; i++) {
+    crc = i;
+    for (k = 0 ; k < 8 ; k++)
+      crc = (crc & 1) ? (crc >> 1) ^ 0xEDB88320U : (crc >> 1);
+    table[i] = crc;
+  }
+
+  crc = 0xFFFFFFFFU;
+  for (n = 0 ; n < len ; n++)
+    crc = table[(crc ^ buf[n]) & 0xFF] ^ (crc >> 8);
+
+  return crc ^ 0xFFFFFFFFU;
+}
+
+/** Return the little-endian uint32 at 'buf'. */
+static uint32_t
+get_uint32(const unsigned char *buf)
+{
+  return (uint32_t)buf[0] | ((uint32_t)buf[1] << 8) |
+    ((uint32_t)buf[2] << 16) | ((uint32_t)buf[3] << 24);
+}
+
+/** Given the filename of a binary morphing matrix file (as written by
+    morpheus.py --binary), map it in memory and place the matrix in
+    CSC format in 'csc_out'. The CSC arrays point straight into the
+    read-only mapping of the file; nothing is parsed or copied, and
+    processes mapping the same file share its pages. */
+enum mm_ret
+dream_set_csc_from_binary(csc_t **csc_out, const char *fname)
+{
+  const uint16_t endian_probe = 1;
+  const unsigned char *map = MAP_FAILED;
+  const int *col_ptrs, *row_inds;
+  const double *values;
+  const uint64_t *thresholds = NULL;
+  uint32_t version, size, entries_n, checksum;
+  uint64_t off_row_inds, off_values, off_cdf, off_thresholds, file_len;
+  struct stat st;
+  size_t map_len = 0;
+  int fd = -1;
+  int i, j;
+  enum mm_ret status = DREAM_MM_OKAY;
+
+  *csc_out = NULL;
+
+  /* The arrays are used in place, so they must be in host order. */
+  if (*(const unsigned char *)&endian_probe != 1) {
+    status = DREAM_MM_INTERNAL;
+    goto err;
+  }
+
+  fd = open(fname, O_RDONLY);
+  if ((fd < 0) || (fstat(fd, &st) < 0)) {
+    status = DREAM_MM_INTERNAL;
+    goto err;
+  }
+
+  /* validate */
+
+  if ((st.st_size < BINARY_HEADER_LEN) || ((uint64_t)st.st_size > SIZE_MAX)) {
+    status = DREAM_MM_CORRUPTED;
+    goto err;
+  }
+  map_len = (size_t)st.st_size;
+
+  map = mmap(NULL, map_len, PROT_READ, MAP_SHARED, fd, 0);
+  if (map == MAP_FAILED) {
+    status = DREAM_MM_INTERNAL;
+    goto err;
+  }
+
+  version = get_uint32(map + 8);
+  if (memcmp(map, BINARY_MAGIC, BINARY_MAGIC_LEN) ||
+      (version < 1) || (version > BINARY_VERSION)) {
+    status = DREAM_MM_NOT_MORPHING;
+    goto err;
+  }
+
+  size = get_uint32(map + 12);
+  entries_n = get_uint32(map + 16);
+  checksum = get_uint32(map + 24);
+
+  /* 'size+1' column pointers must fit in an int. */
+  if ((size == 0) || (entries_n == 0) ||
+      (size >= INT_MAX) || (entries_n > INT_MAX)) {
+    status = DREAM_MM_CORRUPTED;
+    goto err;
+  }
+
+  /* 64-bit arithmetic can't overflow with 31-bit sizes. */
+  off_row_inds = BINARY_HEADER_LEN + ((uint64_t)size + 1) * 4;
+  off_values = off_row_inds + (uint64_t)entries_n * 4;
+  off_values = (off_values + 7) & ~(uint64_t)7;
+  off_cdf = off_values + (uint64_t)entries_n * 8;
+  off_thresholds = off_cdf + (uint64_t)entries_n * 8;
+  file_len = off_thresholds;
+  if (version >= 2)
+    file_len += (uint64_t)entries_n * 8;
+
+  if ((file_len != (uint64_t)map_len) ||
+      (crc32(map + BINARY_HEADER_LEN,
+             map_len - BINARY_HEADER_LEN) != checksum)) {
+    status = DREAM_MM_CORRUPTED;
+    goto err;
+  }
+
+  col_ptrs = (const int *)(map + BINARY_HEADER_LEN);
+  row_inds = (const int *)(map + off_row_inds);
+  values = (const double *)(map + off_values);
+  if (version >= 2)
+    thresholds = (const uint64_t *)(map + off_thresholds);
+
+  if ((col_ptrs[0] != 0) || (col_ptrs[size] != (int)entries_n)) {
+    status = DREAM_MM_CORRUPTED;
+    goto err;
+  }
+
+  for (j = 0 ; j < (int)size ; j++) {
+    /* morphing matrices don't have empty columns */
+    if (col_ptrs[j+1] <= col_ptrs[j]) {
+      status = DREAM_MM_NOT_MORPHING;
+      goto err;
+    }
+  }
+
+  /* Thresholds never decrease and each column's end at exactly
+     DREAM_FIXED_POINT_ONE. */
+  for (j = 0 ; thresholds && (j < (int)size) ; j++) {
+    if (thresholds[col_ptrs[j+1]-1] != DREAM_FIXED_POINT_ONE) {
+      status = DREAM_MM_NOT_MORPHING;
+      goto err;
+    }
+    for (i = col_ptrs[j]+1 ; i < col_ptrs[j+1] ; i++) {
+      if (thresholds[i] < thresholds[i-1]) {
+        status = DREAM_MM_NOT_MORPHING;
+        goto err;
+      }
+    }
+  }
+
+  for (i = 0 ; i < (int)entries_n ; i++) {
+    /* '!(x >= 0)' also catches NaNs */
+    if ((row_inds[i] < 0) || (row_inds[i] >= (int)size) ||
+        !(values[i] >= 0.0)) {
+      status = DREAM_MM_NOT_MORPHING;
+      goto err;
+    }
+  }
+
+  /* stop validating */
+
+  *csc_out = calloc(1, sizeof(csc_t));
+  if (!*csc_out) {
+    status = DREAM_MM_INTERNAL;
+    goto err;
+  }
+
+  (*csc_out)->size = (int)size;
+  (*csc_out)->entries_n = (int)entries_n;
+  (*csc_out)->values = (double *)values;
+  (*csc_out)->row_inds = (int *)row_inds;
+  (*csc_out)->col_ptrs = (int *)col_ptrs;
+  (*csc_out)->cdf = (double *)(map + off_cdf);
+  (*csc_out)->thresholds = (uint64_t *)thresholds;
+  (*csc_out)->map = (void *)map;
+  (*csc_out)->map_len = map_len;
+
+  close(fd);
+
+  goto done;
+
+ err:
+  assert(status != DREAM_MM_OKAY);
+
+  if (map != MAP_FAILED)
+    munmap((void *)map, map_len);
+  if (fd >= 0)
+    close(fd);
+
+ done:
+  return status;
+}
+
+/** DISABLED TILL THE INTEGER OVERFLOWS ARE FIXED. */
+#if 0
+/** Create square CSC matrix of 'cols_n' columns and of 'nz_entries'
+    non-zero entries in 'csc_out'. */
+static int
+csc_create(csc_t **csc_out, int cols_n, int nz_entries)
+{
+  assert((cols_n > 0) && (nz_entries > 0));
+
+  if (cols_n == INT_MAX) /* don't overflow cols_n. */
+    return -1;
+
+  *csc_out = calloc(1, sizeof(csc_t));
+  if (!csc_out)
+    return -1;
+
+  (*csc_out)->values = malloc(nz_entries * sizeof(double));
+  (*csc_out)->row_inds = malloc(nz_entries * sizeof(int));
+  (*csc_out)->col_ptrs = malloc((cols_n+1) * sizeof(int));
+  if ((!(*csc_out)->values) ||
+      (!(*csc_out)->row_inds) ||
+      (!(*csc_out)->col_ptrs)) {
+    csc_free(*csc_out);
+    return -1;
+  }
+
+  (*csc_out)->size = cols_n;
+  (*csc_out)->entries_n = nz_entries;
+
+  return 0;
+}
+
 /** Compare two COO elements by their row.
     Comparison function for qsort() */
 static int
@@ -1,6 +1,11 @@
 #ifndef DREAM_H
 #define DREAM_H
 
+#include <stdio.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <pthread.h>
+
 /** Represents a square sparse matrix in Compressed Sparse Column (CSC)
     format. */
 typedef struct {
@@ -11,8 +16,82 @@ typedef struct {
   double *values; /* values */
   int *row_inds; /* row indices */
   int *col_ptrs; /* column pointers */
+
+  /* per-column CDFs, laid out like 'values' (NULL if not available;
+     see dream_prepare()) */
+  double *cdf;
+  /* per-column fixed-point CDF thresholds, laid out like 'values';
+     each column's end at exactly DREAM_FIXED_POINT_ONE (NULL if not
+     available; see dream_prepare()) */
+  uint64_t *thresholds;
+
+  /* if the arrays above point into a mapped binary file, its mapping */
+  void *map;
+  size_t map_len;
+
+  /* references to the matrix of dream_slot_t users (see below) */
+  int refs;
 } csc_t;
 
+/** Holds the current morphing matrix of, e.g., a protocol pair and
+    direction, so that it can be replaced while threads sample from
+    it.
+
+    Threads take a reference to the current matrix with
+    dream_slot_acquire(), sample from it, and drop the reference with
+    dream_csc_release(). dream_slot_swap() installs a new matrix
+    (e.g. loaded in the background with dream_set_csc_from_binary());
+    threads that acquired the old one keep using it, and the last one
+    to release it frees it. */
+typedef struct {
+  pthread_mutex_t lock; /* held just to read and reference 'csc' */
+  csc_t *csc;
+} dream_slot_t;
+
+/** Fixed-point CDF thresholds of a column end at this. */
+#define DREAM_FIXED_POINT_BITS 32
+#define DREAM_FIXED_POINT_ONE ((uint64_t)1 << DREAM_FIXED_POINT_BITS)
+
+/** State of a xoshiro256+ pseudo-random number generator.
+
+    A loaded csc_t is never written to by the sampling functions, so
+    one matrix can be shared by any number of threads without locking,
+    as long as each thread samples with its own dream_rng_t. */
+typedef struct {
+  uint64_t s[4];
+} dream_rng_t;
+
+/** 'latency[k]' of dream_stats_t counts the calls that took
+    [2^(k-1), 2^k) nanoseconds (0 ns for k = 0); the last bucket also
+    counts all slower calls. */
+#define DREAM_STATS_LATENCY_BUCKETS 32
+
+/** Runtime statistics of the sampling of a thread, recorded by
+    dream_sample_target_length_stats() for one in every 'sample_every'
+    calls.
+
+    Each thread records into its own dream_stats_t, without locking.
+    Any thread can add them up into a snapshot with dream_stats_merge()
+    at any time; it may miss the calls in progress. */
+typedef struct {
+  int size; /* size of the morphing matrix */
+  uint32_t sample_every;
+  uint32_t countdown; /* calls until the next recorded one */
+
+  uint64_t calls; /* all calls, recorded or not (counted up to the
+                     last recorded one) */
+  uint64_t recorded; /* recorded calls (one packet each) */
+  uint64_t *hits; /* recorded calls per source length ('size' of them,
+                     zero-based) */
+  uint64_t *targets; /* recorded target lengths, likewise */
+  uint64_t latency[DREAM_STATS_LATENCY_BUCKETS];
+  uint64_t latency_ns; /* total latency of the recorded calls */
+  /* bytes of padding added to the packets that grow, and bytes split
+     off the packets that shrink */
+  uint64_t padding_bytes;
+  uint64_t split_bytes;
+} dream_stats_t;
+
 /** Status of the morphing matrix parsing. */
 enum mm_ret {
   DREAM_MM_OKAY, /* matrix market parsed correctly */
@@ -26,19 +105,126 @@ enum mm_ret {
     matrix, place the matrix in CSC format in 'csc_out'. */
 enum mm_ret dream_set_csc_from_mm(csc_t **csc_out, FILE *f);
 
+/** Given the filename of a binary morphing matrix file (as written by
+    morpheus.py --binary), map it in memory and place the matrix in
+    CSC format in 'csc_out'. The CSC arrays point straight into the
+    read-only mapping of the file; nothing is parsed or copied, and
+    processes mapping the same file share its pages. */
+enum mm_ret dream_set_csc_from_binary(csc_t **csc_out, const char *fname);
+
 /** Free space allocated by matrix 'csc'. */
 void csc_free(csc_t *csc);
 
+/** Given a morphing matrix 'csc' without per-column CDFs or
+    fixed-point thresholds, compute them (matrices loaded from binary
+    files already have them, except for thresholds in version 1
+    files). Call it once, before sharing 'csc' between threads. With
+    CDFs, sampling a target length is a binary search in the column
+    instead of a linear scan. The thresholds are computed with the
+    same floating point operations as dream.py's get_thresholds(), so
+    they are bit-exact with it. Return 0 on success, or -1 if out of
+    memory. */
+int dream_prepare(csc_t *csc);
+
+/** Initialize 'slot' with the morphing matrix 'csc', which it takes
+    over. Return 0 on success, or -1 on error. */
+int dream_slot_init(dream_slot_t *slot, csc_t *csc);
+
+/** Return a reference to the current morphing matrix of 'slot'. Drop
+    it with dream_csc_release() when done sampling from it. */
+csc_t *dream_slot_acquire(dream_slot_t *slot);
+
+/** Drop a reference to 'csc' taken with dream_slot_acquire(), freeing
+    it if it was the last one. */
+void dream_csc_release(csc_t *csc);
+
+/** Make 'csc' the current morphing matrix of 'slot', which takes it
+    over. The old matrix is freed once no thread uses it anymore. */
+void dream_slot_swap(dream_slot_t *slot, csc_t *csc);
+
+/** Drop the matrix of 'slot' (see dream_slot_swap()) and free the
+    resources of 'slot'. */
+void dream_slot_destroy(dream_slot_t *slot);
+
 /** Given a source packet length in 'n' and a random number \in [0,1]
     in 'rand', return the target packet length according to the
     morphing matrix in 'csc'.
     - 'b_n' is given in one-based numbering. */
-int dream_get_target_length(csc_t *csc, int n, double rand);
+int dream_get_target_length(const csc_t *csc, int n, double rand);
+
+/** Given 'n' source packet lengths in 'lens' and as many random
+    numbers \in [0,1] in 'rands', place their target packet lengths
+    according to the morphing matrix in 'csc' in 'out'.
+    Return 0 on success, or -1 if any of the source lengths or random
+    numbers was invalid; their target lengths are -1. */
+int dream_get_target_lengths(const csc_t *csc, const int *lens,
+                             const double *rands, int *out, size_t n);
+
+/** Given a source packet length in 'n' and a random integer 'r' \in
+    [0, DREAM_FIXED_POINT_ONE), return the target packet length
+    according to the fixed-point thresholds of the morphing matrix in
+    'csc', or -1 if it has none. The same 'n' and 'r' give the same
+    target length as dream.py's get_target_length_fixed(), so test
+    vectors carry over between the two.
+    - 'b_n' is given in one-based numbering. */
+int dream_get_target_length_fixed(const csc_t *csc, int n, uint32_t r);
+
+/** Like dream_get_target_lengths(), with random integers 'rs' for
+    dream_get_target_length_fixed(). */
+int dream_get_target_lengths_fixed(const csc_t *csc, const int *lens,
+                                   const uint32_t *rs, int *out, size_t n);
+
+/** Seed the random number generator 'rng' with 'seed'. Give every
+    thread its own 'rng', seeded differently (e.g. with its thread
+    number). */
+void dream_rng_seed(dream_rng_t *rng, uint64_t seed);
+
+/** Return the next random number \in [0,1) of 'rng'. */
+double dream_rng_double(dream_rng_t *rng);
+
+/** Return the next random 32-bit integer of 'rng'. */
+uint32_t dream_rng_uint32(dream_rng_t *rng);
+
+/** Like dream_get_target_length(), but draw the random number from
+    'rng'. If 'csc' has fixed-point thresholds, draw a random integer
+    and use dream_get_target_length_fixed() instead. Thread-safe as
+    long as no other thread uses 'rng'. */
+int dream_sample_target_length(const csc_t *csc, dream_rng_t *rng, int n);
+
+/** Initialize 'stats' for a morphing matrix of size 'size', to record
+    one in every 'sample_every' calls. Return 0 on success, or -1 on
+    error. */
+int dream_stats_init(dream_stats_t *stats, int size, uint32_t sample_every);
+
+/** Free the resources of 'stats'. */
+void dream_stats_free(dream_stats_t *stats);
+
+/** Like dream_sample_target_length(), but record statistics of the
+    call in 'stats' if its turn has come. 'stats' must belong to the
+    calling thread. */
+int dream_sample_target_length_stats(const csc_t *csc, dream_rng_t *rng,
+                                     int n, dream_stats_t *stats);
+
+/** Add the statistics of 'src' (e.g. of another thread) to 'dst',
+    e.g. a snapshot made with dream_stats_init(). Return 0 on success,
+    or -1 if they're of different sizes. */
+int dream_stats_merge(dream_stats_t *dst, const dream_stats_t *src);
+
+/** Compare the target lengths recorded in 'stats' with 'target', the
+    probability distribution the morphing matrix morphs into ('size'
+    of them, element 'i' being the probability of length 'i+1'). Put
+    in 'chi2' Pearson's chi-square statistic over the lengths that
+    'target' can give, and in 'kl' the Kullback-Leibler divergence of
+    'target' from the recorded lengths, in bits (INFINITY if lengths
+    outside 'target' were recorded). Return how many recorded lengths
+    were outside 'target', or -1 if none were recorded yet. */
+long dream_stats_divergence(const dream_stats_t *stats, const double *target,
+                            double *chi2, double *kl);
 
 /** Given a morphing matrix 'csc' and a source packet length 'n',
     print all possible mutations that can happen to 'n' along with
     their probabilities.
     - 'b_n' is given in one-based numbering. */
-void dream_print_potential(csc_t *csc, int n);
+void dream_print_potential(const csc_t *csc, int n);
 
 #endif /* DREAM_H */
@@ -0,0 +1,140 @@
+#!/usr/bin/python2.7
+
+"""
+Loopback benchmark of morphstream.
+
+$ bench_stream.py <morphing matrix> <source distribution> <target distribution> [packets]
+
+A writer thread sends payloads with lengths drawn from the source
+distribution over a loopback TCP connection; morph_socket() morphs
+them onto a second loopback connection, and a reader thread deframes
+them and checks that the payload stream arrived intact and that no
+frame on the wire is of a length the target distribution never gives.
+Prints the payload and wire throughput, the latency that morphing adds
+to each payload, and the total variation distance between the
+histogram of the frame lengths on the wire and the target
+distribution. That distance is only small if every read of the
+morpher is a whole payload; over TCP, reads often merge payloads, so
+the lengths being morphed don't follow the source distribution.
+"""
+
+import sys
+import os
+import socket
+import threading
+import time
+import zlib
+import numpy
+
+import dream
+import morphstream
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", ".."))
+import distr
+
+"""Return a pair of connected loopback TCP sockets."""
+def tcp_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    a = socket.create_connection(listener.getsockname())
+    b, addr = listener.accept()
+    listener.close()
+    return (a, b)
+
+"""Send payloads of 'lengths' bytes of 'data' to 'sock', then close it."""
+def write(sock, data, lengths):
+    view = memoryview(data)
+    pos = 0
+    for length in lengths:
+        sock.sendall(view[pos:pos+length])
+        pos += length
+    sock.shutdown(socket.SHUT_WR)
+
+"""Deframe everything received from 'sock' until EOF and store the
+CRC-32 of the payload stream, the bytes received and the lengths of
+the frames in 'result'."""
+def read(sock, result):
+    frame_lengths = []
+    deframer = morphstream.Deframer(frame_lengths)
+    crc = 0
+    wire = 0
+    while (True):
+        data = sock.recv(1 << 16)
+        if (not data):
+            break
+        wire += len(data)
+        crc = zlib.crc32(deframer.feed(data), crc)
+    result.update(crc=crc, wire=wire, pending=deframer.pending(),
+                  frame_lengths=frame_lengths)
+
+def main(argv):
+    if (len(argv) < 3):
+        print "Usage: bench_stream.py <morphing matrix> " \
+            "<source distribution> <target distribution> [packets]"
+        sys.exit(1)
+
+    mm = dream.get_morphing_matrix_from_file(argv[0])
+    source = distr.get_distr_from_file(argv[1])
+    target = distr.get_distr_from_file(argv[2])
+    packets = int(argv[3]) if (len(argv) > 3) else 200000
+
+    rng = numpy.random.RandomState(0)
+    lengths = (numpy.searchsorted(numpy.cumsum(source),
+                                  rng.random_sample(packets) * source.sum(),
+                                  side='right') + 1)
+    lengths = numpy.minimum(lengths, len(source)).tolist()
+    data = os.urandom(sum(lengths))
+
+    src_w, src_r = tcp_pair()
+    dst_w, dst_r = tcp_pair()
+    result = {}
+    writer = threading.Thread(target=write, args=(src_w, data, lengths))
+    reader = threading.Thread(target=read, args=(dst_r, result))
+
+    morpher = morphstream.Morpher(mm, target, seed=1) # not the seed of the lengths
+    latencies = []
+    start = time.time()
+    writer.start()
+    reader.start()
+    morphstream.morph_socket(src_r, dst_w, morpher, latencies=latencies)
+    dst_w.shutdown(socket.SHUT_WR)
+    writer.join()
+    reader.join()
+    spent = time.time() - start
+
+    if ((result["crc"] != zlib.crc32(data)) or result["pending"]):
+        print "Payload stream corrupted!"
+        sys.exit(1)
+
+    # Frame lengths on the wire, element 'i' counting length 'i+1'.
+    wire_lengths = numpy.bincount(result["frame_lengths"],
+                                  minlength=len(target)+1)[1:]
+    if ((len(wire_lengths) > len(target)) or
+        numpy.any(wire_lengths[numpy.asarray(target) <= 0])):
+        print "Frames of lengths outside the target distribution!"
+        sys.exit(1)
+    tv = abs(wire_lengths / float(wire_lengths.sum()) -
+             target / target.sum()).sum() / 2
+
+    latencies = numpy.array(latencies) * 1e6
+    print "%d payloads (%d reads) in %.2fs" % (packets,
+                                               morpher.stats["payloads"], spent)
+    print "payload: %.2f MB/s, wire: %.2f MB/s (%.1f%% overhead)" % \
+        (len(data) / spent / 1e6, result["wire"] / spent / 1e6,
+         100.0 * (result["wire"] - len(data)) / len(data))
+    print "frames: %d, splits: %d, padding: %d bytes, " \
+        "short targets: %d" % (morpher.stats["frames"],
+                               morpher.stats["splits"],
+                               morpher.stats["padding_bytes"],
+                               morpher.stats["short_targets"])
+    print "frame lengths on the wire: max %d, total variation distance " \
+        "to the target distribution %.4f" % (max(result["frame_lengths"] or [0]),
+                                             tv)
+    print "added latency: mean %.1fus, p50 %.1fus, p99 %.1fus" % \
+        (latencies.mean(), numpy.percentile(latencies, 50),
+         numpy.percentile(latencies, 99))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,74 @@
+#!/usr/bin/python2.7
+
+"""
+Benchmark of sampling target packet lengths from many threads that
+share one MorphingMatrix through a dream.Sampler.
+
+$ bench_threads.py my_morphing_matrix.bin [max threads] [samples per thread]
+
+For every number of threads up to 'max threads', prints the total and
+per-thread throughput of scalar (get_target_length()) and batch
+(get_target_lengths()) sampling. Scalar sampling holds the GIL, so its
+total throughput stays flat. Batch sampling spends most of its time in
+NumPy, which releases the GIL while it draws and searches, so it scales
+with the number of cores. dreams/c/bench_threads.c is the C equivalent.
+"""
+
+import sys
+import threading
+import time
+import numpy
+
+import dream
+
+BATCH_SIZE = 4096
+
+"""Sample 'samples' target lengths with 'sampler', one at a time."""
+def work_scalar(sampler, samples):
+    lengths = numpy.random.RandomState().randint(1, sampler.matrix.size + 1,
+                                                 size=samples).tolist()
+    for s_len in lengths:
+        sampler.get_target_length(s_len)
+
+"""Sample 'samples' target lengths with 'sampler', BATCH_SIZE at a
+time."""
+def work_batch(sampler, samples):
+    lengths = numpy.random.RandomState().randint(1, sampler.matrix.size + 1,
+                                                 size=BATCH_SIZE)
+    for i in xrange(0, samples, BATCH_SIZE):
+        sampler.get_target_lengths(lengths)
+
+"""Run 'work' on 'n' threads sharing 'sampler', each for 'samples'
+samples, and return how long it took."""
+def run(work, sampler, n, samples):
+    threads = [threading.Thread(target=work, args=(sampler, samples))
+               for i in xrange(n)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+def main(argv):
+    if (len(argv) < 1):
+        print "Usage: bench_threads.py <morphing matrix> " \
+            "[max threads] [samples per thread]"
+        sys.exit(1)
+
+    max_threads = int(argv[1]) if (len(argv) > 1) else 4
+    samples = int(argv[2]) if (len(argv) > 2) else 1000000
+
+    sampler = dream.Sampler(dream.get_morphing_matrix_from_file(argv[0]),
+                            seed=0)
+
+    print "mode\tthreads\tMsamples/s\tper thread"
+    for name, work, count in (("scalar", work_scalar, samples // 10),
+                              ("batch", work_batch, samples)):
+        for n in xrange(1, max_threads + 1):
+            spent = run(work, sampler, n, count)
+            print "%s\t%d\t%.2f\t\t%.2f" % (name, n, n * count / spent / 1e6,
+                                            count / spent / 1e6)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,8 +1,14 @@
 import sys
 import random
 import math
-from decimal import Decimal
-import scipy.io
+import bisect
+import os
+import struct
+import zlib
+import threading
+import itertools
+import numpy
+import scipy.sparse
 
 """
 This library provides the following functions:
@@ -15,6 +21,10 @@ This library provides the following functions:
               spits out an instantly generated target packet length
               for 'source_packet_length'.
 
+    * get_target_lengths(source_packet_lengths, rands=None):
+              like get_target_length() but for a whole NumPy array of
+              source packet lengths at once.
+
 
 Example of its usage:
 
@@ -40,30 +50,114 @@ Out[5]: 983
 
 In [6]: mm.get_target_length(85)
 Out[6]: 985
+
+Morphing matrices written by 'morpheus.py --binary=mm.bin' load
+without parsing, as memory maps of the file:
+
+In [7]: mm_csc, mm_cdf, mm_thresholds = read_binary("mm.bin")
+
+In [8]: mm = MorphingMatrix(mm_csc, cdf=mm_cdf, thresholds=mm_thresholds)
+
+MorphingMatrix can sample target lengths in different ways (see its
+'sampler' argument):
+
+    * SAMPLER_BISECT (default): per-column CDFs are precomputed from
+              the CSC arrays, and each lookup is a binary search in
+              O(log nnz) of the column. Up to rounding, a given 'rand'
+              maps to the same target length as with SAMPLER_LINEAR.
+
+    * SAMPLER_ALIAS: per-column Walker/Vose alias tables are
+              precomputed, and each lookup is O(1). A given 'rand'
+              maps to a target length with the right probability, but
+              not necessarily to the same one as with SAMPLER_LINEAR.
+
+    * SAMPLER_FIXED: each column's CDF is also kept as integer
+              thresholds that end at exactly 2^32 (see
+              get_thresholds()), and a target length is sampled with a
+              random 32-bit integer and an integer binary search. No
+              floating point is involved, so for a given integer the
+              target length is bit-exact with dream.c's
+              dream_get_target_length_fixed(); see
+              get_target_length_fixed().
+
+    * SAMPLER_LINEAR: the original sampler. The column is densified
+              and walked linearly using Decimals. Slow; kept around
+              for reference.
+
+To sample from many threads, share one MorphingMatrix through a
+Sampler, which keeps separate random number generators per thread:
+
+In [9]: sampler = Sampler(mm, seed=42)
+
+In [10]: sampler.get_target_length(85)
+
+To keep statistics of the sampling of a MorphingMatrix, e.g. to tell
+if the morphed traffic still matches the target distribution, set its
+'monitor' to a monitor.Monitor (see monitor.py).
 """
 
 PARANOIA = True
 
+# Columns of a morphing matrix must sum up to 1 within this.
+COLUMN_SUM_TOLERANCE = 1e-5
+
+SAMPLER_LINEAR = "linear"
+SAMPLER_BISECT = "bisect"
+SAMPLER_ALIAS = "alias"
+SAMPLER_FIXED = "fixed"
+SAMPLERS = (SAMPLER_LINEAR, SAMPLER_BISECT, SAMPLER_ALIAS, SAMPLER_FIXED)
+
+# Fixed-point CDF thresholds of a column end at FIXED_POINT_ONE.
+FIXED_POINT_BITS = 32
+FIXED_POINT_ONE = 1 << FIXED_POINT_BITS
+# Shifting column numbers by this many bits puts them above the
+# thresholds (which need FIXED_POINT_BITS+1 bits).
+FIXED_POINT_SHIFT = FIXED_POINT_BITS + 1
+
+# The binary morphing matrix format (see the FAQ).
+BINARY_MAGIC = "MORPHCSC"
+BINARY_VERSION = 2 # version 1 files, without thresholds, can be read too
+BINARY_HEADER = struct.Struct("<8sIIIIII") # magic, version, size,
+                                          # entries, flags, crc32, reserved
+
 """Represents a Morphing Matrix.
 
 'self.matrix' is the morphing matrix itself as a SciPy matrix.
 'self.size' is the number of rows/columns of the square morphing
 matrix (e.g. 1460 if it's a 1460x1460 matrix).
+'self.sampler' is the way target lengths are sampled (e.g. SAMPLER_BISECT).
+'self.monitor', if set to a monitor.Monitor, records statistics of the
+sampling (see monitor.py). It is None by default, which costs nothing.
 """
 class MorphingMatrix:
     """Initialize MorphingMatrix.
 
     'matrix' is a SciPy sparse matrix in CSC format.
+    'sampler' is one of SAMPLERS.
+    'cdf', if given, is the precomputed CDF of 'matrix' as returned by
+    get_cdf(), e.g. the one of a binary morphing matrix file. It is
+    used in place, without copying.
+    'thresholds', likewise, are its precomputed fixed-point CDF
+    thresholds as returned by get_thresholds().
     """
-    def __init__(self, matrix):
+    def __init__(self, matrix, sampler=SAMPLER_BISECT, cdf=None,
+                 thresholds=None):
         self.matrix = matrix
         if (self.matrix.shape[0] != self.matrix.shape[1]):
             raise ValueError("Matrix provided is not square (%d:%d)." %
                              (self.matrix.shape[0], self.matrix.shape[1]))
         self.size = self.matrix.shape[0]
 
+        if (sampler not in SAMPLERS):
+            raise ValueError("Unknown sampler '%s'." % (sampler))
+        self.sampler = sampler
+
         if (PARANOIA): self.__validate()
 
+        self.__build_tables(cdf, thresholds)
+
+        self.monitor = None
+
     """Public function.
     Given 's_len', the packet length of a source packet that we want
     to morph, return the target packet length according to the
@@ -72,9 +166,194 @@ class MorphingMatrix:
     number in __sample_target_size().
     """
     def get_target_length(self, s_len, rand=None):
-        column = self.__get_matrix_column(s_len)
+        if (self.monitor is None):
+            return self.__get_target_length(s_len, rand)
+        return self.monitor.call(self.__get_target_length, s_len, rand)
+
+    """get_target_length() without the monitor."""
+    def __get_target_length(self, s_len, rand):
+        if (self.sampler == SAMPLER_LINEAR):
+            column = self.__get_matrix_column(s_len)
+            return self.__sample_target_size(column, rand)
+
+        if (not (0 < s_len <= self.size)):
+            raise ValueError("You requested column '%d' " \
+                             "of matrix of size '%s'." %(s_len, self.size))
+
+        if (self.sampler == SAMPLER_FIXED):
+            if (rand is None):
+                return self.__get_target_length_fixed(s_len, None)
+            if (not (0 <= rand <= 1)):
+                raise ValueError("Value of 'rand' is unacceptable! (%s)" %
+                                 (rand))
+            return self.__get_target_length_fixed(
+                s_len, min(int(rand * FIXED_POINT_ONE), FIXED_POINT_ONE - 1))
+
+        if (rand is None):
+            rand = random.random()
+        elif (not (0 <= rand <= 1)):
+            raise ValueError("Value of 'rand' is unacceptable! (%s)" % (rand))
+
+        lo = self.__indptr[s_len-1]
+        hi = self.__indptr[s_len]
+        if (lo == hi):
+            raise ValueError("Column '%d' of the morphing matrix " \
+                             "is empty." % (s_len))
+
+        if (self.sampler == SAMPLER_ALIAS):
+            x = float(rand) * (hi - lo)
+            bucket = int(x)
+            if (bucket == hi - lo): # rand == 1
+                bucket -= 1
+            if (x - bucket < self.__alias_prob[lo+bucket]):
+                return int(self.__rows[lo+bucket]) + 1
+            return int(self.__alias_rows[lo+bucket]) + 1
+
+        # First entry whose CDF value passes 'rand'. If 'rand' is 1,
+        # that's past the column, so use its last entry.
+        k = bisect.bisect_right(self.__cdf, (s_len - 1) + float(rand), lo, hi)
+        if (k == hi):
+            k -= 1
+        return int(self.__rows[k]) + 1
+
+    """Public function.
+    Given 's_len', the packet length of a source packet that we want
+    to morph, and 'r', a random integer in [0, FIXED_POINT_ONE), return
+    the target packet length according to the fixed-point CDF
+    thresholds of the morphing matrix: the row of the first entry of
+    the column whose threshold is greater than 'r'. The same 's_len'
+    and 'r' give the same target length in dream.c.
+    If 'r' is None, a random one is drawn.
+    """
+    def get_target_length_fixed(self, s_len, r=None):
+        if (self.monitor is None):
+            return self.__get_target_length_fixed(s_len, r)
+        return self.monitor.call(self.__get_target_length_fixed, s_len, r)
+
+    """get_target_length_fixed() without the monitor."""
+    def __get_target_length_fixed(self, s_len, r):
+        if (not (0 < s_len <= self.size)):
+            raise ValueError("You requested column '%d' " \
+                             "of matrix of size '%s'." %(s_len, self.size))
+
+        if (r is None):
+            r = random.getrandbits(FIXED_POINT_BITS)
+        elif (not (0 <= r < FIXED_POINT_ONE)):
+            raise ValueError("Value of 'r' is unacceptable! (%s)" % (r))
+
+        if (self.__batch_thresholds is None):
+            self.__build_fixed_tables()
+
+        lo = self.__indptr[s_len-1]
+        hi = self.__indptr[s_len]
+        if (lo == hi):
+            raise ValueError("Column '%d' of the morphing matrix " \
+                             "is empty." % (s_len))
+
+        # The last threshold of a column is FIXED_POINT_ONE > 'r'.
+        return int(self.__rows[bisect.bisect_right(self.__thresholds, r,
+                                                   lo, hi)]) + 1
+
+    """Public function.
+    Like get_target_length_fixed(), for a whole NumPy array of source
+    packet 'lengths' and, if given, an array 'rs' of random integers
+    of the same shape.
+    """
+    def get_target_lengths_fixed(self, lengths, rs=None):
+        if (self.monitor is None):
+            return self.__get_target_lengths_fixed(lengths, rs)
+        return self.monitor.call_batch(self.__get_target_lengths_fixed,
+                                       lengths, rs)
+
+    """get_target_lengths_fixed() without the monitor."""
+    def __get_target_lengths_fixed(self, lengths, rs):
+        lengths = numpy.asarray(lengths, dtype=numpy.intp)
+        if (lengths.size == 0):
+            return numpy.empty(lengths.shape, dtype=numpy.intp)
+
+        if ((lengths.min() < 1) or (lengths.max() > self.size)):
+            raise ValueError("You requested columns in [%d,%d] " \
+                             "of matrix of size '%s'." %
+                             (lengths.min(), lengths.max(), self.size))
+
+        if (rs is None):
+            rs = numpy.random.randint(0, FIXED_POINT_ONE, size=lengths.shape,
+                                      dtype=numpy.uint64)
+        else:
+            rs = numpy.asarray(rs)
+            if (rs.shape != lengths.shape):
+                raise ValueError("'rs' and 'lengths' have different " \
+                                 "shapes (%s:%s)." % (rs.shape, lengths.shape))
+            if ((rs.min() < 0) or (rs.max() >= FIXED_POINT_ONE)):
+                raise ValueError("Some values of 'rs' are unacceptable!")
+            rs = rs.astype(numpy.uint64)
+
+        cols = lengths - 1
+        if (not numpy.all(self.__batch_counts[cols])):
+            raise ValueError("Some requested columns of the morphing " \
+                             "matrix are empty.")
+
+        if (self.__batch_thresholds is None):
+            self.__build_fixed_tables()
+
+        # Like get_target_lengths(), with the thresholds of column 'j'
+        # shifted by 'j' << FIXED_POINT_SHIFT into a single sorted array.
+        keys = (cols.astype(numpy.uint64) << numpy.uint64(FIXED_POINT_SHIFT)) | rs
+        k = numpy.searchsorted(self.__batch_thresholds, keys, side='right')
 
-        return self.__sample_target_size(column, rand)
+        return self.__batch_rows[k] + 1
+
+    """Public function.
+    Given 'lengths', a NumPy array of source packet lengths that we
+    want to morph, return a NumPy array with their target packet
+    lengths according to the morphing matrix.
+    If 'rands' is given, it must be an array of the same shape as
+    'lengths' with numbers \in [0,1], which are used instead of
+    generating random numbers. Up to rounding, a length and its 'rand'
+    map to the same target length as with SAMPLER_BISECT.
+
+    All packets are sampled in one vectorized pass, whatever the
+    sampler of the matrix is.
+    """
+    def get_target_lengths(self, lengths, rands=None):
+        if (self.monitor is None):
+            return self.__get_target_lengths(lengths, rands)
+        return self.monitor.call_batch(self.__get_target_lengths,
+                                       lengths, rands)
+
+    """get_target_lengths() without the monitor."""
+    def __get_target_lengths(self, lengths, rands):
+        lengths = numpy.asarray(lengths, dtype=numpy.intp)
+        if (lengths.size == 0):
+            return numpy.empty(lengths.shape, dtype=numpy.intp)
+
+        if ((lengths.min() < 1) or (lengths.max() > self.size)):
+            raise ValueError("You requested columns in [%d,%d] " \
+                             "of matrix of size '%s'." %
+                             (lengths.min(), lengths.max(), self.size))
+
+        if (rands is None):
+            rands = numpy.random.random_sample(lengths.shape)
+        else:
+            rands = numpy.asarray(rands, dtype=numpy.double)
+            if (rands.shape != lengths.shape):
+                raise ValueError("'rands' and 'lengths' have different " \
+                                 "shapes (%s:%s)." % (rands.shape, lengths.shape))
+            if (not numpy.all((rands >= 0) & (rands <= 1))):
+                raise ValueError("Some values of 'rands' are unacceptable!")
+
+        cols = lengths - 1
+        if (not numpy.all(self.__batch_counts[cols])):
+            raise ValueError("Some requested columns of the morphing " \
+                             "matrix are empty.")
+
+        # First entry of each column whose CDF value passes 'rand'. If
+        # 'rand' is 1, that's the first entry of the next column, so
+        # clamp to the last entry of the column.
+        k = numpy.searchsorted(self.__batch_cdf, cols + rands, side='right')
+        k = numpy.minimum(k, self.__batch_last[cols])
+
+        return self.__batch_rows[k] + 1
 
     """Public function.
     Given 's_len', the packet length of a source packet that we want
@@ -97,12 +376,128 @@ class MorphingMatrix:
         for pot in potential:
             print "\t%d bytes with probability %s" % (pot[0], pot[1])
 
-    """Make sure that our morphing matrix indeed looks like one."""
+    """Make sure that our morphing matrix indeed looks like one: all
+    its columns should describe valid probability mass functions. This
+    is one vectorized pass over its CSC arrays."""
     def __validate(self):
-        # all columns should describe valid probability mass functions.
-        for i in xrange(1,self.size+1):
-            col = self.__get_matrix_column(i)
-            assert(Decimal(0.99999) < Decimal(math.fsum(col)) < Decimal(1.00001))
+        csc = self.matrix.tocsc()
+        data = numpy.asarray(csc.data, dtype=numpy.double)
+
+        if ((not numpy.all(numpy.isfinite(data))) or numpy.any(data < 0)):
+            raise ValueError("Morphing matrix has negative or " \
+                             "non-finite entries.")
+
+        cols = numpy.repeat(numpy.arange(self.size), numpy.diff(csc.indptr))
+        sums = numpy.bincount(cols, weights=data, minlength=self.size)
+        bad = numpy.flatnonzero(numpy.abs(sums - 1) >= COLUMN_SUM_TOLERANCE)
+        if (len(bad)):
+            raise ValueError("Column '%d' of the morphing matrix sums up " \
+                             "to %s instead of 1." % (bad[0] + 1, sums[bad[0]]))
+
+    """Precompute the sampling tables of the morphing matrix.
+
+    All tables are laid out like the CSC arrays of the matrix: the
+    entries of column 'j' live in [indptr[j], indptr[j+1]).
+    'self.__rows' holds the (zero-based) row of each entry, 'self.__cdf'
+    the CDF of get_cdf() and 'self.__alias_prob' and
+    'self.__alias_rows' the per-column Walker/Vose alias tables.
+    'self.__thresholds' holds the fixed-point thresholds of
+    get_thresholds() and 'self.__batch_thresholds' the same shifted by
+    their column; both are only built by __build_fixed_tables().
+    The 'self.__batch_*' NumPy arrays are used by get_target_lengths()
+    and get_target_lengths_fixed().
+
+    If a precomputed 'cdf' is given, the tables with one entry per
+    non-zero entry are the (possibly memory-mapped) arrays of the
+    matrix, which are not copied. Otherwise, they are Python lists,
+    which are faster to index. The same goes for 'thresholds'.
+    """
+    def __build_tables(self, cdf, thresholds):
+        csc = self.matrix.tocsc()
+
+        if (cdf is None):
+            if (not csc.has_sorted_indices):
+                csc = csc.sorted_indices()
+            cdf = get_cdf(csc)
+            self.__indptr = csc.indptr.tolist()
+            self.__rows = csc.indices.tolist()
+            self.__cdf = cdf.tolist()
+        else:
+            # The CDF is laid out like the arrays of 'matrix'.
+            if (len(cdf) != csc.nnz):
+                raise ValueError("CDF has the wrong size (%d:%d)." %
+                                 (len(cdf), csc.nnz))
+            self.__indptr = csc.indptr.tolist()
+            self.__rows = csc.indices
+            self.__cdf = cdf
+
+        if ((thresholds is not None) and (len(thresholds) != csc.nnz)):
+            raise ValueError("Thresholds have the wrong size (%d:%d)." %
+                             (len(thresholds), csc.nnz))
+        self.__csc = csc
+        self.__thresholds = thresholds
+        self.__batch_thresholds = None
+        if (self.sampler == SAMPLER_FIXED):
+            self.__build_fixed_tables()
+
+        indptr = csc.indptr
+        self.__batch_cdf = cdf
+        self.__batch_last = indptr[1:] - 1
+        self.__batch_counts = numpy.diff(indptr)
+        self.__batch_rows = csc.indices
+
+        if (self.sampler == SAMPLER_ALIAS):
+            data = numpy.asarray(csc.data, dtype=numpy.double)
+            self.__alias_prob = [1.0] * len(data)
+            self.__alias_rows = list(self.__rows)
+            for j in xrange(self.size):
+                self.__build_alias_column(data, indptr[j], indptr[j+1])
+
+    """Build the fixed-point sampling tables (see __build_tables()),
+    from the thresholds given to the constructor if any. They take an
+    nnz-sized copy even of memory-mapped thresholds, so unless the
+    sampler is SAMPLER_FIXED they're only built the first time a
+    fixed-point sampling function is called."""
+    def __build_fixed_tables(self):
+        csc = self.__csc
+        thresholds = self.__thresholds
+        if (thresholds is None):
+            thresholds = get_thresholds(csc)
+            self.__thresholds = thresholds.tolist()
+
+        # Set last, since other threads check it to tell if the tables
+        # are built.
+        self.__batch_thresholds = thresholds | numpy.repeat(
+            numpy.arange(self.size, dtype=numpy.uint64) <<
+            numpy.uint64(FIXED_POINT_SHIFT), numpy.diff(csc.indptr))
+
+    """Fill in the alias table entries of the column spanning
+    [lo, hi) of the CSC arrays, using Vose's method."""
+    def __build_alias_column(self, data, lo, hi):
+        n = hi - lo
+        total = math.fsum(data[lo:hi])
+        if ((n == 0) or (total <= 0)):
+            return
+
+        scaled = [p * n / total for p in data[lo:hi]]
+        small = [k for k in xrange(n) if (scaled[k] < 1.0)]
+        large = [k for k in xrange(n) if (scaled[k] >= 1.0)]
+
+        while (small and large):
+            s = small.pop()
+            l = large.pop()
+            self.__alias_prob[lo+s] = scaled[s]
+            self.__alias_rows[lo+s] = self.__rows[lo+l]
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if (scaled[l] < 1.0):
+                small.append(l)
+            else:
+                large.append(l)
+
+        # Whatever is left over should have probability 1; any
+        # difference is floating point noise.
+        for k in small + large:
+            self.__alias_prob[lo+k] = 1.0
 
     """
     Given a morphing matrix 'column' as a list, and a 'rand'
@@ -110,6 +505,8 @@ class MorphingMatrix:
     If 'rand' is None, we generate a random number on the fly.
     """
     def __sample_target_size(self, column, rand):
+        from decimal import Decimal
+
         assert(len(column) == self.size)
         cdf = 0
         i = 0
@@ -142,11 +539,263 @@ class MorphingMatrix:
 
         return col
 
+"""A thread-safe sampler of a MorphingMatrix.
+
+A MorphingMatrix is never modified after it's built, so one of them
+(and its tables) can be shared by any number of threads. A Sampler
+gives every thread that uses it its own random number generators, so
+threads can share a Sampler without contending on a lock:
+
+    sampler = Sampler(mm, seed=42)
+    # in any thread:
+    sampler.get_target_length(85)
+    sampler.get_target_lengths(lengths)
+
+'matrix' is a MorphingMatrix. If 'seed' is given, the generators of
+the n-th thread to use the sampler are seeded with ('seed', n);
+otherwise they are seeded from the OS.
+"""
+class Sampler:
+    def __init__(self, matrix, seed=None):
+        self.matrix = matrix
+        self.seed = seed
+        self.__local = threading.local()
+        self.__threads = itertools.count()
+
+    """Return the (random.Random, numpy.random.RandomState) pair of
+    the calling thread, creating it on its first call."""
+    def __get_rngs(self):
+        try:
+            return self.__local.rngs
+        except AttributeError:
+            pass
+
+        if (self.seed is None):
+            rngs = (random.Random(), numpy.random.RandomState())
+        else:
+            # itertools.count() is atomic under the GIL
+            seed = (self.seed, next(self.__threads))
+            rngs = (random.Random(seed), numpy.random.RandomState(seed))
+        self.__local.rngs = rngs
+        return rngs
+
+    """Public function.
+    Like MorphingMatrix.get_target_length(), with the random number
+    drawn from the generator of the calling thread. With SAMPLER_FIXED,
+    that's a random integer for get_target_length_fixed()."""
+    def get_target_length(self, s_len):
+        if (self.matrix.sampler == SAMPLER_FIXED):
+            r = self.__get_rngs()[0].getrandbits(FIXED_POINT_BITS)
+            return self.matrix.get_target_length_fixed(s_len, r)
+        rand = self.__get_rngs()[0].random()
+        return self.matrix.get_target_length(s_len, rand)
+
+    """Public function.
+    Like MorphingMatrix.get_target_lengths(), with the random numbers
+    drawn from the generator of the calling thread. With SAMPLER_FIXED,
+    those are random integers for get_target_lengths_fixed()."""
+    def get_target_lengths(self, lengths):
+        lengths = numpy.asarray(lengths)
+        if (self.matrix.sampler == SAMPLER_FIXED):
+            rs = self.__get_rngs()[1].randint(0, FIXED_POINT_ONE,
+                                              size=lengths.shape,
+                                              dtype=numpy.uint64)
+            return self.matrix.get_target_lengths_fixed(lengths, rs)
+        rands = self.__get_rngs()[1].random_sample(lengths.shape)
+        return self.matrix.get_target_lengths(lengths, rands)
+
+"""
+Given a morphing matrix 'csc' in sparse CSC form with sorted indices,
+return the running sums of its columns, laid out like its CSC arrays,
+divided by the total of their column (totals that aren't positive are
+taken as 1). Each column is summed in order, one entry after the
+other, like dream.c does.
+"""
+def get_normalized_cumsums(csc):
+    indptr = csc.indptr
+    data = numpy.asarray(csc.data, dtype=numpy.double)
+    size = len(indptr) - 1
+
+    cumsums = numpy.empty(len(data))
+    for j in xrange(size):
+        lo, hi = indptr[j], indptr[j+1]
+        numpy.cumsum(data[lo:hi], out=cumsums[lo:hi])
+
+    counts = numpy.diff(indptr)
+    totals = numpy.ones(size)
+    totals[counts > 0] = cumsums[indptr[1:][counts > 0] - 1]
+    totals[totals <= 0] = 1.0
+
+    return cumsums / numpy.repeat(totals, counts)
+
+"""
+Given a morphing matrix 'csc' in sparse CSC form with sorted indices,
+return its per-column CDFs as a NumPy array laid out like its CSC
+arrays. Each column's CDF is normalized to end at exactly 1 and is
+shifted by the (zero-based) column number, so that the CDFs of all
+columns form a single sorted array: the target length of source
+length 'j' with random number 'rand' is the row of the first entry of
+column 'j-1' whose CDF value is greater than 'j-1 + rand'.
+"""
+def get_cdf(csc):
+    counts = numpy.diff(csc.indptr)
+    return (get_normalized_cumsums(csc) +
+            numpy.repeat(numpy.arange(len(counts)), counts))
+
+"""
+Given a morphing matrix 'csc' in sparse CSC form with sorted indices,
+return its per-column CDFs in fixed point, as a NumPy array of uint64
+thresholds laid out like its CSC arrays: each normalized running sum
+times FIXED_POINT_ONE, rounded to the nearest integer. The thresholds
+of a column never decrease and its last one is exactly
+FIXED_POINT_ONE, so that entry 'k' of a column is sampled for
+FIXED_POINT_ONE * p_k random integers in [0, FIXED_POINT_ONE), with
+p_k rounded to a multiple of 2^-32. Entries that round to nothing are
+never sampled.
+"""
+def get_thresholds(csc):
+    thresholds = numpy.floor(get_normalized_cumsums(csc) * FIXED_POINT_ONE +
+                             0.5).astype(numpy.uint64)
+    counts = numpy.diff(csc.indptr)
+    thresholds[csc.indptr[1:][counts > 0] - 1] = FIXED_POINT_ONE
+    return thresholds
+
+"""Return the offsets of the row indices, values, CDF and thresholds
+arrays of a binary morphing matrix file of 'version' with 'size'
+columns and 'entries' non-zero entries, and the length of the file.
+Version 1 files have no thresholds; their offset is None."""
+def get_binary_layout(size, entries, version=BINARY_VERSION):
+    off_row_inds = BINARY_HEADER.size + (size + 1) * 4
+    off_values = off_row_inds + entries * 4
+    off_values = (off_values + 7) & ~7 # align doubles
+    off_cdf = off_values + entries * 8
+    if (version == 1):
+        return (off_row_inds, off_values, off_cdf, None, off_cdf + entries * 8)
+    off_thresholds = off_cdf + entries * 8
+    return (off_row_inds, off_values, off_cdf, off_thresholds,
+            off_thresholds + entries * 8)
+
+"""
+Given a morphing 'matrix' as a SciPy sparse matrix, write it to file
+'fname' in the binary morphing matrix format (see the FAQ): a header,
+the CSC arrays, the per-column CDFs of get_cdf() and the fixed-point
+thresholds of get_thresholds(), with a checksum.
+"""
+def write_binary(matrix, fname):
+    csc = matrix.tocsc().sorted_indices()
+    csc.sum_duplicates()
+    size = csc.shape[0]
+    if (csc.shape[0] != csc.shape[1]):
+        raise ValueError("Matrix provided is not square (%d:%d)." %
+                         (csc.shape[0], csc.shape[1]))
+
+    off_row_inds, off_values, off_cdf, off_thresholds, length = \
+        get_binary_layout(size, csc.nnz)
+    padding = off_values - (off_row_inds + csc.nnz * 4)
+
+    chunks = [csc.indptr.astype("<i4").tostring(),
+              csc.indices.astype("<i4").tostring(),
+              "\0" * padding,
+              csc.data.astype("<f8").tostring(),
+              get_cdf(csc).astype("<f8").tostring(),
+              get_thresholds(csc).astype("<u8").tostring()]
+    crc = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+
+    with open(fname, "wb") as f:
+        f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, size,
+                                   csc.nnz, 0, crc & 0xffffffff, 0))
+        for chunk in chunks:
+            f.write(chunk)
+
+    assert(os.path.getsize(fname) == length)
+
+"""
+Given a filename 'fname' containing a binary morphing matrix (see
+write_binary()), return a (matrix, cdf, thresholds) triple: the matrix
+in sparse CSC form, its CDF (see get_cdf()) and its fixed-point
+thresholds (see get_thresholds(); None for version 1 files). Pass them
+all to MorphingMatrix().
+The arrays are read-only memory maps of the file, so nothing is parsed
+or copied, and processes loading the same file share its pages. They
+change if the file is rewritten in place, and reading them fails
+(with SIGBUS) if it's truncated, so replace such files by renaming a
+new file over them. If 'copy' is true, the file is read into memory
+instead, and the matrix stays as it was read.
+"""
+def read_binary(fname, copy=False):
+    if (copy):
+        buf = numpy.fromfile(fname, dtype=numpy.uint8)
+        length = len(buf)
+    else:
+        length = os.path.getsize(fname)
+    if (length < BINARY_HEADER.size):
+        raise ValueError("'%s' is too short." % (fname))
+
+    if (not copy):
+        buf = numpy.memmap(fname, dtype=numpy.uint8, mode="r")
+    magic, version, size, entries, _, crc, _ = \
+        BINARY_HEADER.unpack(buf[:BINARY_HEADER.size].tostring())
+    if ((magic != BINARY_MAGIC) or (not (1 <= version <= BINARY_VERSION))):
+        raise ValueError("'%s' is not a binary morphing matrix file " \
+                         "of version 1 to %d." % (fname, BINARY_VERSION))
+
+    off_row_inds, off_values, off_cdf, off_thresholds, expected = \
+        get_binary_layout(size, entries, version)
+    if (length != expected):
+        raise ValueError("'%s' has the wrong size (%d:%d)." %
+                         (fname, length, expected))
+    if ((zlib.crc32(buf[BINARY_HEADER.size:]) & 0xffffffff) != crc):
+        raise ValueError("'%s' is corrupted (bad checksum)." % (fname))
+    if (not copy):
+        buf = None # unmap it
+
+    # Map (or copy) each array on its own: SciPy copies arrays that are
+    # small views of a bigger one. Plain ndarray views are faster to
+    # index than memmaps.
+    def get_array(dtype, offset, count):
+        if (copy):
+            dtype = numpy.dtype(dtype)
+            return buf[offset:offset+count*dtype.itemsize].view(dtype).copy()
+        return numpy.memmap(fname, dtype=dtype, mode="r", offset=offset,
+                            shape=(count,)).view(numpy.ndarray)
+
+    indptr = get_array("<i4", BINARY_HEADER.size, size + 1)
+    indices = get_array("<i4", off_row_inds, entries)
+    data = get_array("<f8", off_values, entries)
+    cdf = get_array("<f8", off_cdf, entries)
+    thresholds = None
+    if (off_thresholds is not None):
+        thresholds = get_array("<u8", off_thresholds, entries)
+
+    if ((indptr[0] != 0) or (indptr[-1] != entries) or
+        numpy.any(numpy.diff(indptr) < 0) or
+        numpy.any((indices < 0) | (indices >= size)) or
+        (not numpy.all(data >= 0))):
+        raise ValueError("'%s' does not contain a valid " \
+                         "morphing matrix." % (fname))
+
+    csc = scipy.sparse.csc_matrix((data, indices, indptr),
+                                  shape=(size, size), copy=False)
+
+    return (csc, cdf, thresholds)
+
+"""
+Given a filename 'fname' containing a binary morphing matrix, return
+that matrix in sparse CSC form. Use read_binary() to also get its
+precomputed CDF and thresholds.
+"""
+def get_csc_from_binary(fname):
+    return read_binary(fname)[0]
+
 """
 Given a filename 'fname' containing a sparse matrix in Matrix Market
 format, return that matrix in sparse CSC form.
 """
 def get_csc_from_mm(fname):
+    import scipy.io # slow to import, and not needed for binary files
+
     mat = scipy.io.mmread(fname)
     if (type(mat) is not scipy.sparse.coo_matrix):
         raise ValueError("'%s' does not contain a sparse " \
@@ -154,6 +803,22 @@ def get_csc_from_mm(fname):
 
     return mat.tocsc()
 
+"""
+Given a filename 'fname' containing a morphing matrix, either binary
+(see write_binary()) or in Matrix Market format, return a
+MorphingMatrix of it using 'sampler'. Binary files are used in place
+unless 'copy' is true (see read_binary()).
+"""
+def get_morphing_matrix_from_file(fname, sampler=SAMPLER_BISECT, copy=False):
+    with open(fname, "rb") as f:
+        magic = f.read(len(BINARY_MAGIC))
+
+    if (magic == BINARY_MAGIC):
+        csc, cdf, thresholds = read_binary(fname, copy)
+        return MorphingMatrix(csc, sampler, cdf=cdf, thresholds=thresholds)
+
+    return MorphingMatrix(get_csc_from_mm(fname), sampler)
+
 if __name__ != "__main__":
     if (sys.hexversion < 0x02070000):
         raise RuntimeError("This library is only useful with " \
@@ -0,0 +1,290 @@
+import sys
+import time
+import threading
+import numpy
+
+"""
+Runtime instrumentation of the sampling of a dream.MorphingMatrix,
+cheap enough to leave on in production.
+
+    mm = dream.get_morphing_matrix_from_file("mm.bin")
+    mm.monitor = Monitor(mm.size, target=distr.get_distr_from_file(
+                                      "data/https_cs_distr.txt"))
+    ...
+    snapshot = mm.monitor.snapshot()
+    divergence = mm.monitor.get_divergence()
+
+Once 'mm.monitor' is set, one in every 'sample_every' calls of the
+sampling functions of 'mm' is recorded:
+
+    * 'hits': how many packets of each source length were sampled,
+              i.e. how often each column of the matrix was used.
+
+    * 'targets': the histogram of the target lengths emitted.
+
+    * 'latency': how long the recorded calls took, in buckets of
+              powers of two nanoseconds (see LATENCY_BUCKETS).
+
+    * 'padding_bytes' and 'split_bytes': the bytes of padding that the
+              target lengths add to the source packets that grow, and
+              the bytes that have to be split off the ones that shrink.
+
+Since the recorded calls are a uniform sample of all calls, the
+histograms have the shape they would have if every call was recorded.
+get_divergence() compares 'targets' to the target distribution that
+the matrix is supposed to morph into, to tell if the morphed traffic
+drifted away from it (e.g. because the source traffic doesn't look
+like the source distribution of the matrix anymore).
+
+Every thread records into its own counters, without locking;
+snapshot() adds up the counters of all threads. A snapshot taken while
+other threads sample may miss their calls in progress. The counters of
+threads that exited are added to a common total and dropped, so a
+thread per connection doesn't make the Monitor grow (threads not
+started with the threading module never count as exited, though).
+"""
+
+# 'latency[k]' counts the calls that took [2^(k-1), 2^k) nanoseconds
+# (0 ns for k = 0); the last bucket also counts all slower calls. Like
+# DREAM_STATS_LATENCY_BUCKETS of dream.c.
+LATENCY_BUCKETS = 32
+
+DEFAULT_SAMPLE_EVERY = 16
+
+# The counters of a ThreadStats that snapshot() adds up.
+COUNTERS = ("calls", "recorded_calls", "packets", "padding_bytes",
+            "split_bytes", "hits", "targets", "latency", "latency_seconds")
+
+# Look for exited threads when this many threads have counters
+# (and then when twice as many as were left the last time).
+MIN_SWEEP_THREADS = 64
+
+"""The counters of a Monitor that a single thread records into."""
+class ThreadStats:
+    def __init__(self, size):
+        self.calls = 0
+        self.countdown = 1 # calls until the next recorded one
+        self.recorded_calls = 0
+        self.packets = 0
+        self.padding_bytes = 0
+        self.split_bytes = 0
+        self.hits = numpy.zeros(size, dtype=numpy.int64)
+        self.targets = numpy.zeros(size, dtype=numpy.int64)
+        self.latency = numpy.zeros(LATENCY_BUCKETS, dtype=numpy.int64)
+        self.latency_seconds = 0.0
+
+    """Add the counters of the ThreadStats 'other' to these ones."""
+    def add(self, other):
+        for key in COUNTERS:
+            setattr(self, key, getattr(self, key) + getattr(other, key))
+
+    """Record the latency of a call that took 'seconds'."""
+    def record_latency(self, seconds):
+        self.recorded_calls += 1
+        self.latency_seconds += seconds
+        bucket = int(seconds * 1e9).bit_length()
+        self.latency[min(bucket, LATENCY_BUCKETS - 1)] += 1
+
+"""
+Collects statistics of the sampling of a MorphingMatrix (see the
+module docs).
+
+'size' is the size of the matrix and 'target', if given, the target
+probability distribution it morphs into (a NumPy array, element 'i'
+being the probability of length 'i+1'), for get_divergence().
+One in every 'sample_every' calls of each thread is recorded.
+"""
+class Monitor:
+    def __init__(self, size, target=None, sample_every=DEFAULT_SAMPLE_EVERY):
+        if (sample_every <= 0):
+            raise ValueError("'sample_every' must be positive (%d)." %
+                             (sample_every))
+        if ((target is not None) and (len(target) != size)):
+            raise ValueError("Target distribution and matrix have " \
+                             "different sizes (%d:%d)." % (len(target), size))
+        self.size = size
+        self.target = target
+        self.sample_every = sample_every
+
+        self.__local = threading.local()
+        # Guards 'self.__threads', 'self.__exited' and 'self.__sweep_at'.
+        self.__lock = threading.Lock()
+        self.__threads = [] # (thread, ThreadStats) pairs
+        self.__exited = ThreadStats(size) # counters of the exited threads
+        self.__sweep_at = MIN_SWEEP_THREADS
+
+    """Return the ThreadStats of the calling thread, creating it on
+    its first call."""
+    def __get_stats(self):
+        try:
+            return self.__local.stats
+        except AttributeError:
+            pass
+
+        stats = ThreadStats(self.size)
+        with self.__lock:
+            self.__threads.append((threading.current_thread(), stats))
+            if (len(self.__threads) >= self.__sweep_at):
+                self.__sweep()
+                self.__sweep_at = max(2 * len(self.__threads),
+                                      MIN_SWEEP_THREADS)
+        self.__local.stats = stats
+        return stats
+
+    """Add the counters of the threads that exited to 'self.__exited'
+    and forget them. Exited threads don't record anymore, so their
+    counters are final. Call with 'self.__lock' held."""
+    def __sweep(self):
+        alive = []
+        for (thread, stats) in self.__threads:
+            if (thread.is_alive()):
+                alive.append((thread, stats))
+            else:
+                self.__exited.add(stats)
+        self.__threads = alive
+
+    """Return whether the next call of the calling thread is to be
+    recorded, and its ThreadStats."""
+    def __next_call(self):
+        stats = self.__get_stats()
+        stats.calls += 1
+        stats.countdown -= 1
+        if (stats.countdown):
+            return (False, stats)
+        stats.countdown = self.sample_every
+        return (True, stats)
+
+    """Public function.
+    Return func(s_len, rand), the target length of source length
+    's_len', recording the call if its turn has come."""
+    def call(self, func, s_len, rand):
+        (record, stats) = self.__next_call()
+        if (not record):
+            return func(s_len, rand)
+
+        start = time.time()
+        t_len = func(s_len, rand)
+        stats.record_latency(time.time() - start)
+
+        stats.packets += 1
+        stats.hits[s_len-1] += 1
+        stats.targets[t_len-1] += 1
+        if (t_len > s_len):
+            stats.padding_bytes += t_len - s_len
+        else:
+            stats.split_bytes += s_len - t_len
+        return t_len
+
+    """Public function.
+    Like call(), for func(lengths, rands) that returns the target
+    lengths of a NumPy array of source 'lengths'."""
+    def call_batch(self, func, lengths, rands):
+        (record, stats) = self.__next_call()
+        if (not record):
+            return func(lengths, rands)
+
+        start = time.time()
+        t_lens = func(lengths, rands)
+        stats.record_latency(time.time() - start)
+
+        s_lens = numpy.asarray(lengths).ravel()
+        t_flat = t_lens.ravel()
+        stats.packets += s_lens.size
+        stats.hits += numpy.bincount(s_lens - 1, minlength=self.size)
+        stats.targets += numpy.bincount(t_flat - 1, minlength=self.size)
+        diff = t_flat - s_lens
+        stats.padding_bytes += int(diff[diff > 0].sum())
+        stats.split_bytes += int(-diff[diff < 0].sum())
+        return t_lens
+
+    """Public function.
+    Return the statistics of all threads so far as a dict (see the
+    module docs). 'hits' and 'targets' are NumPy arrays, element 'i'
+    being for length 'i+1'. 'calls' counts all the calls, recorded or
+    not, and 'packets' the packets of the recorded ones. 'threads' is
+    how many live threads have counters."""
+    def snapshot(self):
+        total = ThreadStats(self.size)
+        with self.__lock:
+            self.__sweep()
+            total.add(self.__exited)
+            for (thread, stats) in self.__threads:
+                total.add(stats)
+            threads = len(self.__threads)
+
+        snapshot = {"sample_every": self.sample_every, "threads": threads}
+        for key in COUNTERS:
+            snapshot[key] = getattr(total, key)
+        return snapshot
+
+    """Public function.
+    Zero the statistics of all threads. Calls recorded while resetting
+    may be partly lost."""
+    def reset(self):
+        with self.__lock:
+            self.__threads = []
+            self.__exited = ThreadStats(self.size)
+            self.__sweep_at = MIN_SWEEP_THREADS
+            # Threads start over with fresh counters on their next call.
+            self.__local = threading.local()
+
+    """Public function.
+    Compare the histogram of the target lengths emitted so far with
+    the target distribution ('target', or the one given to the
+    Monitor), and return a dict with:
+
+        'packets': how many target lengths the histogram has.
+        'chi2', 'dof', 'p_value': Pearson's chi-square statistic of
+                  the histogram against the target distribution, its
+                  degrees of freedom and its p-value, over the lengths
+                  that the target distribution can give.
+        'kl': the Kullback-Leibler divergence of the target
+                  distribution from the histogram, in bits (infinite
+                  if lengths outside the target distribution were
+                  emitted).
+        'outside_support': how many target lengths were emitted that
+                  the target distribution never gives.
+
+    Raise ValueError if there's no target distribution or no target
+    lengths were recorded yet.
+    """
+    def get_divergence(self, target=None):
+        if (target is None):
+            target = self.target
+        if (target is None):
+            raise ValueError("No target distribution to compare with.")
+        target = numpy.asarray(target, dtype=numpy.double)
+        if (len(target) != self.size):
+            raise ValueError("Target distribution and matrix have " \
+                             "different sizes (%d:%d)." %
+                             (len(target), self.size))
+
+        observed = self.snapshot()["targets"].astype(numpy.double)
+        packets = observed.sum()
+        if (not packets):
+            raise ValueError("No target lengths were recorded yet.")
+        target = target / target.sum()
+
+        support = target > 0
+        expected = target[support] * packets
+        chi2 = float((((observed[support] - expected) ** 2) / expected).sum())
+        dof = int(support.sum()) - 1
+        outside = int(observed[~support].sum())
+
+        seen = observed > 0
+        p = observed[seen] / packets
+        if (outside):
+            kl = float("inf")
+        else:
+            kl = float((p * numpy.log2(p / target[seen])).sum())
+
+        import scipy.stats # only needed here
+        p_value = float(scipy.stats.chi2.sf(chi2, dof)) if (dof > 0) else 1.0
+
+        return {"packets": int(packets), "chi2": chi2, "dof": dof,
+                "p_value": p_value, "kl": kl, "outside_support": outside}
+
+if __name__ != "__main__":
+    if (sys.hexversion < 0x02070000):
+        raise RuntimeError("This library is only useful with " \
+                           "a Python version >= 2.7.")
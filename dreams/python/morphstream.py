@@ -0,0 +1,236 @@
+import sys
+import struct
+import select
+import time
+import numpy
+
+"""
+Streaming traffic morphing on top of dream.MorphingMatrix.
+
+Morpher turns payloads (e.g. the data of each read from a client
+socket) into morphed frames, with the same policy as
+analysis/simulate.py: the first target length of a payload comes from
+its morphing matrix column. If the payload doesn't fit, it's split, and
+the target lengths of the rest come from the target distribution.
+
+Each frame is a HEADER with the length of the payload chunk it carries
+and the length of its padding, followed by the chunk and the zero
+padding, so that the whole frame, HEADER included, takes exactly the
+target length on the wire. A frame thus carries at most the target
+length minus HEADER.size payload bytes. Target lengths shorter than
+HEADER.size can't hold a frame at all; they are replaced by the next
+target length from the target distribution, and counted in
+'stats'. Deframer recovers the payload stream from the frames.
+
+Morpher does no I/O itself: it lays out the frames of a batch of
+payloads in one bytearray, copying each payload once, and the caller
+sends memoryview slices of it. morph_socket() is a blocking pump
+between two sockets built on it:
+
+    mm = dream.get_morphing_matrix_from_file("mm.bin")
+    morpher = Morpher(mm, distr.get_distr_from_file("https_cs_distr.txt"))
+    morph_socket(client, server, morpher)
+
+and on the other side:
+
+    deframer = Deframer()
+    payload = deframer.feed(server.recv(65536))
+"""
+
+# payload chunk length, padding length (network byte order)
+HEADER = struct.Struct("!HH")
+
+# How many target lengths to draw from the target distribution at a time.
+PREFETCH = 1024
+
+# How many payloads to morph together at most.
+DEFAULT_BATCH = 64
+
+"""Morphs payloads into frames.
+
+'matrix' is a dream.MorphingMatrix and 'target' the target probability
+distribution it morphs into (a NumPy array, element 'i' being the
+probability of length 'i+1'). 'seed' seeds the random number generator
+of the morpher. A Morpher is meant to be used by a single thread, e.g.
+one per connection; they can all share 'matrix'.
+
+'self.stats' counts the payloads, frames, payload bytes, padding bytes,
+splits and target lengths too short for a frame ('short_targets')
+morphed so far.
+"""
+class Morpher:
+    def __init__(self, matrix, target, seed=None):
+        if (len(target) != matrix.size):
+            raise ValueError("Target distribution and matrix have " \
+                             "different sizes (%d:%d)." %
+                             (len(target), matrix.size))
+        if (not numpy.any(numpy.asarray(target)[HEADER.size:] > 0)):
+            raise ValueError("The target distribution has no lengths " \
+                             "that can carry payload after a %d byte " \
+                             "header." % (HEADER.size))
+        self.matrix = matrix
+
+        cdf = numpy.cumsum(target)
+        self.__cdf = cdf / cdf[-1]
+        self.__rng = numpy.random.RandomState(seed)
+        self.__targets = []
+
+        self.stats = {"payloads" : 0, "frames" : 0, "payload_bytes" : 0,
+                      "padding_bytes" : 0, "splits" : 0,
+                      "short_targets" : 0}
+
+    """Return a target length drawn from the target distribution.
+    They are drawn PREFETCH at a time."""
+    def __next_target(self):
+        if (not self.__targets):
+            k = numpy.searchsorted(self.__cdf,
+                                   self.__rng.random_sample(PREFETCH),
+                                   side='right')
+            self.__targets = (numpy.minimum(k, len(self.__cdf) - 1) + 1).tolist()
+        return self.__targets.pop()
+
+    """Public function.
+    Given a list of payload 'lengths' (each in [1, matrix.size]),
+    return the list of frames of each, as (chunk length, padding
+    length) pairs; each frame takes HEADER.size + chunk length +
+    padding length bytes, which is its target length. The first
+    target lengths of all the payloads are sampled from the matrix at
+    once."""
+    def get_frames(self, lengths):
+        firsts = self.matrix.get_target_lengths(
+            lengths, self.__rng.random_sample(len(lengths))).tolist()
+
+        frames = []
+        for length, target in zip(lengths, firsts):
+            payload_frames = []
+            while (True):
+                room = target - HEADER.size # payload bytes the frame fits
+                if (room >= length):
+                    break
+                if (room >= 0):
+                    payload_frames.append((room, 0))
+                    length -= room
+                else:
+                    self.stats["short_targets"] += 1
+                target = self.__next_target()
+            payload_frames.append((length, room - length))
+            frames.append(payload_frames)
+
+        return frames
+
+    """Public function.
+    Given a list of 'payloads' (objects supporting the buffer
+    interface, e.g. memoryviews, each of 1 to matrix.size bytes), return
+    a (buffer, ends) pair: a bytearray with the frames of all the
+    payloads, in order, and a list with the offset where each frame
+    ends in it."""
+    def morph(self, payloads):
+        payloads = [memoryview(payload) for payload in payloads]
+        frames = self.get_frames([len(payload) for payload in payloads])
+
+        size = sum(HEADER.size + chunk + padding
+                   for payload_frames in frames
+                   for (chunk, padding) in payload_frames)
+        buf = bytearray(size) # zeroed, so padding costs nothing
+        view = memoryview(buf)
+        ends = []
+
+        offset = 0
+        for payload, payload_frames in zip(payloads, frames):
+            pos = 0
+            for (chunk, padding) in payload_frames:
+                HEADER.pack_into(buf, offset, chunk, padding)
+                offset += HEADER.size
+                view[offset:offset+chunk] = payload[pos:pos+chunk]
+                offset += chunk + padding
+                pos += chunk
+                ends.append(offset)
+
+                self.stats["padding_bytes"] += padding
+            self.stats["splits"] += len(payload_frames) - 1
+            self.stats["payload_bytes"] += pos
+        self.stats["payloads"] += len(payloads)
+        self.stats["frames"] += len(ends)
+
+        return (buf, ends)
+
+"""Recovers the payload stream from a stream of frames.
+If 'frame_lengths' is a list, the length of every complete frame,
+HEADER included, is appended to it."""
+class Deframer:
+    def __init__(self, frame_lengths=None):
+        self.__buf = bytearray()
+        self.frame_lengths = frame_lengths
+
+    """Public function.
+    Given the next 'data' received from the stream of frames, return
+    the payload bytes of all the frames it completes, as a string."""
+    def feed(self, data):
+        self.__buf.extend(data)
+        buf = self.__buf
+        payload = []
+
+        pos = 0
+        while (len(buf) - pos >= HEADER.size):
+            chunk, padding = HEADER.unpack_from(buf, pos)
+            end = pos + HEADER.size + chunk + padding
+            if (end > len(buf)):
+                break
+            payload.append(buf[pos+HEADER.size:pos+HEADER.size+chunk])
+            if (self.frame_lengths is not None):
+                self.frame_lengths.append(end - pos)
+            pos = end
+
+        del buf[:pos]
+        return str(bytearray().join(payload))
+
+    """Public function.
+    Return how many bytes of incomplete frames are buffered."""
+    def pending(self):
+        return len(self.__buf)
+
+"""
+Public function.
+Read payloads from socket 'src' until EOF, morph them with 'morpher'
+and send the frames to socket 'dst', one send per frame. Whatever is
+readable from 'src' without blocking is morphed together, up to
+'batch' payloads at a time; each payload is at most the size of the
+matrix. If 'latencies' is a list, append the seconds between
+receiving each payload and sending its last frame to it.
+"""
+def morph_socket(src, dst, morpher, batch=DEFAULT_BATCH, latencies=None):
+    size = morpher.matrix.size
+    bufs = [bytearray(size) for i in xrange(batch)]
+
+    eof = False
+    while (not eof):
+        payloads = []
+        received = []
+        while (len(payloads) < batch):
+            if (payloads and (not select.select([src], [], [], 0)[0])):
+                break
+            n = src.recv_into(bufs[len(payloads)], size)
+            if (n == 0):
+                eof = True
+                break
+            payloads.append(memoryview(bufs[len(payloads)])[:n])
+            received.append(time.time())
+
+        if (not payloads):
+            break
+
+        buf, ends = morpher.morph(payloads)
+        view = memoryview(buf)
+        start = 0
+        for end in ends:
+            dst.sendall(view[start:end])
+            start = end
+
+        if (latencies is not None):
+            sent = time.time()
+            latencies.extend(sent - t for t in received)
+
+if __name__ != "__main__":
+    if (sys.hexversion < 0x02070000):
+        raise RuntimeError("This library is only useful with " \
+                           "a Python version >= 2.7.")
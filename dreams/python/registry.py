@@ -0,0 +1,241 @@
+import sys
+import os
+import threading
+import collections
+
+import dream
+
+"""
+A registry of the morphing matrices of a long-running process, which
+can be replaced without restarting it.
+
+Matrices are keyed by protocol pair and direction, e.g.
+(("tor", "https"), "cs"). Samplers lease the current matrix of a key
+for as long as they use it:
+
+    registry = MatrixRegistry(capacity=16)
+    registry.register((("tor", "https"), "cs"), "tor_https_cs.bin")
+
+    with registry.lease((("tor", "https"), "cs")) as mm:
+        mm.get_target_length(85)
+
+To roll out a new matrix, reload() loads and validates it in a
+background thread and then swaps it in atomically. Leases taken before
+the swap keep using the old matrix until they end; new ones get the
+new matrix. If the new matrix can't be loaded, the old one stays.
+
+Binary matrix files are read into memory rather than used in place
+from memory maps (see dream.read_binary()), so that rewriting a file
+in place can't change, or crash, the matrices leased from it. With
+'copy=False', they are mapped, which saves memory and shares pages
+between processes; then a new matrix must always be written to a
+temporary file and renamed over the old one (os.rename()), never
+rewritten in place.
+
+At most 'capacity' matrices stay loaded. When more are needed, the
+least recently leased ones that aren't leased right now are evicted;
+they're loaded again from their file the next time they're leased.
+"""
+
+DEFAULT_CAPACITY = 32
+
+"""A loaded morphing matrix of a key, and how many leases use it."""
+class Entry:
+    def __init__(self, matrix, fname, stamp):
+        self.matrix = matrix
+        self.fname = fname
+        self.stamp = stamp # file (mtime, size) when loaded
+        self.refs = 0
+
+"""A lease of the matrix of an Entry. Use it as a context manager, or
+call release() when done with 'self.matrix'."""
+class Lease:
+    def __init__(self, registry, entry):
+        self.matrix = entry.matrix
+        self.__registry = registry
+        self.__entry = entry
+
+    def __enter__(self):
+        return self.matrix
+
+    def __exit__(self, *exc):
+        self.release()
+
+    """Public function.
+    End the lease. Releasing more than once does nothing."""
+    def release(self):
+        if (self.__entry is not None):
+            self.__registry._release(self.__entry)
+            self.__entry = None
+
+"""Return the (mtime, size) of file 'fname', to tell if it changed."""
+def get_stamp(fname):
+    st = os.stat(fname)
+    return (st.st_mtime, st.st_size)
+
+"""
+Holds the morphing matrices of a process (see the module docs).
+
+'capacity' is how many matrices may stay loaded at most; leased ones
+are never evicted, so there may be more while they're in use.
+'sampler' is the sampler of the MorphingMatrix objects (see dream.py).
+'on_error', if given, is called with (key, fname, exception) when a
+background reload fails.
+'copy' tells whether binary matrix files are read into memory (the
+default) or used in place (see the module docs).
+
+'self.stats' counts the 'loads', 'reloads', 'evictions' and failed
+reloads ('errors') so far.
+"""
+class MatrixRegistry:
+    def __init__(self, capacity=DEFAULT_CAPACITY, sampler=dream.SAMPLER_BISECT,
+                 on_error=None, copy=True):
+        if (capacity <= 0):
+            raise ValueError("Capacity must be positive (%d)." % (capacity))
+        self.capacity = capacity
+        self.sampler = sampler
+        self.on_error = on_error
+        self.copy = copy
+        self.stats = {"loads": 0, "reloads": 0, "evictions": 0, "errors": 0}
+
+        self.__lock = threading.Lock()
+        self.__entries = collections.OrderedDict() # LRU first
+        self.__files = {} # key -> filename, loaded or not
+        self.__reloading = {} # key -> thread
+
+    """Public function.
+    Register the morphing matrix file 'fname' for 'key' and load it
+    now. Raise ValueError (or IOError) if it can't be loaded."""
+    def register(self, key, fname):
+        entry = self.__load(fname)
+        with self.__lock:
+            self.__files[key] = fname
+            self.__install(key, entry)
+
+    """Public function.
+    Return a Lease of the current matrix of 'key', loading it first if
+    it was evicted. Raise KeyError if 'key' was never registered."""
+    def lease(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if (entry is not None):
+                self.__entries[key] = self.__entries.pop(key) # most recent
+                entry.refs += 1
+                return Lease(self, entry)
+            fname = self.__files[key]
+
+        # Evicted: load it again, outside the lock. If another thread
+        # loaded it meanwhile, use that one.
+        entry = self.__load(fname)
+        with self.__lock:
+            if (key not in self.__entries):
+                self.__install(key, entry)
+            entry = self.__entries[key]
+            entry.refs += 1
+            return Lease(self, entry)
+
+    """Public function.
+    Load the morphing matrix file 'fname' (by default, the registered
+    file of 'key') in a background thread and, if it's valid, swap it
+    in as the matrix of 'key'. Return the thread, which can be joined
+    to wait for the swap. A reload of a key that is being reloaded
+    returns the thread of that reload instead."""
+    def reload(self, key, fname=None):
+        with self.__lock:
+            thread = self.__reloading.get(key)
+            if (thread is not None):
+                return thread
+            if (fname is None):
+                fname = self.__files[key]
+            thread = threading.Thread(target=self.__reload, args=(key, fname))
+            thread.daemon = True
+            self.__reloading[key] = thread
+        thread.start()
+        return thread
+
+    """Public function.
+    Reload (see reload()) every loaded matrix whose file changed since
+    it was loaded, e.g. from a timer. Return the reload threads."""
+    def poll(self):
+        with self.__lock:
+            candidates = [(key, entry.fname, entry.stamp)
+                          for (key, entry) in self.__entries.items()]
+
+        threads = []
+        for (key, fname, stamp) in candidates:
+            try:
+                changed = get_stamp(fname) != stamp
+            except OSError:
+                continue # being replaced; try again next time
+            if (changed):
+                threads.append(self.reload(key, fname))
+        return threads
+
+    """Public function.
+    Return the keys of the matrices that are loaded right now, least
+    recently leased first."""
+    def loaded(self):
+        with self.__lock:
+            return self.__entries.keys()
+
+    """Load and validate morphing matrix file 'fname' into an Entry."""
+    def __load(self, fname):
+        stamp = get_stamp(fname)
+        entry = Entry(dream.get_morphing_matrix_from_file(fname, self.sampler,
+                                                          self.copy),
+                      fname, stamp)
+        with self.__lock:
+            self.stats["loads"] += 1
+        return entry
+
+    """Body of the reload thread of 'key'."""
+    def __reload(self, key, fname):
+        try:
+            entry = self.__load(fname)
+        except Exception, e:
+            with self.__lock:
+                self.stats["errors"] += 1
+                del self.__reloading[key]
+            if (self.on_error):
+                self.on_error(key, fname, e)
+            return
+
+        with self.__lock:
+            self.__files[key] = fname
+            self.__install(key, entry)
+            self.stats["reloads"] += 1
+            del self.__reloading[key]
+
+    """Make 'entry' the matrix of 'key' and evict matrices beyond the
+    capacity. The old entry, if any, lives on in its leases. Call with
+    the lock held."""
+    def __install(self, key, entry):
+        self.__entries.pop(key, None)
+        self.__entries[key] = entry
+        self.__evict(key)
+
+    """Evict the least recently leased matrices that aren't leased,
+    other than the one of 'keep', until at most 'self.capacity' are
+    loaded, if possible. Call with the lock held."""
+    def __evict(self, keep=None):
+        excess = len(self.__entries) - self.capacity
+        for key in self.__entries.keys():
+            if (excess <= 0):
+                break
+            if ((key != keep) and (not self.__entries[key].refs)):
+                del self.__entries[key]
+                self.stats["evictions"] += 1
+                excess -= 1
+
+    """End a lease of 'entry' (see Lease.release())."""
+    def _release(self, entry):
+        with self.__lock:
+            assert(entry.refs > 0)
+            entry.refs -= 1
+            if (not entry.refs):
+                self.__evict()
+
+if __name__ != "__main__":
+    if (sys.hexversion < 0x02070000):
+        raise RuntimeError("This library is only useful with " \
+                           "a Python version >= 2.7.")
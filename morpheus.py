@@ -4,29 +4,85 @@ import sys
 import math
 import subprocess
 import os
-import decimal
 import itertools
 import getopt
-from scipy.sparse import lil_matrix
+import tempfile
+import multiprocessing
+import time
+import hashlib
+import shutil
+import array
+from scipy.sparse import coo_matrix
 import scipy.io
+import scipy.sparse
 import numpy
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "dreams", "python"))
+import dream
+
+import distr
+
 PARANOIA = True
 
 # 1500b ethernet MTU - 20b min. ip headers - 20b min. tcp headers
 MAX_TCP_PAYLOAD_SIZE = 1460
 
-GLPK_FILENAME = "morpher.mod"
+# LP solver backends.
+SOLVER_GLPSOL = "glpsol" # spawn glpsol(1) and parse its solution file
+SOLVER_LINPROG = "linprog" # solve in-process with scipy.optimize.linprog()
+SOLVER_OT1D = "ot1d" # exact 1-D optimal transport; no LP at all
+SOLVERS = (SOLVER_GLPSOL, SOLVER_LINPROG, SOLVER_OT1D)
+
+# Files of a glpsol run. They live in a fresh temporary directory per
+# run, so that concurrent runs don't overwrite each other's files.
+GLPK_FILENAME = "morpher.mps" # free MPS
 SOLUTION_FILENAME = "morpher.sol"
 
-# Strings necessary for the GLPK file format.
-PROLOGUE = "data;\n\n"
-SET_STRING = "set PACKET_SIZE"
-SOURCE_PARAM_STRING = "param source :="
-TARGET_PARAM_STRING = "param target :="
-EPILOGUE = "end;\n"
+# Strategies for finding the morphing matrix.
+STRATEGY_FULL = "full" # a single LP with size^2 variables
+STRATEGY_DIVIDE = "divide" # divide-and-conquer over bins of packet lengths
+STRATEGY_COLGEN = "colgen" # column generation from a band around the diagonal
+STRATEGIES = (STRATEGY_FULL, STRATEGY_DIVIDE, STRATEGY_COLGEN)
+
+# Default number of bins of the divide-and-conquer strategy.
+DEFAULT_BINS = 32
+
+# How many rows to widen the support of a previous morphing matrix by,
+# when re-solving incrementally.
+DEFAULT_WINDOW = 8
+
+# Half-width of the initial band of the column generation strategy, how
+# many entries it adds to a column at most per round, and how many
+# rounds it does at most.
+DEFAULT_BAND = 4
+COLGEN_ENTRIES_PER_COLUMN = 8
+COLGEN_MAX_ROUNDS = 10
+# Reduced costs (in bytes of padding per packet) above
+# -REDUCED_COST_TOLERANCE count as >= 0.
+REDUCED_COST_TOLERANCE = 1e-6
+# Entries of a solution above this count as non-zero when recovering
+# its duals.
+SUPPORT_TOLERANCE = 1e-7
+# A solution is known to be optimal when its objective is within
+# OPTIMALITY_TOLERANCE * max(1, objective) of a lower bound.
+OPTIMALITY_TOLERANCE = 1e-6
+# How many columns to price at a time.
+COLGEN_CHUNK_SIZE = 64
+
+# On-disk cache of solved morphing matrices.
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "morpheus")
+DEFAULT_CACHE_SIZE = 256 # megabytes
+CACHE_VERSION = "2" # bump when the solution of a key may change
+
+# How many MPS and Matrix Market entries to format at a time.
+MPS_CHUNK_SIZE = 1 << 16
+MM_CHUNK_SIZE = 1 << 16
 
-# this is our GLPK model
+# this is our LP, in GLPK MathProg. get_lp_arrays() builds it as arrays
+# that the solver backends consume.
 MODEL = \
 """set PACKET_SIZE;
 
@@ -50,14 +106,26 @@ Matrix between two probability distributions.
 
 'self.source' is the source distribution.
 'self.target' is the target distribution.
-'self.result' is the morphing matrix.
+'self.solver' is the LP solver backend (one of SOLVERS).
+'self.result' is the morphing matrix as a SciPy sparse matrix.
+'self.stats' is a dictionary of solver instrumentation, filled in by
+harvest(): the size of the LP ('variables', 'constraints',
+'nonzeros'), the seconds spent building and solving it ('build_time',
+'solve_time'), the solver's 'iterations' (None if unknown), the
+'objective' value and the max. absolute primal residuals of the
+column_prob and morphing_creation constraints ('column_residual',
+'target_residual').
 """
 class MorphingMatrixLP:
-    """Initialize a GLPK run.
+    """Initialize an LP run.
     'source' is the source distribution.
     'target' is the target distribution'.
+    'solver' is the LP solver backend to use (one of SOLVERS).
+    'support', if given, is a (rows, cols) pair of arrays of the
+    (zero-based) matrix entries that may be non-zero; all other
+    entries are fixed to zero. It needs the linprog backend.
     """
-    def __init__(self, source, target):
+    def __init__(self, source, target, solver=SOLVER_GLPSOL, support=None):
         if (len(source) != len(target)):
             print "Packet length distributions have different size."
             sys.exit(1)
@@ -65,158 +133,982 @@ class MorphingMatrixLP:
             print "0 size distribution"
             sys.exit(1)
 
+        if (solver not in SOLVERS):
+            print "Unknown LP solver '%s'." % (solver)
+            sys.exit(1)
+        if ((support is not None) and (solver != SOLVER_LINPROG)):
+            print "Restricting the LP variables needs the linprog solver."
+            sys.exit(1)
+
         self.source = source
         self.target = target
+        self.solver = solver
+        self.support = support
         self.size = len(self.source)
-        self.result = []
+        self.result = None
+        self.workdir = None
+        self.stats = {}
 
     """Public function.
-    Run GLPK and return the morphing matrix.
+    Solve the LP and return the morphing matrix as a SciPy sparse
+    matrix. If the LP is restricted to a support on which it's
+    infeasible, return None.
     """
     def harvest(self):
-        self.__run()
-        self.__parse_solution_file()
-        self.__clean_mess()
+        if (self.solver == SOLVER_OT1D):
+            return self.__run_ot1d()
 
-        return self.result
+        start = time.time()
+        lp = get_lp_arrays(self.source, self.target, self.support)
+        c, a_eq, b_eq = lp[:3]
+        self.stats = {"variables": len(c), "constraints": len(b_eq),
+                      "nonzeros": a_eq.nnz, "build_time": time.time() - start}
 
-    """Write GLPK file to disk."""
-    def __create_glpk_file(self):
-        f = open(GLPK_FILENAME, 'w')
-        f.write(MODEL)
+        start = time.time()
+        if (self.solver == SOLVER_LINPROG):
+            self.__run_linprog(*lp)
+        else:
+            self.__run(*lp)
+            self.__parse_solution_file(*lp[3:])
+            self.__clean_mess()
+        self.stats["solve_time"] = time.time() - start
 
-        f.write(PROLOGUE)
-        f.write(self.__get_set_string())
-        f.write(self.__get_param_string(type="source"))
-        f.write(self.__get_param_string(type="false"))
-        f.write(EPILOGUE)
+        if (self.result is not None):
+            self.stats.update(get_residuals(self.result, self.source,
+                                            self.target))
+            self.stats["objective"] = get_objective(self.result, self.source)
 
-    """Return 'set' string of the data section of the GLPK file."""
-    def __get_set_string(self):
-        string = ""
+        return self.result
 
-        string += SET_STRING
-        for i in xrange(1,self.size+1):
-            string += " %s" % (str(i))
+    """Solve the LP exactly without building it, and return the
+    morphing matrix. Packet lengths are one-dimensional and the cost
+    of morphing a packet of length 'j' into one of length 'i' is
+    |i - j|, so the LP is a 1-D optimal transport (earth mover's)
+    problem between the source and target distributions. Its optimum
+    is the monotone coupling of their CDFs (see
+    get_monotone_coupling()), which takes O(n log n) time to find."""
+    def __run_ot1d(self):
+        start = time.time()
+        self.result = get_monotone_coupling(self.source, self.target)
+        self.stats = {"variables": self.size ** 2,
+                      "constraints": 2 * self.size, "nonzeros": 0,
+                      "build_time": 0.0, "solve_time": time.time() - start,
+                      "iterations": None}
+        self.stats.update(get_residuals(self.result, self.source,
+                                        self.target))
+        self.stats["objective"] = get_objective(self.result, self.source)
 
-        string += ";\n\n"
-        return string
+        return self.result
 
+    """Solve the LP 'c', 'a_eq', 'b_eq' over the entries ('i', 'j') (see
+    get_lp_arrays()) in-process using scipy.optimize.linprog()."""
+    def __run_linprog(self, c, a_eq, b_eq, i, j):
+        from scipy.optimize import linprog
 
-    """Return 'param' string of the data section of the GLPK file."""
-    def __get_param_string(self, type):
-        string = ""
+        n = self.size
+        a_eq = a_eq.tocsr()
 
-        if type == "source":
-            string += SOURCE_PARAM_STRING
-            distr = self.source
-        else:
-            string += TARGET_PARAM_STRING
-            distr = self.target
+        # The last SciPy versions for Python 2.7 (up to 1.2) have no
+        # HiGHS; interior-point is their only sparse method.
+        res = linprog(c, A_eq=a_eq, b_eq=b_eq, bounds=(0, None),
+                      method="interior-point", options={"sparse": True})
+        self.stats["iterations"] = res.nit
 
-        for num in xrange(1,self.size+1):
-            string += "\n"
-            string += "\t%s %s" % (str(num), str(distr[num-1]))
+        if ((res.status == 2) and (self.support is not None)):
+            self.result = None # infeasible on this support
+            return
+        if (res.status != 0):
+            print "linprog failed: %s" % (res.message)
+            sys.exit(1)
 
-        string += ";\n\n"
-        return string
+        x = numpy.clip(res.x, 0, None) # interior point noise
+        self.result = coo_matrix((x, (i, j)), shape=(n, n))
 
-    """Run GLPK."""
-    def __run(self):
-        self.__create_glpk_file()
+    """Run GLPK on the LP 'c', 'a_eq', 'b_eq' over the entries ('i', 'j')
+    (see get_lp_arrays()), written as a free MPS file."""
+    def __run(self, c, a_eq, b_eq, i, j):
+        self.workdir = tempfile.mkdtemp(prefix="morpheus-")
+        write_mps(os.path.join(self.workdir, GLPK_FILENAME),
+                  c, a_eq, b_eq, i, j)
 
-        subprocess.check_output([
+        output = subprocess.check_output([
             "glpsol",
-            "--math", GLPK_FILENAME,
-            "--output", SOLUTION_FILENAME
+            "--freemps", os.path.join(self.workdir, GLPK_FILENAME),
+            "--output", os.path.join(self.workdir, SOLUTION_FILENAME)
         ])
+        self.stats["iterations"] = get_glpsol_iterations(output)
+
+    """Parse the solution file of glpsol into the morphing matrix, for
+    the LP over the entries ('i', 'j') (see get_lp_arrays())."""
+    def __parse_solution_file(self, i, j):
+        self.result = get_solution_from_file(
+            os.path.join(self.workdir, SOLUTION_FILENAME), i, j, self.size)
+
+    """Remove files that were created for GLPK."""
+    def __clean_mess(self):
+        os.remove(os.path.join(self.workdir, GLPK_FILENAME))
+        os.remove(os.path.join(self.workdir, SOLUTION_FILENAME))
+        os.rmdir(self.workdir)
+        self.workdir = None
+
+"""
+Finds the Morphing Matrix between two probability distributions with
+the divide-and-conquer approach of the paper:
+
+  * The packet lengths are split into 'bins' contiguous bins, and a
+    small LP morphs the binned source distribution into the binned
+    target distribution. Its solution, K[a,b], is the probability
+    that a packet of source bin 'b' becomes a packet of target bin 'a'.
+
+  * Within a bin (a == b), a sub-LP morphs the source distribution
+    restricted to the bin into the target distribution restricted to
+    the bin. The sub-LPs are independent and are solved in parallel.
+
+  * Between different bins (a != b) the padding cost of any morphing
+    is the same, since every target length of bin 'a' is on the same
+    side of every source length of bin 'b'. The monotone coupling of
+    the two restricted distributions is used, since it's sparse.
+
+  The resulting matrix is M[i,j] = K[a,b] * M_ab[i,j] for 'i' in bin
+  'a' and 'j' in bin 'b'. It satisfies the constraints of MODEL, but
+  it is only optimal if the binned LP is; see get_objective().
+
+'self.source' and 'self.target' are the distributions.
+'self.bins' is the number of bins.
+'self.solver' is the LP solver backend of the LPs.
+'self.jobs' is the number of sub-LPs to solve in parallel.
+'self.result' is the morphing matrix as a SciPy sparse matrix.
+"""
+class DivideAndConquerLP:
+    """Initialize a divide-and-conquer run.
+    'jobs' defaults to the number of CPUs.
+    """
+    def __init__(self, source, target, bins=DEFAULT_BINS,
+                 solver=SOLVER_GLPSOL, jobs=None):
+        if (len(source) != len(target)):
+            print "Packet length distributions have different size."
+            sys.exit(1)
+        if (len(source) <= 0):
+            print "0 size distribution"
+            sys.exit(1)
+        if (bins <= 0):
+            print "The number of bins must be positive."
+            sys.exit(1)
+
+        self.source = numpy.array(map(numpy.double, source))
+        self.target = numpy.array(map(numpy.double, target))
+        self.size = len(self.source)
+        self.bins = min(bins, self.size)
+        self.solver = solver
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.result = None
+
+    """Public function.
+    Solve the binned LP and the sub-LPs and return the morphing matrix
+    as a SciPy sparse matrix.
+    """
+    def harvest(self):
+        edges = numpy.linspace(0, self.size, self.bins+1).astype(int)
+        starts = edges[:-1]
+
+        source_bins = numpy.add.reduceat(self.source, starts)
+        target_bins = numpy.add.reduceat(self.target, starts)
+
+        binned = MorphingMatrixLP(source_bins, target_bins, self.solver)
+        k_m = binned.harvest().toarray()
+        # Drop solver noise, so that we don't morph into every bin.
+        k_m[k_m < 1e-12] = 0
+        k_m /= k_m.sum(axis=0)
+
+        diagonal = [a for a in xrange(self.bins)
+                    if ((k_m[a,a] > 0) and (source_bins[a] > 0))]
+        sub_lps = [(self.__get_bin(self.source, edges, a),
+                    self.__get_bin(self.target, edges, a), self.solver)
+                   for a in diagonal]
+        sub_results = {}
+        if (len(sub_lps) == 1 or self.jobs == 1):
+            sub_results = dict(zip(diagonal, map(solve_sub_lp, sub_lps)))
+        elif (sub_lps):
+            pool = multiprocessing.Pool(min(self.jobs, len(sub_lps)))
+            try:
+                sub_results = dict(zip(diagonal,
+                                       pool.map(solve_sub_lp, sub_lps)))
+            finally:
+                pool.close()
+                pool.join()
+
+        rows, cols, values = [], [], []
+        for b in xrange(self.bins):
+            source = self.__get_bin(self.source, edges, b)
+            for a in numpy.flatnonzero(k_m[:,b]):
+                if (b in sub_results and a == b):
+                    m_ab = sub_results[b]
+                else:
+                    m_ab = get_monotone_coupling(
+                        source, self.__get_bin(self.target, edges, a))
+                rows.append(m_ab.row + edges[a])
+                cols.append(m_ab.col + edges[b])
+                values.append(m_ab.data * k_m[a,b])
+
+        self.result = coo_matrix((numpy.concatenate(values),
+                                  (numpy.concatenate(rows),
+                                   numpy.concatenate(cols))),
+                                 shape=(self.size, self.size))
+        return self.result
+
+    """Return bin 'n' of 'distr' as a probability distribution.
+    Bins with no probability mass become uniform distributions."""
+    def __get_bin(self, distr, edges, n):
+        d = distr[edges[n]:edges[n+1]]
+        total = math.fsum(d)
+        if (total <= 0):
+            return numpy.ones(len(d)) / len(d)
+        return d / total
+
+"""
+Re-solves the Morphing Matrix LP for distributions that drifted a
+little since a previous morphing matrix was solved.
+
+The previous solution is used as a warm start: column generation (see
+ColumnGenerationLP) starts from the entries near the support of the
+previous matrix (its non-zero entries, widened by 'window' rows on
+each side, plus the diagonal). When the drift is small, that LP is
+small and its solution is near the previous one. The warm start is
+only accepted if its objective is within OPTIMALITY_TOLERANCE of a
+lower bound on the optimum within 'max_rounds' rounds; otherwise the
+full LP is solved instead.
+
+'self.previous' is the previous morphing matrix as a SciPy sparse matrix.
+'self.window' is how many rows to widen the previous support by.
+'self.stats' is a dict describing the re-solve, filled in by harvest():
+the size of the warm 'support', whether the 'warm' start gave the
+result, its 'rounds' of column generation, the 'objective' of the
+result, a 'lower_bound' on the optimum and the optimality 'gap'
+between them, whether the result is known to be 'optimal', and how it
+differs from the previous matrix.
+'self.result' is the morphing matrix as a SciPy sparse matrix.
+"""
+class IncrementalLP:
+    def __init__(self, source, target, previous, solver=SOLVER_LINPROG,
+                 window=DEFAULT_WINDOW, max_rounds=COLGEN_MAX_ROUNDS):
+        if (solver != SOLVER_LINPROG):
+            print "Warm starts need the linprog solver."
+            sys.exit(1)
+        if (previous.shape != (len(source), len(source))):
+            print "Previous morphing matrix has the wrong size (%s:%d)." % \
+                (previous.shape, len(source))
+            sys.exit(1)
+
+        self.source = source
+        self.target = target
+        self.previous = previous.tocoo()
+        self.solver = solver
+        self.window = window
+        self.max_rounds = max_rounds
+        self.stats = {}
+        self.result = None
+
+    """Public function.
+    Solve the LP and return the morphing matrix as a SciPy sparse
+    matrix.
+    """
+    def harvest(self):
+        n = len(self.source)
+        prev = self.previous
+        keep = prev.data > 1e-9 # ignore solver noise
+
+        offsets = numpy.arange(-self.window, self.window+1)
+        rows = (prev.row[keep][:,None] + offsets).ravel()
+        cols = numpy.repeat(prev.col[keep], len(offsets))
+        rows = numpy.concatenate((rows, numpy.arange(n)))
+        cols = numpy.concatenate((cols, numpy.arange(n)))
+        inside = (rows >= 0) & (rows < n)
+        support = numpy.unique(rows[inside] * n + cols[inside])
+        support = (support // n, support % n)
+
+        colgen = ColumnGenerationLP(self.source, self.target,
+                                    solver=self.solver, support=support,
+                                    max_rounds=self.max_rounds)
+        # Column generation solves the full LP itself if the warm start
+        # isn't proven optimal.
+        self.result = colgen.harvest()
+        self.stats["support"] = colgen.stats["initial_support"]
+        self.stats["rounds"] = colgen.stats["rounds"]
+        self.stats["warm"] = not colgen.stats["full_lp"]
+        for key in ("lower_bound", "gap", "optimal"):
+            self.stats[key] = colgen.stats[key]
+
+        self.__compare()
+        return self.result
+
+    """Fill 'self.stats' with how the new morphing matrix differs from
+    the previous one."""
+    def __compare(self):
+        source = numpy.array(map(numpy.double, self.source))
+        target = numpy.array(map(numpy.double, self.target))
+        prev = self.previous.tocsc()
+        diff = abs(self.result.tocsc() - prev)
+
+        # Total variation distance between the old and new column of
+        # each source length, averaged over the new source distribution.
+        column_tv = numpy.asarray(diff.sum(axis=0)).ravel() / 2
+        self.stats["max_change"] = diff.max() if (diff.nnz) else 0.0
+        self.stats["mean_column_tv"] = math.fsum(source * column_tv)
+        self.stats["previous_error"] = abs(prev.dot(source) - target).max()
+        self.stats["previous_objective"] = get_objective(prev, source)
+        self.stats["objective"] = get_objective(self.result, source)
 
-    """Parse the solution file of glpsol and return the morphing matrix."""
-    def __parse_solution_file(self):
-        INTERESTING_FILE_SECTION = \
 """
-   No. Column name  St   Activity     Lower bound   Upper bound    Marginal
------- ------------ -- ------------- ------------- ------------- -------------
+Finds the Morphing Matrix between two probability distributions with
+column generation, without ever building the full LP.
+
+Since the padding cost of morph[i,j] is |i - j|, optimal matrices
+mostly morph packets into nearby lengths. The LP is first solved only
+over the entries within 'band' rows of the diagonal (or over a given
+'support'), plus those of the monotone coupling of the distributions
+(see get_monotone_coupling()), which make it feasible. Then, in rounds:
+
+  * the duals of the restricted LP are recovered from its solution
+    (see get_support_duals());
+
+  * every entry is priced with them, a few columns at a time (see
+    price_entries()), which also gives a lower bound on the objective
+    of the full LP;
+
+  * if the objective is within OPTIMALITY_TOLERANCE of the best lower
+    bound so far, the solution is optimal for the full LP too.
+    Otherwise, the entries with the most negative reduced costs (up to
+    COLGEN_ENTRIES_PER_COLUMN per column) join the support, and the
+    restricted LP is solved again.
+
+The recovered duals are only exact when the support of the solution is
+a spanning tree; on degenerate supports, finding no negative reduced
+cost proves nothing, and their lower bound may be far off. So the
+lower bound is also computed with the duals of get_monotone_duals(),
+which are optimal for the full LP: it then equals the optimum, and an
+optimal solution is always recognized as such.
+
+If pricing adds no entries or 'max_rounds' rounds pass before the
+solution is known to be optimal, the full LP is solved instead.
+
+The LP only ever has as many variables as the support, so time and
+memory grow with the support, not with size^2.
+
+'self.band' is the half-width of the initial band.
+'self.stats' is a dict describing the rounds, filled in by harvest():
+the 'rounds', the 'initial_support' and final 'support' sizes, the
+'objective', its 'lower_bound' and the 'gap' between them, whether the
+'full_lp' had to be solved, and whether the solution is known to be
+'optimal'.
+'self.result' is the morphing matrix as a SciPy sparse matrix.
 """
+class ColumnGenerationLP:
+    def __init__(self, source, target, band=DEFAULT_BAND,
+                 solver=SOLVER_LINPROG, support=None,
+                 max_rounds=COLGEN_MAX_ROUNDS):
+        if (len(source) != len(target)):
+            print "Packet length distributions have different size."
+            sys.exit(1)
+        if (len(source) <= 0):
+            print "0 size distribution"
+            sys.exit(1)
+        if (solver != SOLVER_LINPROG):
+            print "Column generation needs the linprog solver."
+            sys.exit(1)
 
-        morphing_matrix = []
+        self.source = numpy.array(map(numpy.double, source))
+        self.target = numpy.array(map(numpy.double, target))
+        self.size = len(self.source)
+        self.band = band
+        self.solver = solver
+        self.support = support
+        self.max_rounds = max_rounds
+        self.stats = {}
+        self.result = None
 
-        f = open(SOLUTION_FILENAME)
-        solution = f.read()
-        f.close()
+    """Public function.
+    Solve the LP and return the morphing matrix as a SciPy sparse
+    matrix.
+    """
+    def harvest(self):
+        n = self.size
+        # Entries are kept as sorted keys i*n + j.
+        if (self.support is None):
+            offsets = numpy.arange(-self.band, self.band+1)
+            rows = (numpy.arange(n)[:,None] + offsets).ravel()
+            cols = numpy.repeat(numpy.arange(n), len(offsets))
+            inside = (rows >= 0) & (rows < n)
+            keys = rows[inside] * n + cols[inside]
+        else:
+            keys = numpy.asarray(self.support[0]) * n + \
+                numpy.asarray(self.support[1])
+        greedy = get_monotone_coupling(self.source, self.target)
+        keys = numpy.union1d(keys, greedy.row * n + greedy.col)
 
-        assert(INTERESTING_FILE_SECTION in solution)
-        matrix_section = solution.split(INTERESTING_FILE_SECTION)[1]
+        self.stats = {"rounds": [], "initial_support": len(keys),
+                      "optimal": False, "full_lp": False}
+        # Costs are >= 0, and so is the optimum.
+        best_bound = max(price_entries(
+                self.source, self.target,
+                get_monotone_duals(self.source, self.target), keys)[1], 0.0)
+        while (True):
+            lp = MorphingMatrixLP(self.source, self.target, self.solver,
+                                  (keys // n, keys % n))
+            self.result = lp.harvest()
+            if (self.result is None):
+                print "Column generation: restricted LP is infeasible."
+                sys.exit(1)
 
-        entries = matrix_section.split("\n")
+            v = get_support_duals(self.source, self.result)[0]
+            new, bound = price_entries(self.source, self.target, v, keys)
+            best_bound = max(best_bound, bound)
 
-        for i in xrange(len(entries)):
-            substr = entries[i]
-            if (substr == ""):
+            self.stats["rounds"].append(
+                {"support": len(keys), "added": len(new),
+                 "objective": lp.stats["objective"], "lower_bound": bound,
+                 "solve_time": lp.stats["solve_time"]})
+            if (is_optimal(lp.stats["objective"], best_bound)):
+                self.stats["optimal"] = True
+                break
+            if ((not len(new)) or
+                (len(self.stats["rounds"]) >= self.max_rounds)):
                 break
+            keys = numpy.union1d(keys, new)
+
+        if (not self.stats["optimal"]):
+            self.result = MorphingMatrixLP(self.source, self.target,
+                                           self.solver).harvest()
+            self.stats["full_lp"] = True
+
+        self.stats["support"] = len(keys)
+        self.stats["objective"] = get_objective(self.result, self.source)
+        self.stats["lower_bound"] = best_bound
+        self.stats["gap"] = max(self.stats["objective"] - best_bound, 0.0)
+        self.stats["optimal"] = is_optimal(self.stats["objective"],
+                                           best_bound)
+        return self.result
+
+"""Return whether a solution of value 'objective' is optimal, given a
+'lower_bound' on the optimum (see OPTIMALITY_TOLERANCE)."""
+def is_optimal(objective, lower_bound):
+    return objective - lower_bound <= \
+        OPTIMALITY_TOLERANCE * max(1.0, objective)
+
+"""
+Given the 'source' distribution and a morphing 'matrix' that solves
+the LP restricted to some support, return the duals (v, w) that give
+its non-zero entries (those above SUPPORT_TOLERANCE, in columns with
+source probability) zero reduced costs: v[i] + w[j] = |i - j| for each
+of them, by least squares. 'v' are the duals of morphing_creation and
+source[j]*w[j] those of column_prob (see get_lp_arrays()).
+Interior-point doesn't give the duals, and this is much cheaper than
+solving the dual LP.
+"""
+def get_support_duals(source, matrix):
+    from scipy.sparse.linalg import lsqr
+
+    m = matrix.tocoo()
+    n = m.shape[0]
+    source = numpy.asarray(source, dtype=numpy.double)
+    keep = (m.data > SUPPORT_TOLERANCE) & (source[m.col] > 0)
+    i, j = m.row[keep], m.col[keep]
+
+    eqs = numpy.arange(len(i))
+    a = scipy.sparse.coo_matrix(
+        (numpy.ones(2 * len(i)),
+         (numpy.concatenate((eqs, eqs)), numpy.concatenate((i, n + j)))),
+        shape=(len(i), 2*n))
+    y = lsqr(a.tocsr(), numpy.abs(i - j).astype(numpy.double),
+             atol=1e-12, btol=1e-12)[0]
+
+    return (y[:n], y[n:])
+
+"""
+Given the 'source' and 'target' distributions, the duals 'v' of
+morphing_creation (see get_support_duals()) and the sorted keys
+(i*n + j) of the entries of a support, price every entry of the LP,
+a few columns at a time. Return a (new, bound) pair:
+
+  * 'new' are the keys of the entries outside the support with
+    negative reduced costs, |i - j| - v[i] - w[j] < -'tolerance', at
+    most 'per_column' per column, the most negative ones. w[j] is the
+    least |i - j| - v[i] of the support of column 'j', which is what
+    the reduced costs of the support being >= 0 and zero on its
+    non-zero entries (complementary slackness) make it.
+
+  * 'bound' is the Lagrangian lower bound on the objective of the full
+    LP, v*target + sum_j source[j] * min_i (|i - j| - v[i]), which
+    holds for any 'v'.
+"""
+def price_entries(source, target, v, keys, per_column=COLGEN_ENTRIES_PER_COLUMN,
+                  tolerance=REDUCED_COST_TOLERANCE):
+    source = numpy.asarray(source, dtype=numpy.double)
+    n = len(source)
+    lengths = numpy.arange(n)
+    per_column = min(per_column, n)
+
+    # The support, sorted by column.
+    support_cols, support_rows = keys % n, keys // n
+    order = numpy.lexsort((support_rows, support_cols))
+    support_cols, support_rows = support_cols[order], support_rows[order]
+
+    new = []
+    bound = math.fsum(v * numpy.asarray(target, dtype=numpy.double))
+    for start in xrange(0, n, COLGEN_CHUNK_SIZE):
+        cols = lengths[start:start+COLGEN_CHUNK_SIZE]
+        reduced = numpy.abs(lengths[:,None] - cols) - v[:,None]
+        bound += math.fsum(source[cols] * reduced.min(axis=0))
+
+        lo, hi = numpy.searchsorted(support_cols, [cols[0], cols[-1] + 1])
+        in_support = numpy.zeros(reduced.shape, dtype=bool)
+        in_support[support_rows[lo:hi], support_cols[lo:hi] - start] = True
+        w = numpy.where(in_support, reduced, numpy.inf).min(axis=0)
+        reduced -= w
+        reduced[in_support] = numpy.inf
+
+        best = numpy.argpartition(reduced, per_column - 1,
+                                  axis=0)[:per_column]
+        chosen = (reduced[best, numpy.arange(len(cols))] < -tolerance) & \
+            (source[cols] > 0)
+        new.append(best[chosen] * n +
+                   numpy.broadcast_to(cols, best.shape)[chosen])
+
+    return (numpy.unique(numpy.concatenate(new)), bound)
+
+"""
+Given the 'source' and 'target' distributions, return the LP of MODEL
+as a (c, a_eq, b_eq, i, j) tuple of arrays: minimize c*x subject to
+a_eq*x = b_eq and x >= 0, where variable x[k] is morph[i[k],j[k]] (row
+'i' is the target length, column 'j' the source length, both
+zero-based). 'a_eq' is a SciPy COO matrix whose rows are:
+  rows [0, size): column_prob, sum_i morph[i,j] = 1
+  rows [size, 2*size): morphing_creation, sum_j morph[i,j]*source[j] = target[i]
+Without a 'support', there's a variable for every entry, x[i*size + j]
+being morph[i,j]. With a 'support' (a (rows, cols) pair of arrays),
+only its entries are variables, in its order.
+"""
+def get_lp_arrays(source, target, support=None):
+    n = len(source)
+    source = numpy.array(map(numpy.double, source))
+    target = numpy.array(map(numpy.double, target))
 
-            substr = ' '.join(substr.split()).split(" ")
+    if (support is not None):
+        i, j = map(numpy.asarray, support)
+    else:
+        i = numpy.repeat(numpy.arange(n), n)
+        j = numpy.tile(numpy.arange(n), n)
+    var = numpy.arange(len(i))
+
+    c = source[j] * numpy.abs(i - j)
+    a_eq = scipy.sparse.coo_matrix(
+        (numpy.concatenate((numpy.ones(len(var)), source[j])),
+         (numpy.concatenate((j, n + i)), numpy.concatenate((var, var)))),
+        shape=(2*n, len(var)))
+    b_eq = numpy.concatenate((numpy.ones(n), target))
+
+    return (c, a_eq, b_eq, i, j)
+
+"""
+Write the LP 'c', 'a_eq', 'b_eq' over the entries ('i', 'j') (see
+get_lp_arrays()) to file 'fname' in free MPS format. Variable x[k] is
+named 'm<i+1>_<j+1>', like morph[i,j] of MODEL, and the variables are
+listed in order. Rows 'c<j+1>' are column_prob and rows 't<i+1>'
+morphing_creation. Zero coefficients are left out.
+"""
+def write_mps(fname, c, a_eq, b_eq, i, j):
+    n = len(b_eq) // 2
+    row_names = ["obj"] + ["c%d" % (k+1) for k in xrange(n)] + \
+        ["t%d" % (k+1) for k in xrange(n)]
+
+    # All non-zero coefficients as (variable, row, value) triplets, the
+    # objective being row -1, sorted by variable and then row. A
+    # variable without any coefficient gets an explicit zero one, since
+    # it must appear at least once.
+    a = a_eq.tocoo()
+    present = numpy.zeros(len(c), dtype=bool)
+    present[a.col[a.data != 0]] = True
+    obj = numpy.flatnonzero((c != 0) | (~present))
+    nz = a.data != 0
+    var = numpy.concatenate((obj, a.col[nz]))
+    row = numpy.concatenate((numpy.full(len(obj), -1, dtype=a.row.dtype),
+                             a.row[nz]))
+    value = numpy.concatenate((c[obj], a.data[nz]))
+    order = numpy.lexsort((row, var))
+    var, row, value = var[order], row[order] + 1, value[order]
+
+    # Most coefficients repeat (1 or source[j]), so format each distinct
+    # value once.
+    values, value = numpy.unique(value, return_inverse=True)
+    values = map(repr, values.tolist())
+
+    with open(fname, "w") as f:
+        f.write("NAME morpher\nROWS\n N obj\n")
+        f.write("".join(" E %s\n" % (name) for name in row_names[1:]))
+
+        f.write("COLUMNS\n")
+        for start in xrange(0, len(var), MPS_CHUNK_SIZE):
+            end = start + MPS_CHUNK_SIZE
+            f.write("".join([" m%d_%d %s %s\n" % (vi, vj, row_names[r],
+                                                   values[v])
+                             for (vi, vj, r, v) in
+                             zip((i[var[start:end]] + 1).tolist(),
+                                 (j[var[start:end]] + 1).tolist(),
+                                 row[start:end].tolist(),
+                                 value[start:end].tolist())]))
+
+        f.write("RHS\n")
+        for k in numpy.flatnonzero(b_eq):
+            f.write(" rhs %s %r\n" % (row_names[k+1], float(b_eq[k])))
+        f.write("ENDATA\n")
+
+"""
+Given the filename 'fname' of a glpsol solution file (glpsol --output)
+of the LP over the entries ('i', 'j') of an 'n'x'n' morphing matrix
+(see get_lp_arrays()), return the morphing matrix as a SciPy COO
+matrix. The file is read a line at a time and only its non-zero
+activities are kept, so memory scales with the non-zero entries of
+the matrix instead of with the 'n'^2 variables of the LP.
+"""
+def get_solution_from_file(fname, i, j, n):
+    INTERESTING_FILE_SECTION = [
+        "No. Column name  St   Activity     Lower bound   Upper bound    Marginal",
+        "------ ------------ -- ------------- ------------- ------------- -------------"]
+
+    variables = array.array("l") # indices into 'i' and 'j'
+    values = array.array("d")
+    k = 0
+
+    with open(fname) as f:
+        # Skip to the table of the columns.
+        previous = None
+        for line in f:
+            line = line.strip()
+            if ([previous, line] == INTERESTING_FILE_SECTION):
+                break
+            previous = line
+        else:
+            raise ValueError("'%s' has no columns section." % (fname))
+
+        # A column takes one line, or two if its name is too long:
+        # its number and name, then the rest.
+        for line in f:
+            substr = line.split()
             strlen = len(substr)
+            if (strlen == 0):
+                break
 
             if ((strlen == 6) or (strlen == 7)):
-                morphing_matrix.append(substr[3])
+                activity = substr[3]
             elif ((strlen == 3) or (strlen == 4)):
-                morphing_matrix.append(substr[1])
+                activity = substr[1]
             elif (strlen == 5):
                 if (substr[-1] == "eps"):
-                    morphing_matrix.append(substr[1])
+                    activity = substr[1]
                 else:
-                    morphing_matrix.append(substr[3])
+                    activity = substr[3]
+            else:
+                continue
 
-        n = len(morphing_matrix)
-        size = math.sqrt(n)
-        assert(size == int(size)) # must not be a float
+            """
+            XXX This cast to a double introduces loss of significance.
+            Unfortunately, SciPy doesn't support sparse matrices
+            with Decimals or strings.
+            """
+            value = float(activity)
+            if (value != 0):
+                variables.append(k)
+                values.append(value)
+            k += 1
 
-        self.result = morphing_matrix
+    if (k != len(i)):
+        raise ValueError("'%s' has %d columns instead of %d." %
+                         (fname, k, len(i)))
 
-    """Remove files that were created for GLPK."""
-    def __clean_mess(self):
-        os.remove(GLPK_FILENAME)
-        os.remove(SOLUTION_FILENAME)
+    variables = numpy.frombuffer(variables, dtype=numpy.dtype("l"))
+    return coo_matrix((numpy.frombuffer(values, dtype=numpy.double),
+                       (i[variables], j[variables])), shape=(n, n))
 
-def string_is_float(string):
-    try:
-        float(string)
-    except ValueError, TypeError:
-        return False
-    return True
+"""
+Write the morphing 'matrix' (a SciPy sparse matrix) to file 'fname' in
+Matrix Market format, like scipy.io.mmwrite() does (and, like it,
+appending '.mtx' to 'fname' if needed; see get_mm_filename()). Only its
+non-zero entries are written, MM_CHUNK_SIZE at a time, so nothing of
+the size of a dense matrix is ever built.
+"""
+def write_mm(fname, matrix, comment="Morphing Matrix"):
+    m = matrix.tocoo()
+    with open(get_mm_filename(fname), "w") as f:
+        f.write("%%MatrixMarket matrix coordinate real general\n")
+        f.write("".join("%%%s\n" % (line) for line in comment.split("\n")))
+        f.write("%d %d %d\n" % (m.shape[0], m.shape[1], m.nnz))
+        for start in xrange(0, m.nnz, MM_CHUNK_SIZE):
+            end = start + MM_CHUNK_SIZE
+            f.write("".join(["%d %d %.15e\n" % entry for entry in
+                             zip((m.row[start:end] + 1).tolist(),
+                                 (m.col[start:end] + 1).tolist(),
+                                 m.data[start:end].tolist())]))
 
-"""Given a file of the format '<packet length: probability>\n':
+"""Given the terminal 'output' of glpsol, return the number of simplex
+iterations it reports, or None if it reports none."""
+def get_glpsol_iterations(output):
+    iterations = None
+    for line in output.splitlines():
+        # e.g. '*   123: obj =   2.713867188e+00 inf =   0.000e+00 (0)'
+        fields = line.lstrip("*| ").split(":", 1)
+        if ((len(fields) == 2) and fields[0].isdigit() and
+            fields[1].lstrip().startswith("obj")):
+            iterations = int(fields[0])
+    return iterations
 
-# comment
-1: 0.024...
-2: 0.005...
-3: 0.156...
-...
+"""Given a morphing 'matrix' between distributions 'source' and
+'target', return a dictionary with the max. absolute residuals of the
+column_prob ('column_residual') and morphing_creation
+('target_residual') constraints of MODEL."""
+def get_residuals(matrix, source, target):
+    source = numpy.array(map(numpy.double, source))
+    target = numpy.array(map(numpy.double, target))
+    m = matrix.tocsc()
+    return {"column_residual":
+                numpy.abs(numpy.asarray(m.sum(axis=0)).ravel() - 1).max(),
+            "target_residual": numpy.abs(m.dot(source) - target).max()}
+
+"""Solve the sub-LP 'args' of DivideAndConquerLP. This is a module
+level function so that multiprocessing can pickle it."""
+def solve_sub_lp(args):
+    source, target, solver = args
+    return MorphingMatrixLP(source, target, solver).harvest().tocoo()
+
+"""
+Given the 'source' and 'target' distributions, return duals 'v' of
+morphing_creation that are optimal for the full LP (see
+price_entries()). Since the cost is |i - j|, the dual of the LP is to
+maximize sum_i v[i] * (target[i] - source[i]) over the 'v' with
+|v[i+1] - v[i]| <= 1, and v[i+1] - v[i] is best +1 where the source
+CDF is above the target CDF at 'i', -1 otherwise.
+"""
+def get_monotone_duals(source, target):
+    source_cdf = numpy.cumsum(source) / math.fsum(source)
+    target_cdf = numpy.cumsum(target) / math.fsum(target)
+    steps = numpy.where(source_cdf[:-1] > target_cdf[:-1], 1.0, -1.0)
+    return numpy.concatenate(([0.0], numpy.cumsum(steps)))
 
-return a list representing its probability distribution.
 """
+Given two probability distributions 'source' and 'target' (possibly of
+different sizes) return the morphing matrix of their monotone coupling
+as a SciPy COO matrix: the smallest source lengths become the smallest
+target lengths. It has less than len(source)+len(target) non-zero
+entries. Columns of zero-probability source lengths map to a single
+target length.
+"""
+def get_monotone_coupling(source, target):
+    source_cdf = numpy.cumsum(source) / math.fsum(source)
+    target_cdf = numpy.cumsum(target) / math.fsum(target)
+    source_cdf[-1] = target_cdf[-1] = 1.0
+
+    # Each interval between consecutive CDF breakpoints is probability
+    # mass moving from one source length to one target length.
+    points = numpy.union1d(source_cdf, target_cdf)
+    points = points[points > 0]
+    mass = numpy.diff(numpy.concatenate(([0.0], points)))
+    middle = points - mass / 2
+    cols = numpy.minimum(numpy.searchsorted(source_cdf, middle, side='right'),
+                         len(source)-1)
+    rows = numpy.minimum(numpy.searchsorted(target_cdf, middle, side='right'),
+                         len(target)-1)
+
+    source_mass = numpy.diff(numpy.concatenate(([0.0], source_cdf)))
+    keep = (mass > 0) & (source_mass[cols] > 0)
+    rows, cols = rows[keep], cols[keep]
+    values = mass[keep] / source_mass[cols]
+
+    empty = numpy.flatnonzero(source_mass <= 0)
+    if (len(empty)):
+        rows = numpy.concatenate((rows, numpy.minimum(
+            numpy.searchsorted(target_cdf, source_cdf[empty], side='right'),
+            len(target)-1)))
+        cols = numpy.concatenate((cols, empty))
+        values = numpy.concatenate((values, numpy.ones(len(empty))))
+
+    return coo_matrix((values, (rows, cols)), shape=(len(target), len(source)))
+
+"""Given a morphing 'matrix' and the 'source' distribution, return
+the value of the objective function of MODEL: the expected padding
+overhead, sum_j source[j] * sum_i matrix[i,j] * |i - j|."""
+def get_objective(matrix, source):
+    m = matrix.tocoo()
+    source = numpy.array(map(numpy.double, source))
+    return math.fsum(source[m.col] * m.data * numpy.abs(m.row - m.col))
+
+"""
+Given a morphing 'matrix', return a sparser copy of it in CSC format:
+entries smaller than 'threshold' are dropped and, if 'top_k' is given,
+only the 'top_k' largest entries of each column are kept. The largest
+entry of a column is always kept, so no column becomes empty. Columns
+are renormalized to sum up to 1 again.
+"""
+def prune_matrix(matrix, threshold=0.0, top_k=None):
+    m = matrix.tocoo()
+    keep = m.data > 0
+    rows, cols, data = m.row[keep], m.col[keep], m.data[keep]
+
+    # Rank the entries of each column by decreasing value.
+    order = numpy.lexsort((-data, cols))
+    rows, cols, data = rows[order], cols[order], data[order]
+    starts = numpy.searchsorted(cols, numpy.arange(m.shape[1]))
+    rank = numpy.arange(len(data)) - starts[cols]
+
+    keep = (rank == 0) | (data >= threshold)
+    if (top_k is not None):
+        keep &= rank < top_k
+    rows, cols, data = rows[keep], cols[keep], data[keep]
+
+    totals = numpy.bincount(cols, weights=data, minlength=m.shape[1])
+    data = data / totals[cols]
+
+    return coo_matrix((data, (rows, cols)), shape=m.shape).tocsc()
+
+"""Given a morphing 'matrix' and its 'pruned' version (see
+prune_matrix()) between distributions 'source' and 'target', return a
+dictionary with their non-zero entries ('nnz', 'pruned_nnz'), their
+expected padding costs ('objective', 'pruned_objective') and the max.
+and total absolute target distribution errors of 'pruned'
+('max_error', 'total_error')."""
+def get_prune_stats(matrix, pruned, source, target):
+    source = numpy.array(map(numpy.double, source))
+    target = numpy.array(map(numpy.double, target))
+    error = numpy.abs(pruned.dot(source) - target)
+    return {"nnz": matrix.nnz, "pruned_nnz": pruned.nnz,
+            "objective": get_objective(matrix, source),
+            "pruned_objective": get_objective(pruned, source),
+            "max_error": error.max(), "total_error": math.fsum(error)}
+
+"""Given a distribution file 'filename' (see distr.py), return its
+probability distribution as a NumPy array. Exit if it's not valid."""
 def get_distr_from_file(filename):
-    i = 1
-    distr = []
-    with open(filename) as file:
-        for line in file:
-            subline = line.split(" ")
-            if (subline[0].startswith("#")): # comment
+    try:
+        return distr.get_distr_from_file(filename, paranoid=PARANOIA)
+    except ValueError, e:
+        print e
+        sys.exit(1)
+
+"""
+Represents a content-addressed on-disk cache of solved morphing
+matrices. A morphing matrix is stored as a Matrix Market file named
+after the hash of its normalized source and target distributions and
+of the solver settings that produced it (see get_key()). When the
+cache grows beyond its size limit, the least recently used matrices
+are evicted; the modification time of a file is its last use.
+
+'self.directory' is the directory of the cache.
+'self.max_size' is the size limit of the cache in bytes.
+"""
+class MatrixCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR,
+                 max_size=DEFAULT_CACHE_SIZE*1024*1024):
+        self.directory = directory
+        self.max_size = max_size
+        if (not os.path.isdir(self.directory)):
+            os.makedirs(self.directory)
+
+    """Public function.
+    Return the cache key of the morphing matrix between distributions
+    'source' and 'target' when solved with 'settings'.
+    """
+    @staticmethod
+    def get_key(source, target, settings):
+        h = hashlib.sha256()
+        h.update("morpheus cache v%s\n" % (CACHE_VERSION))
+        h.update("solver=%s\n" % (settings.get("solver", SOLVER_GLPSOL)))
+        strategy = settings.get("strategy", STRATEGY_FULL)
+        h.update("strategy=%s\n" % (strategy))
+        if (strategy == STRATEGY_DIVIDE):
+            h.update("bins=%d\n" % (settings.get("bins", DEFAULT_BINS)))
+        if (strategy == STRATEGY_COLGEN):
+            h.update("band=%d\n" % (settings.get("band", DEFAULT_BAND)))
+        if (settings.get("previous")):
+            h.update("previous=%s window=%d\n" %
+                     (get_file_hash(settings["previous"]),
+                      settings.get("window", DEFAULT_WINDOW)))
+        if (settings.get("prune") or settings.get("top_k")):
+            h.update("prune=%r top_k=%r\n" %
+                     (settings.get("prune"), settings.get("top_k")))
+        for distr in (source, target):
+            d = numpy.array(map(numpy.double, distr))
+            d /= math.fsum(d)
+            h.update("%d\n" % (len(d)))
+            h.update(d.tostring())
+
+        return h.hexdigest()
+
+    """Public function.
+    If the cache has the morphing matrix of 'key', copy it to 'output'
+    and return True. Otherwise, return False.
+    """
+    def lookup(self, key, output):
+        fname = self.__get_filename(key)
+        try:
+            shutil.copyfile(fname, output)
+        except IOError:
+            return False
+
+        os.utime(fname, None) # mark it as recently used
+        return True
+
+    """Public function.
+    Add the morphing matrix in Matrix Market file 'fname' to the cache
+    as the morphing matrix of 'key', and evict old matrices if needed.
+    """
+    def store(self, key, fname):
+        # Copy and rename, so that concurrent runs never see a partial file.
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(fname, tmp)
+        os.rename(tmp, self.__get_filename(key))
+
+        self.__evict()
+
+    """Remove least recently used matrices until the cache fits in
+    'self.max_size'."""
+    def __evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if (not name.endswith(".mtx")):
                 continue
-            if ((len(subline) != 2) or
-                (not subline[0].startswith(str(i))) or
-                (not string_is_float(subline[1]))):
-                print "Wrong file format (%d %s %s)" % (len(subline), subline[0], str(i))
-                sys.exit(1)
-            distr.append(subline[1].rstrip())
-            i+=1
+            fname = os.path.join(self.directory, name)
+            try:
+                st = os.stat(fname)
+            except OSError: # evicted by a concurrent run
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
 
-    if (PARANOIA):
-        tmp = map(decimal.Decimal, distr)
-        assert(math.fsum(tmp) == decimal.Decimal(1))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, fname) in sorted(entries):
+            if (total <= self.max_size):
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total -= size
 
-    return distr
+    """Return the filename of the morphing matrix of 'key'."""
+    def __get_filename(self, key):
+        return os.path.join(self.directory, "%s.mtx" % (key))
+
+"""Return the SHA-256 hex digest of the contents of file 'fname'."""
+def get_file_hash(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), ""):
+            h.update(chunk)
+    return h.hexdigest()
+
+"""Return the filename that scipy.io.mmwrite() and write_mm() write to
+when asked to write to 'output'."""
+def get_mm_filename(output):
+    if (not output.endswith(".mtx")):
+        return output + ".mtx"
+    return output
 
 """Spit usage instructions and exit"""
 def usage():
@@ -226,55 +1118,246 @@ def usage():
        --source=<source distribution filename>
        --target=<target distribution filename>
        --output=<morphing matrix output filename>
-    """
+       --binary=<also write the morphing matrix in binary format to this file>
+       --solver=<LP solver: 'glpsol' (default), 'linprog' (in-process
+                 interior-point) or 'ot1d' (exact 1-D optimal transport,
+                 no LP)>
+       --strategy=<'full' (default), 'divide' (divide-and-conquer) or
+                   'colgen' (column generation)>
+       --bins=<number of bins of the 'divide' strategy (default: %d)>
+       --band=<half-width of the initial band of the 'colgen' strategy
+               (default: %d)>
+       --jobs=<number of LPs to solve in parallel (default: #CPUs)>
+       --gap (also solve the full LP and report the optimality gap)
+       --manifest=<file of '<source> <target> <output> [<binary>]' lines; generate
+                   all of them in parallel instead of --source/--target/--output>
+       --cache-dir=<cache of solved morphing matrices (default: %s)>
+       --cache-size=<size limit of the cache in megabytes (default: %d)>
+       --no-cache (don't look up or store matrices in the cache)
+       --previous=<morphing matrix solved for slightly different
+                   distributions; re-solve incrementally starting from it
+                   (linprog solver only)>
+       --window=<rows to widen the support of --previous by (default: %d)>
+       --prune=<drop entries smaller than this probability, e.g. 1e-4>
+       --top-k=<keep only the k largest entries of each column>
+    """ % (DEFAULT_BINS, DEFAULT_BAND, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE,
+           DEFAULT_WINDOW)
     sys.exit()
 
+"""Startup morpheus."""
+def startup(source_distr, target_distr, output, solver=SOLVER_GLPSOL,
+            strategy=STRATEGY_FULL, bins=DEFAULT_BINS, band=DEFAULT_BAND,
+            jobs=None, gap=False,
+            cache_dir=DEFAULT_CACHE_DIR, cache_size=DEFAULT_CACHE_SIZE,
+            previous=None, window=DEFAULT_WINDOW, prune=None, top_k=None,
+            binary=None):
+    """Cached morphing matrix."""
+    cache = None
+    if (cache_dir):
+        cache = MatrixCache(cache_dir, cache_size*1024*1024)
+        key = MatrixCache.get_key(source_distr, target_distr,
+                                  {"solver": solver, "strategy": strategy,
+                                   "bins": bins, "band": band,
+                                   "previous": previous,
+                                   "window": window, "prune": prune,
+                                   "top_k": top_k})
+        if (cache.lookup(key, get_mm_filename(output))):
+            print "Using cached morphing matrix %s." % (key)
+            if (binary):
+                dream.write_binary(scipy.io.mmread(get_mm_filename(output)),
+                                   binary)
+            return
+
+    """Morphing matrix."""
+    if (previous):
+        m_m_lp = IncrementalLP(source_distr, target_distr,
+                               scipy.io.mmread(previous), solver, window)
+    elif (strategy == STRATEGY_DIVIDE):
+        m_m_lp = DivideAndConquerLP(source_distr, target_distr, bins,
+                                    solver, jobs)
+    elif (strategy == STRATEGY_COLGEN):
+        m_m_lp = ColumnGenerationLP(source_distr, target_distr, band, solver)
+    else:
+        m_m_lp = MorphingMatrixLP(source_distr, target_distr, solver)
+    m_m = m_m_lp.harvest()
+
+    assert(m_m.shape == (len(source_distr), len(source_distr)))
+
+    if (isinstance(m_m_lp, MorphingMatrixLP) and (solver == SOLVER_OT1D)):
+        stats = m_m_lp.stats
+        print "Monotone coupling: %d non-zero entries, found in %.6fs." % \
+            (m_m.nnz, stats["solve_time"])
+        print "Monotone coupling: objective %f, max. primal residuals %g " \
+            "(column_prob), %g (morphing_creation)." % \
+            (stats["objective"], stats["column_residual"],
+             stats["target_residual"])
+    elif (isinstance(m_m_lp, MorphingMatrixLP)):
+        stats = m_m_lp.stats
+        print "LP: %d variables, %d constraints, %d non-zeros." % \
+            (stats["variables"], stats["constraints"], stats["nonzeros"])
+        print "LP: built in %.2fs, solved in %.2fs (%s iterations)." % \
+            (stats["build_time"], stats["solve_time"],
+             stats["iterations"] if (stats["iterations"] is not None) else "?")
+        print "LP: objective %f, max. primal residuals %g (column_prob), " \
+            "%g (morphing_creation)." % \
+            (stats["objective"], stats["column_residual"],
+             stats["target_residual"])
+
+    if (previous):
+        stats = m_m_lp.stats
+        if (stats["warm"]):
+            print "Warm-started from the previous matrix (%d of %d " \
+                "variables), proven optimal after %d round(s)." % \
+                (stats["support"], len(source_distr) ** 2,
+                 len(stats["rounds"]))
+        else:
+            print "Warm start not proven optimal after %d round(s); " \
+                "solved the full LP." % (len(stats["rounds"]))
+        print "Lower bound on the optimum: %f, optimality gap: at most %g%s." % \
+            (stats["lower_bound"], stats["gap"],
+             "" if (stats["optimal"]) else " (not proven optimal)")
+        print "Previous matrix: max. target distribution error %g." % \
+            (stats["previous_error"])
+        print "Matrix change: max. entry %g, mean column total variation %g." % \
+            (stats["max_change"], stats["mean_column_tv"])
+        print "Expected padding cost: %f -> %f (%+f)." % \
+            (stats["previous_objective"], stats["objective"],
+             stats["objective"] - stats["previous_objective"])
+
+    if (strategy == STRATEGY_COLGEN):
+        for (k, r) in enumerate(m_m_lp.stats["rounds"]):
+            print "Column generation round %d: %d variables, objective %f, " \
+                "solved in %.2fs, %d entries added." % \
+                (k+1, r["support"], r["objective"], r["solve_time"], r["added"])
+        stats = m_m_lp.stats
+        if (stats["full_lp"]):
+            print "Column generation not proven optimal after %d " \
+                "round(s); solved the full LP." % (len(stats["rounds"]))
+        elif (stats["optimal"]):
+            print "Proven optimal with %d of %d " \
+                "variables." % (stats["support"], len(source_distr) ** 2)
+        if (not stats["optimal"]):
+            print "Not proven optimal."
+        print "Objective: %f (lower bound: %f, gap at most %f)." % \
+            (stats["objective"], stats["lower_bound"], stats["gap"])
+
+    if (gap and (strategy != STRATEGY_FULL)):
+        objective = get_objective(m_m, source_distr)
+        full = MorphingMatrixLP(source_distr, target_distr, solver).harvest()
+        optimum = get_objective(full, source_distr)
+        print "Objective: %f (full LP: %f, optimality gap: %f%%)" % \
+            (objective, optimum,
+             100 * (objective - optimum) / optimum if (optimum) else 0)
+
+    if (prune or top_k):
+        pruned = prune_matrix(m_m, prune or 0.0, top_k)
+        stats = get_prune_stats(m_m, pruned, source_distr, target_distr)
+        print "Pruned %d of %d non-zero entries (%.1f%%)." % \
+            (stats["nnz"] - stats["pruned_nnz"], stats["nnz"],
+             100.0 * (stats["nnz"] - stats["pruned_nnz"]) / stats["nnz"])
+        print "Expected padding cost: %f -> %f (%+f)." % \
+            (stats["objective"], stats["pruned_objective"],
+             stats["pruned_objective"] - stats["objective"])
+        print "Target distribution error: max. %g, total %g." % \
+            (stats["max_error"], stats["total_error"])
+        m_m = pruned
+
+    write_mm(output, m_m)
+    if (binary):
+        dream.write_binary(m_m, binary)
+
+    if (cache):
+        cache.store(key, get_mm_filename(output))
+
+"""Given a manifest file of the format '<source> <target> <output> [<binary>]\n':
+
+# comment
+data/tor_cs_distr.txt data/https_cs_distr.txt tor_https_cs.mtx
+data/tor_sc_distr.txt data/https_sc_distr.txt tor_https_sc.mtx tor_https_sc.bin
+...
+
+return a list of (source, target, output, binary) filename tuples,
+where 'binary' is None if no binary output was given. Relative
+filenames are relative to the directory of the manifest.
 """
-Given a 'list' and a 'size', return a list of lists representing a
-square matrix.
-Example: get_sqmatrix_from_list([0,1,2,3],2) = [[0,1],[2,3]]
-"""
-def get_sqmatrix_from_list(list, size):
-    ret = []
-    start = 0
-    end = size
-    if (len(list) != pow(size,2)):
-        raise ValueError("You either gave a wrong 'size' " \
-                         "or this is not a square matrix. (%d:%d)" % (len(list), size))
+def get_manifest_from_file(filename):
+    topdir = os.path.dirname(filename)
+    manifest = []
+    with open(filename) as file:
+        for line in file:
+            subline = line.split()
+            if ((not subline) or (subline[0].startswith("#"))): # comment
+                continue
+            if (len(subline) not in (3, 4)):
+                print "Wrong manifest format (%s)" % (line.rstrip())
+                sys.exit(1)
+            entry = [os.path.join(topdir, fname) for fname in subline]
+            manifest.append(tuple(entry + [None] * (4 - len(entry))))
 
-    tmp_list = []
-    for _ in xrange(size):
-        ret.append(list[start:end])
-        start += size
-        end += size
+    return manifest
 
-    assert(start == len(list))
+"""Generate the morphing matrix of the manifest entry 'args', which is
+a (source, target, output, binary, settings) tuple. Return the entry,
+how long it took and an error string (None on success). This is a module level
+function so that multiprocessing can pickle it."""
+def run_manifest_entry(args):
+    source, target, output, binary, settings = args
+    error = None
+    start = time.time()
+    try:
+        startup(get_distr_from_file(source), get_distr_from_file(target),
+                output, binary=binary, **settings)
+    except (Exception, SystemExit), e:
+        error = "%s: %s" % (type(e).__name__, e)
 
-    return ret
+    return (source, target, output, time.time() - start, error)
 
-"""Startup morpheus."""
-def startup(source_distr, target_distr, output):
-    """Morphing matrix."""
-    m_m_glpk = MorphingMatrixLP(source_distr, target_distr)
-    m_m = m_m_glpk.harvest()
+"""Generate the morphing matrices of all the entries of 'manifest' on a
+pool of 'jobs' processes, passing 'settings' to startup(). Each LP
+solve uses its own temporary directory, so entries don't interfere.
+Print the time spent on each entry and return the number of failed
+entries."""
+def batch(manifest, jobs, settings):
+    # Worker processes can't have children, so LPs of one entry are
+    # solved sequentially.
+    settings = dict(settings, jobs=1)
+    tasks = [(source, target, output, binary, settings)
+             for (source, target, output, binary) in manifest]
 
-    m_size = len(m_m)
-    assert(math.sqrt(m_size) == int(math.sqrt(m_size)))
+    failed = 0
+    start = time.time()
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        for (source, target, output, spent, error) in \
+                pool.imap_unordered(run_manifest_entry, tasks):
+            if (error):
+                failed += 1
+                print "%s -> %s: FAILED after %.2fs (%s)" % \
+                    (source, target, spent, error)
+            else:
+                print "%s -> %s: wrote %s in %.2fs" % \
+                    (source, target, output, spent)
+    finally:
+        pool.close()
+        pool.join()
 
-    """
-    XXX This cast to numpy.double introduces loss of significance.
-    Unfortunately, SciPy doesn't support sparse matrices
-    with Decimals or strings.
-    """
-    tmp_m_m = map(numpy.double, m_m)
-    sq = get_sqmatrix_from_list(tmp_m_m, int(math.sqrt(m_size)))
-    lm = lil_matrix(sq)
-    scipy.io.mmwrite(output, lm, comment="Morphing Matrix", field="real")
+    print "Generated %d/%d morphing matrices in %.2fs." % \
+        (len(tasks) - failed, len(tasks), time.time() - start)
+
+    return failed
 
 """Entry point"""
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "s:t:o:p", ["source=", "target=", "output="])
+        opts, args = getopt.getopt(argv, "s:t:o:p", ["source=", "target=", "output=",
+                                                          "solver=", "strategy=",
+                                                          "bins=", "band=",
+                                                          "jobs=", "gap",
+                                                          "manifest=", "cache-dir=",
+                                                          "cache-size=", "no-cache",
+                                                          "previous=", "window=",
+                                                          "binary=", "prune=",
+                                                          "top-k="])
     except getopt.GetoptError:
         usage()
         sys.exit(1)
@@ -282,6 +1365,20 @@ def main(argv):
     source = None
     target = None
     output = None
+    solver = SOLVER_GLPSOL
+    strategy = STRATEGY_FULL
+    bins = DEFAULT_BINS
+    band = DEFAULT_BAND
+    jobs = None
+    gap = False
+    manifest = None
+    cache_dir = DEFAULT_CACHE_DIR
+    cache_size = DEFAULT_CACHE_SIZE
+    previous = None
+    window = DEFAULT_WINDOW
+    binary = None
+    prune = None
+    top_k = None
 
     for opt, arg in opts:
         if opt in ("-s", "--source"):
@@ -290,21 +1387,140 @@ def main(argv):
             target = arg
         elif opt in ("-o", "--output"):
             output = arg
+        elif opt == "--solver":
+            solver = arg
+        elif opt == "--strategy":
+            strategy = arg
+        elif opt == "--bins":
+            bins = int(arg) if arg.isdigit() else 0
+        elif opt == "--band":
+            band = int(arg) if arg.isdigit() else -1
+        elif opt == "--jobs":
+            jobs = int(arg) if arg.isdigit() else 0
+        elif opt == "--gap":
+            gap = True
+        elif opt == "--manifest":
+            manifest = arg
+        elif opt == "--cache-dir":
+            cache_dir = arg
+        elif opt == "--cache-size":
+            cache_size = int(arg) if arg.isdigit() else 0
+        elif opt == "--no-cache":
+            cache_dir = None
+        elif opt == "--previous":
+            previous = arg
+        elif opt == "--window":
+            window = int(arg) if arg.isdigit() else -1
+        elif opt == "--binary":
+            binary = arg
+        elif opt == "--prune":
+            try:
+                prune = float(arg)
+            except ValueError:
+                prune = -1.0
+        elif opt == "--top-k":
+            top_k = int(arg) if arg.isdigit() else 0
 
-    if ((not source) or (not target)):
-        print "Please provide a source and a target distribution."
+    if (manifest):
+        if (not os.path.isfile(manifest)):
+            print "Please provide a valid manifest filename."
+            usage()
+        entries = get_manifest_from_file(manifest)
+        outputs = [output for (_, _, output, _) in entries] + \
+            [binary for (_, _, _, binary) in entries if (binary)]
+        if (not entries):
+            print "The manifest is empty."
+            usage()
+        if (len(set(outputs)) != len(outputs)):
+            print "The manifest lists the same output filename twice."
+            usage()
+        for (source, target, output, binary) in entries:
+            if ((not os.path.isfile(source)) or (not os.path.isfile(target))):
+                print "Please provide valid filenames for the distributions " \
+                    "(%s, %s)." % (source, target)
+                usage()
+            for fname in (output, binary):
+                if (fname and os.path.exists(fname)):
+                    print "Output file '%s' already exists." % (fname)
+                    usage()
+    else:
+        if ((not source) or (not target)):
+            print "Please provide a source and a target distribution."
+            usage()
+        if ((not os.path.isfile(source)) or (not os.path.isfile(target))):
+            print "Please provide valid filenames for the distributions."
+            usage()
+        if ((not output) or (os.path.exists(output))):
+            print "Please provide a valid output filename."
+            usage()
+        if (binary and os.path.exists(binary)):
+            print "Please provide a valid binary output filename."
+            usage()
+    if (solver not in SOLVERS):
+        print "Please provide a valid LP solver (%s)." % (", ".join(SOLVERS))
+        usage()
+    if (strategy not in STRATEGIES):
+        print "Please provide a valid strategy (%s)." % (", ".join(STRATEGIES))
+        usage()
+    if ((bins <= 0) or (jobs == 0)):
+        print "Please provide a positive number of bins and jobs."
+        usage()
+    if (band < 0):
+        print "Please provide a non-negative band."
+        usage()
+    if ((strategy == STRATEGY_COLGEN) and (solver != SOLVER_LINPROG)):
+        print "The 'colgen' strategy needs the linprog solver."
+        usage()
+    if (cache_size <= 0):
+        print "Please provide a positive cache size."
+        usage()
+    if (previous and (not os.path.isfile(previous))):
+        print "Please provide a valid filename for the previous matrix."
         usage()
-    if ((not os.path.isfile(source)) or (not os.path.isfile(target))):
-        print "Please provide valid filenames for the distributions."
+    if (previous and (strategy != STRATEGY_FULL)):
+        print "--previous only works with the 'full' strategy."
         usage()
-    if ((not output) or (os.path.exists(output))):
-        print "Please provide a valid output filename."
+    if (previous and (solver == SOLVER_GLPSOL)):
+        print "--previous needs the linprog solver."
         usage()
+    if (previous and (solver == SOLVER_OT1D)):
+        print "--previous is pointless with the 'ot1d' solver, " \
+            "which is exact and takes no LP solve."
+        usage()
+    if (window < 0):
+        print "Please provide a non-negative window."
+        usage()
+    if ((prune is not None) and (not (0 <= prune < 1))):
+        print "Please provide a pruning threshold in [0, 1)."
+        usage()
+    if (top_k == 0):
+        print "Please provide a positive number of entries to keep."
+        usage()
+
+    settings = {
+        "solver": solver,
+        "strategy": strategy,
+        "bins": bins,
+        "band": band,
+        "jobs": jobs,
+        "gap": gap,
+        "cache_dir": cache_dir,
+        "cache_size": cache_size,
+        "previous": previous,
+        "window": window,
+        "prune": prune,
+        "top_k": top_k,
+    }
+
+    if (manifest):
+        if (batch(entries, jobs or multiprocessing.cpu_count(), settings)):
+            sys.exit(1)
+        return
 
     source_distr = get_distr_from_file(source)
     target_distr = get_distr_from_file(target)
 
-    startup(source_distr, target_distr, output)
+    startup(source_distr, target_distr, output, binary=binary, **settings)
 
 if __name__ == "__main__":
     if (sys.hexversion < 0x02070000):